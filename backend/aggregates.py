@@ -0,0 +1,95 @@
+"""Materialized artist, album and genre summaries.
+
+Each summary collection holds one document per artist, album (keyed by album
+name and artist) or genre with a song count, the total duration and a
+representative cover. They are kept up to date with ``$inc`` upserts whenever
+songs are added, so the listing endpoints never have to scan ``songs``.
+"""
+import logging
+
+from pymongo import ReplaceOne, UpdateOne
+
+logger = logging.getLogger(__name__)
+
+# summary collection -> (summary key field, song field) pairs
+SUMMARIES = {
+    "artists": (("name", "artist"),),
+    "albums": (("name", "album"), ("artist", "artist")),
+    "genres": (("name", "genre"),),
+}
+
+REBUILD_BATCH_SIZE = 1000
+
+
+def summarize(songs, summaries=None):
+    """Fold songs into ``{collection: {key: totals}}``, optionally adding to ``summaries``."""
+    if summaries is None:
+        summaries = {collection: {} for collection in SUMMARIES}
+    for song in songs:
+        for collection, key_fields in SUMMARIES.items():
+            key = tuple(song[song_field] for _, song_field in key_fields)
+            totals = summaries[collection].get(key)
+            if totals is None:
+                totals = summaries[collection][key] = {
+                    "song_count": 0,
+                    "total_duration": 0,
+                    "cover_art": song.get("cover_art", ""),
+                }
+            totals["song_count"] += 1
+            totals["total_duration"] += song.get("duration", 0)
+    return summaries
+
+
+async def write_summaries(db, summaries):
+    """Apply folded totals to the summary collections (one bulk write per collection)."""
+    for collection, totals_by_key in summaries.items():
+        key_fields = [summary_field for summary_field, _ in SUMMARIES[collection]]
+        operations = [
+            UpdateOne(
+                dict(zip(key_fields, key)),
+                {
+                    "$inc": {"song_count": totals["song_count"], "total_duration": totals["total_duration"]},
+                    "$setOnInsert": {"cover_art": totals["cover_art"]},
+                },
+                upsert=True,
+            )
+            for key, totals in totals_by_key.items()
+        ]
+        if operations:
+            await db[collection].bulk_write(operations, ordered=False)
+
+
+async def record_songs(db, songs):
+    """Add newly inserted songs to the summaries."""
+    await write_summaries(db, summarize(songs))
+
+
+async def rebuild_summaries(db):
+    """Recompute every summary from the songs collection."""
+    for collection, key_fields in SUMMARIES.items():
+        pipeline = [
+            {"$group": {
+                "_id": {summary_field: f"${song_field}" for summary_field, song_field in key_fields},
+                "song_count": {"$sum": 1},
+                "total_duration": {"$sum": "$duration"},
+                "cover_art": {"$first": "$cover_art"},
+            }},
+        ]
+        operations = []
+        async for group in db.songs.aggregate(pipeline, allowDiskUse=True):
+            key = group.pop("_id")
+            operations.append(ReplaceOne(key, {**key, **group}, upsert=True))
+            if len(operations) >= REBUILD_BATCH_SIZE:
+                await db[collection].bulk_write(operations, ordered=False)
+                operations = []
+        if operations:
+            await db[collection].bulk_write(operations, ordered=False)
+    logger.info("Rebuilt artist, album and genre summaries")
+
+
+async def ensure_summaries(db):
+    """Build the summaries on first start against an existing catalog; returns whether it did."""
+    if await db.artists.estimated_document_count() == 0 and await db.songs.estimated_document_count() > 0:
+        await rebuild_summaries(db)
+        return True
+    return False
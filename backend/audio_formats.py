@@ -0,0 +1,119 @@
+"""Minimal audio container parsing: durations and MP3 frame boundaries.
+
+Only what the media pipeline needs is implemented natively (WAV, FLAC and
+MPEG audio Layer III). Other formats fall back to ``mutagen`` when it is
+installed.
+"""
+import mmap
+import wave
+
+try:
+    import mutagen
+except ImportError:  # optional dependency
+    mutagen = None
+
+AUDIO_EXTENSIONS = {".mp3", ".flac", ".wav", ".ogg", ".oga", ".opus", ".m4a", ".aac"}
+
+_MP3_BITRATES = {
+    # MPEG-1 Layer III
+    True: (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+    # MPEG-2 / 2.5 Layer III
+    False: (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+}
+_MP3_SAMPLE_RATES = {3: (44100, 48000, 32000), 2: (22050, 24000, 16000), 0: (11025, 12000, 8000)}
+
+
+def parse_mp3_header(data, offset=0):
+    """Decode a Layer III frame header at ``offset``.
+
+    Returns ``(frame_length, samples_per_frame, sample_rate)`` or None.
+    """
+    if offset + 4 > len(data):
+        return None
+    header = int.from_bytes(data[offset:offset + 4], "big")
+    if header >> 21 != 0x7FF:
+        return None
+    version = (header >> 19) & 0b11
+    layer = (header >> 17) & 0b11
+    bitrate_index = (header >> 12) & 0b1111
+    rate_index = (header >> 10) & 0b11
+    padding = (header >> 9) & 1
+    if version == 1 or layer != 1 or bitrate_index in (0, 15) or rate_index == 3:
+        return None
+    mpeg1 = version == 3
+    bitrate = _MP3_BITRATES[mpeg1][bitrate_index] * 1000
+    sample_rate = _MP3_SAMPLE_RATES[version][rate_index]
+    samples = 1152 if mpeg1 else 576
+    return samples // 8 * bitrate // sample_rate + padding, samples, sample_rate
+
+
+def _id3v2_size(data):
+    if data[:3] != b"ID3" or len(data) < 10:
+        return 0
+    size = 0
+    for byte in data[6:10]:
+        size = (size << 7) | (byte & 0x7F)
+    footer = 10 if data[5] & 0x10 else 0
+    return 10 + size + footer
+
+
+def iter_mp3_frames(data):
+    """Yield ``(offset, length, samples, sample_rate)`` for each MP3 frame in ``data``."""
+    offset = _id3v2_size(data)
+    end = len(data)
+    while offset + 4 <= end:
+        frame = parse_mp3_header(data, offset)
+        if frame is None or offset + frame[0] > end:
+            # Resync on the next possible frame sync byte
+            offset = data.find(b"\xff", offset + 1)
+            if offset < 0:
+                return
+            continue
+        yield (offset,) + frame
+        offset += frame[0]
+
+
+def _flac_duration(path):
+    with open(path, "rb") as file:
+        header = file.read(42)
+    if header[:4] != b"fLaC" or header[4] & 0x7F != 0:
+        return None
+    streaminfo = header[8:42]
+    sample_rate = int.from_bytes(streaminfo[10:13], "big") >> 4
+    total_samples = int.from_bytes(streaminfo[13:18], "big") & 0xFFFFFFFFF
+    return total_samples / sample_rate if sample_rate and total_samples else None
+
+
+def _wav_duration(path):
+    try:
+        with wave.open(str(path), "rb") as audio:
+            return audio.getnframes() / audio.getframerate()
+    except (wave.Error, EOFError):
+        return None
+
+
+def _mp3_duration(path):
+    with open(path, "rb") as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        seconds = sum(samples / rate for _, _, samples, rate in iter_mp3_frames(data))
+    return seconds or None
+
+
+def probe_duration(path):
+    """Duration of an audio file in seconds, or None if it cannot be determined.
+
+    Blocking; call it from a worker thread.
+    """
+    suffix = path.suffix.lower()
+    duration = None
+    if path.stat().st_size:
+        if suffix == ".wav":
+            duration = _wav_duration(path)
+        elif suffix == ".flac":
+            duration = _flac_duration(path)
+        elif suffix == ".mp3":
+            duration = _mp3_duration(path)
+    if duration is None and mutagen is not None:
+        audio = mutagen.File(path)
+        if audio is not None and audio.info is not None:
+            duration = audio.info.length
+    return duration
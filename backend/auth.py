@@ -0,0 +1,158 @@
+"""Password hashing and signed access tokens.
+
+bcrypt is deliberately slow, so ``PasswordHasher`` runs it on a small
+dedicated thread pool (bcrypt releases the GIL while hashing) and turns
+callers away with ``HasherBusy`` once ``max_pending`` hashes are queued,
+rather than letting a login storm back up behind every other request.
+
+Access tokens are HS256 JWTs verified with the shared secret alone.
+``RevocationList`` remembers the ids of logged-out tokens until they would
+have expired anyway; revocations are stored in the ``revoked_tokens``
+repository so other processes pick them up with ``refresh``.
+
+Accounts registered before passwords were stored have no ``password_hash``
+and cannot log in until one is set from the ``backend`` directory:
+
+    python auth.py set-password user@example.com
+"""
+import argparse
+import asyncio
+import getpass
+import secrets
+import sys
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import jwt
+from passlib.context import CryptContext
+
+
+class HasherBusy(Exception):
+    pass
+
+
+class InvalidToken(Exception):
+    pass
+
+
+class PasswordHasher:
+    def __init__(self, workers=2, max_pending=64, rounds=12):
+        self.workers = workers
+        self.max_pending = max_pending
+        self._context = CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=rounds)
+        self._executor = None
+        self._pending = 0
+        # Checked against when the account does not exist, so a miss costs as much as a hit
+        self._dummy_hash = None
+
+    async def _run(self, func, *args):
+        if self._pending >= self.max_pending:
+            raise HasherBusy()
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="password-hash")
+        self._pending += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+        finally:
+            self._pending -= 1
+
+    async def hash(self, password):
+        return await self._run(self._context.hash, password)
+
+    async def verify(self, password, password_hash):
+        """Return ``(matches, new_hash)``; ``new_hash`` is set when the stored hash should be upgraded."""
+        if password_hash is None:
+            if self._dummy_hash is None:
+                self._dummy_hash = await self.hash(secrets.token_hex(16))
+            await self._run(self._context.verify, password, self._dummy_hash)
+            return False, None
+        return await self._run(self._context.verify_and_update, password, password_hash)
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+class TokenIssuer:
+    def __init__(self, secret, ttl=86400, algorithm="HS256"):
+        self.secret = secret
+        self.ttl = ttl
+        self.algorithm = algorithm
+
+    def issue(self, subject, **claims):
+        """Return ``(token, expires_at)`` for ``subject`` with extra ``claims``."""
+        issued_at = datetime.utcnow().replace(microsecond=0)
+        expires_at = issued_at + timedelta(seconds=self.ttl)
+        payload = {**claims, "sub": subject, "jti": uuid.uuid4().hex, "iat": issued_at, "exp": expires_at}
+        return jwt.encode(payload, self.secret, algorithm=self.algorithm), expires_at
+
+    def decode(self, token):
+        try:
+            return jwt.decode(token, self.secret, algorithms=[self.algorithm], options={"require": ["exp", "jti", "sub"]})
+        except jwt.PyJWTError as exc:
+            raise InvalidToken(str(exc)) from exc
+
+
+class RevocationList:
+    def __init__(self, clock=time.time):
+        self._clock = clock
+        self._revoked = {}  # jti -> expiry (epoch seconds)
+        self._last_refresh = None
+
+    def __contains__(self, jti):
+        return jti in self._revoked
+
+    def purge(self):
+        now = self._clock()
+        self._revoked = {jti: expires for jti, expires in self._revoked.items() if expires > now}
+
+    async def revoke(self, store, claims):
+        await store.add(claims["jti"], datetime.utcfromtimestamp(claims["exp"]))
+        self._revoked[claims["jti"]] = claims["exp"]
+
+    async def refresh(self, store, overlap=timedelta(seconds=60)):
+        """Load revocations made since the last refresh (all unexpired ones the first time)."""
+        started = datetime.utcnow()
+        if self._last_refresh is None:
+            revoked = await store.unexpired(started)
+        else:
+            # Overlap a little so writes from hosts with a lagging clock are not missed
+            revoked = await store.revoked_since(self._last_refresh - overlap)
+        for jti, expires_at in revoked:
+            self._revoked[jti] = (expires_at - datetime(1970, 1, 1)).total_seconds()
+        self._last_refresh = started
+        self.purge()
+
+
+async def _main(email):
+    import server
+
+    try:
+        if server.STORAGE_BACKEND == "memory":
+            print("set-password needs STORAGE_BACKEND=mongo; the memory backend keeps users inside the server process")
+            return 1
+        user = await server.storage.users.find_by_email(email)
+        if user is None:
+            print(f"No user with email {email}")
+            return 1
+        password = getpass.getpass(f"New password for {email}: ")
+        if not password or password != getpass.getpass("Repeat it: "):
+            print("Passwords are empty or do not match")
+            return 1
+        await server.storage.users.set_password_hash(user["id"], await server.password_hasher.hash(password))
+    finally:
+        server.password_hasher.shutdown()
+        server.storage.close()
+    print(f"Password set for {email}")
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Set a user's password, e.g. for an account registered without one")
+    parser.add_argument("command", choices=["set-password"])
+    parser.add_argument("email")
+    args = parser.parse_args()
+    sys.exit(asyncio.run(_main(args.email)))
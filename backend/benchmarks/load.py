@@ -0,0 +1,453 @@
+"""Load-benchmark every ``/api`` route.
+
+Seeds a throwaway database with a synthetic catalog, playlists and play
+history, starts the app (in-process over ASGI, or behind a local uvicorn with
+``--http``) and drives each route with ``--concurrency`` concurrent clients.
+Prints requests per second and p50/p95/p99 latency per route and writes them
+to ``--output`` as JSON; with ``--baseline`` the run is compared against an
+earlier one and exits non-zero when a route's p95 or throughput is worse by
+more than ``--tolerance``. In-process, a handler that never waits on I/O
+runs to completion before the next request starts, so its latency excludes
+queueing; ``--http`` measures what a client would see. Run from the
+``backend`` directory:
+
+    python -m benchmarks.load --catalog 10k --output bench-10k.json
+    python -m benchmarks.load --catalog 10k --baseline bench-10k.json
+
+Seeding goes through the app's storage repositories. By default they are
+backed by a local MongoDB (``--mongo-url``, default
+``mongodb://localhost:27017``) in which a ``bench_*`` database is created
+and dropped afterwards; ``--storage memory`` runs against the in-process
+engine instead, which needs no server and isolates the app's own overhead.
+Only compare runs made with the same storage. Data and request mix are
+derived from ``--seed``, so runs repeat.
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import logging
+import math
+import os
+import platform
+import random
+import sys
+import time
+import uuid
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+import httpx
+import numpy as np
+
+# catalog name -> (songs, plays, users)
+CATALOGS = {
+    "10k": (10_000, 200_000, 2_000),
+    "100k": (100_000, 2_000_000, 20_000),
+    "1m": (1_000_000, 10_000_000, 100_000),
+}
+GENRES = ["Pop", "Rock", "Jazz", "Electronic", "Ambient", "Hip Hop", "Classical", "Folk", "Metal", "Soul"]
+WORDS = [
+    "night", "electric", "dream", "river", "golden", "echo", "city", "fire", "summer", "ghost",
+    "velvet", "neon", "ocean", "shadow", "wild", "silver", "heart", "storm", "midnight", "paper",
+]
+SEED_BATCH_SIZE = 10_000
+PLAY_DAYS = 7
+PLAYLIST_SONGS = 50
+PASSWORD = "benchmark-password"
+
+# ``route`` is the path template, to report routes left without a scenario
+Scenario = namedtuple("Scenario", "route method make expect requests", defaults=((200,), None))
+
+
+class Workload:
+    """The seeded data requests are drawn from."""
+
+    def __init__(self, seed, songs, users, playlists):
+        self.rng = random.Random(seed)
+        self.songs = songs
+        self.users = users
+        self.playlists = playlists
+        self.email = None
+        self.access_token = None
+        self.logout_tokens = []
+        self.counter = 0
+
+    def song(self):
+        # Skewed towards the head of the catalog, like real listening
+        return self.songs[int(len(self.songs) * self.rng.random() ** 3)]
+
+    def user(self):
+        return self.rng.choice(self.users)
+
+    def playlist(self):
+        return self.rng.choice(self.playlists)
+
+    def unique(self):
+        self.counter += 1
+        return self.counter
+
+
+def make_uuid(rng):
+    return str(uuid.UUID(int=rng.getrandbits(128), version=4))
+
+
+def song_document(rng, index, release_date):
+    words = rng.sample(WORDS, 2)
+    return {
+        "id": make_uuid(rng),
+        "title": f"{words[0].title()} {words[1].title()} {index}",
+        "artist": f"Artist {index % 5000} {rng.choice(WORDS).title()}",
+        "album": f"Album {index % 20000}",
+        "duration": rng.randint(90, 420),
+        "genre": rng.choice(GENRES),
+        "audio_url": f"https://cdn.example.com/audio/{index}.mp3",
+        "cover_art": f"https://cdn.example.com/covers/{index % 20000}.jpg",
+        "release_date": release_date,
+        "media_path": None,
+        "content_hash": None,
+    }
+
+
+def new_song(workload):
+    index = workload.unique()
+    document = song_document(workload.rng, index, None)
+    return {field: document[field] for field in ("title", "artist", "album", "duration", "genre", "audio_url", "cover_art")}
+
+
+SCENARIOS = [
+    Scenario("/api/songs", "GET", lambda w: {"params": {"limit": 100}}),
+    Scenario("/api/songs/search", "GET", lambda w: {"params": {"q": w.rng.choice(WORDS)}}),
+    Scenario("/api/songs/{song_id}", "GET", lambda w: {"url": f"/api/songs/{w.song()}"}),
+    Scenario("/api/artists", "GET", lambda w: {"params": {"limit": 100}}),
+    Scenario("/api/albums", "GET", lambda w: {"params": {"limit": 100}}),
+    Scenario("/api/genres", "GET", lambda w: {}),
+    Scenario("/api/cache/stats", "GET", lambda w: {}),
+    Scenario("/api/playlists", "GET", lambda w: {"params": {"user_id": w.user()}}),
+    Scenario("/api/playlists/{playlist_id}", "GET", lambda w: {"url": f"/api/playlists/{w.playlist()}"}),
+    Scenario("/api/playlists/{playlist_id}/songs", "GET", lambda w: {"url": f"/api/playlists/{w.playlist()}/songs"}),
+    Scenario("/api/play-history/{user_id}", "GET", lambda w: {"url": f"/api/play-history/{w.user()}"}),
+    Scenario("/api/play-history/{user_id}/daily", "GET", lambda w: {"url": f"/api/play-history/{w.user()}/daily"}),
+    Scenario("/api/songs/{song_id}/daily-plays", "GET", lambda w: {"url": f"/api/songs/{w.song()}/daily-plays"}),
+    Scenario("/api/recommendations/{user_id}", "GET", lambda w: {"url": f"/api/recommendations/{w.user()}"}),
+    Scenario("/api/charts/{dimension}", "GET", lambda w: {
+        "url": f"/api/charts/{w.rng.choice(['songs', 'artists', 'genres'])}",
+        "params": {"window": w.rng.choice(["1h", "24h", "7d"])},
+    }),
+    Scenario("/api/auth/me", "GET", lambda w: {"headers": {"Authorization": f"Bearer {w.access_token}"}}),
+    Scenario("/api/metrics", "GET", lambda w: {}),
+    Scenario("/api/health/live", "GET", lambda w: {}),
+    Scenario("/api/health/ready", "GET", lambda w: {}),
+    Scenario("/api/play-history", "POST", lambda w: {"params": {"user_id": w.user(), "song_id": w.song()}}),
+    Scenario("/api/songs", "POST", lambda w: {"json": new_song(w)}),
+    Scenario("/api/songs/import", "POST", lambda w: {
+        "content": "\n".join(json.dumps(new_song(w)) for _ in range(100)),
+        "headers": {"Content-Type": "application/x-ndjson"},
+    }, requests=50),
+    Scenario("/api/playlists", "POST", lambda w: {
+        "json": {"name": f"Bench {w.unique()}", "description": "", "user_id": w.user()},
+    }),
+    Scenario("/api/playlists/{playlist_id}/songs/{song_id}", "PUT",
+             lambda w: {"url": f"/api/playlists/{w.playlist()}/songs/{w.song()}"}),
+    Scenario("/api/playlists/{playlist_id}/songs/{song_id}", "DELETE",
+             lambda w: {"url": f"/api/playlists/{w.playlist()}/songs/{w.song()}"}),
+    # Concurrent batches on the same playlist may conflict
+    Scenario("/api/playlists/bulk", "POST", lambda w: {"json": {"operations": [
+        {"playlist_id": w.playlist(), "op": "add", "song_id": w.song()} for _ in range(20)
+    ]}}, expect=(200, 409)),
+    # bcrypt-bound, so fewer requests
+    Scenario("/api/auth/register", "POST", lambda w: {"json": {
+        "username": "bench", "email": f"bench-{w.unique()}@example.com", "password": PASSWORD,
+    }}, requests=40),
+    Scenario("/api/auth/login", "POST", lambda w: {"json": {"email": w.email, "password": PASSWORD}}, requests=40),
+    Scenario("/api/auth/logout", "POST",
+             lambda w: {"headers": {"Authorization": f"Bearer {w.logout_tokens.pop()}"}}, requests=200),
+]
+
+
+def load_server(storage, mongo_url, db_name):
+    """Import ``server`` against the benchmark database."""
+    os.environ["STORAGE_BACKEND"] = storage
+    os.environ["MONGO_URL"] = mongo_url
+    os.environ["DB_NAME"] = db_name
+    import server
+
+    return server
+
+
+async def seed(server, rng, songs, plays, users):
+    """Write the synthetic catalog, playlists and play history; returns the workload ids."""
+    storage = server.storage
+    await storage.ensure_indexes()
+    release = datetime(2020, 1, 1)
+    song_ids = []
+    summaries = None
+    for start in range(0, songs, SEED_BATCH_SIZE):
+        batch = [
+            song_document(rng, index, release + timedelta(minutes=index))
+            for index in range(start, min(start + SEED_BATCH_SIZE, songs))
+        ]
+        await storage.songs.insert_many(batch)
+        summaries = server.summarize(batch, summaries)
+        song_ids.extend(song["id"] for song in batch)
+    if summaries is not None:
+        await storage.songs.add_to_summaries(summaries)
+    user_ids = [make_uuid(rng) for _ in range(users)]
+
+    playlist_ids = []
+    now = datetime.utcnow()
+    for start in range(0, max(1, users // 10), SEED_BATCH_SIZE):
+        batch = [
+            {
+                "id": make_uuid(rng),
+                "name": f"Playlist {start + index}",
+                "description": "",
+                "user_id": rng.choice(user_ids),
+                "song_ids": rng.sample(song_ids, min(PLAYLIST_SONGS, songs)),
+                "cover_art": "",
+                "is_public": rng.random() < 0.5,
+                "created_at": now,
+                "revision": 0,
+            }
+            for index in range(min(SEED_BATCH_SIZE, max(1, users // 10) - start))
+        ]
+        for playlist in batch:
+            await storage.playlists.insert(playlist)
+        playlist_ids.extend(playlist["id"] for playlist in batch)
+
+    # Plays go through the same write path as the play buffer, so the daily
+    # rollups, recommendation model and charts are filled in too. Batches
+    # follow each other in time, as the buffer would write them
+    generator = np.random.default_rng(rng.getrandbits(32))
+    song_array = np.array(song_ids)
+    user_array = np.array(user_ids)
+    for start in range(0, plays, SEED_BATCH_SIZE):
+        count = min(SEED_BATCH_SIZE, plays - start)
+        song_index = (generator.random(count) ** 3 * songs).astype(np.int64)
+        user_index = (generator.random(count) ** 2 * users).astype(np.int64)
+        positions = start + np.sort(generator.random(count)) * count
+        ages = (1 - positions / plays) * PLAY_DAYS * 86400
+        batch = [
+            {
+                "id": make_uuid(rng),
+                "user_id": str(user_array[user]),
+                "song_id": str(song_array[song]),
+                "played_at": now - timedelta(seconds=float(age)),
+            }
+            for user, song, age in zip(user_index, song_index, ages)
+        ]
+        await server.write_plays(batch)
+    return song_ids, user_ids, playlist_ids
+
+
+@contextlib.asynccontextmanager
+async def serve(app, http, port, concurrency):
+    """Start the app and yield a client for it."""
+    if not http:
+        async with app.router.lifespan_context(app):
+            transport = httpx.ASGITransport(app=app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+                yield client
+        return
+
+    import uvicorn
+
+    uvicorn_server = uvicorn.Server(uvicorn.Config(
+        app, host="127.0.0.1", port=port, log_level="warning", timeout_keep_alive=60
+    ))
+    task = asyncio.create_task(uvicorn_server.serve())
+    while not uvicorn_server.started:
+        if task.done():
+            task.result()
+        await asyncio.sleep(0.05)
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    try:
+        async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}", limits=limits, timeout=None) as client:
+            yield client
+    finally:
+        uvicorn_server.should_exit = True
+        await task
+
+
+async def wait_until_ready(server, timeout=1800):
+    deadline = time.monotonic() + timeout
+    while not (server.search_index.ready and server.recommender.ready):
+        if time.monotonic() > deadline:
+            raise SystemExit("Search index or recommendations not built in time")
+        await asyncio.sleep(0.1)
+
+
+def percentile(ordered, fraction):
+    return ordered[max(0, math.ceil(fraction * len(ordered)) - 1)]
+
+
+async def run_scenario(client, scenario, workload, requests, concurrency, warmup):
+    async def send():
+        request = scenario.make(workload)
+        url = request.pop("url", scenario.route)
+        started = time.perf_counter()
+        try:
+            status = (await client.request(scenario.method, url, **request)).status_code
+        except httpx.TransportError as error:
+            status = type(error).__name__
+        return time.perf_counter() - started, status
+
+    for _ in range(min(warmup, requests)):
+        await send()
+    timings = []
+    statuses = {}
+    remaining = requests
+
+    async def worker():
+        nonlocal remaining
+        while remaining > 0:
+            remaining -= 1
+            elapsed, status = await send()
+            timings.append(elapsed)
+            statuses[status] = statuses.get(status, 0) + 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    wall = time.perf_counter() - started
+    timings.sort()
+    return {
+        "requests": len(timings),
+        "errors": sum(count for status, count in statuses.items() if status not in scenario.expect),
+        "statuses": {str(status): count for status, count in sorted(statuses.items(), key=str)},
+        "rps": len(timings) / wall,
+        "p50_ms": percentile(timings, 0.50) * 1000,
+        "p95_ms": percentile(timings, 0.95) * 1000,
+        "p99_ms": percentile(timings, 0.99) * 1000,
+    }
+
+
+def uncovered_routes(app):
+    covered = {(scenario.method, scenario.route) for scenario in SCENARIOS}
+    return sorted(
+        f"{method} {route.path}"
+        for route in app.routes
+        if route.path.startswith("/api/")
+        for method in getattr(route, "methods", ())
+        if (method, route.path) not in covered
+    )
+
+
+def compare(results, baseline, tolerance):
+    """Print how each route moved against ``baseline``; returns the regressions."""
+    keys = ("songs", "plays", "users", "concurrency", "transport", "storage", "play_history_storage")
+    changed = [key for key in keys if results["meta"].get(key) != baseline["meta"].get(key)]
+    if changed:
+        print(f"warning: baseline differs in {', '.join(changed)}; the comparison may not be meaningful")
+    regressions = []
+    print(f"\n{'route':<58} {'rps':>16} {'p95 ms':>20}")
+    for name, current in results["routes"].items():
+        previous = baseline["routes"].get(name)
+        if previous is None:
+            continue
+        rps_change = current["rps"] / previous["rps"] - 1
+        p95_change = current["p95_ms"] / previous["p95_ms"] - 1 if previous["p95_ms"] else 0.0
+        worse = rps_change < -tolerance or p95_change > tolerance
+        if worse:
+            regressions.append(name)
+        print(f"{name:<58} {current['rps']:9.1f} {rps_change:+6.1%} {current['p95_ms']:12.2f} {p95_change:+6.1%}"
+              f"{'  REGRESSED' if worse else ''}")
+    return regressions
+
+
+async def main(args):
+    songs, plays, users = CATALOGS[args.catalog]
+    songs, plays, users = args.songs or songs, args.plays if args.plays is not None else plays, args.users or users
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    db_name = f"bench_{uuid.uuid4().hex[:12]}"
+    server = load_server(args.storage, args.mongo_url, db_name)
+    rng = random.Random(args.seed)
+    try:
+        started = time.perf_counter()
+        song_ids, user_ids, playlist_ids = await seed(server, rng, songs, plays, users)
+        print(f"Seeded {songs} songs, {len(playlist_ids)} playlists and {plays} plays by {users} users "
+              f"in {time.perf_counter() - started:.1f}s")
+        workload = Workload(args.seed, song_ids, user_ids, playlist_ids)
+        async with serve(server.app, args.http, args.port, args.concurrency) as client:
+            await wait_until_ready(server)
+            # The account the auth routes sign in as
+            workload.email = f"bench-{uuid.uuid4().hex}@example.com"
+            registered = await client.post(
+                "/api/auth/register", json={"username": "bench", "email": workload.email, "password": PASSWORD}
+            )
+            registered.raise_for_status()
+            account = registered.json()
+            workload.access_token = account["access_token"]
+            workload.logout_tokens = [
+                server.tokens.issue(account["id"], email=workload.email)[0]
+                for _ in range(args.requests + args.warmup)
+            ]
+
+            routes = {}
+            for scenario in SCENARIOS:
+                name = f"{scenario.method} {scenario.route}"
+                requests = min(args.requests, scenario.requests or args.requests)
+                routes[name] = await run_scenario(
+                    client, scenario, workload, requests, args.concurrency, args.warmup
+                )
+                result = routes[name]
+                print(f"{name:<58} {result['rps']:9.1f} req/s  p50 {result['p50_ms']:8.2f}  "
+                      f"p95 {result['p95_ms']:8.2f}  p99 {result['p99_ms']:8.2f} ms"
+                      f"{'  errors: ' + str(result['statuses']) if result['errors'] else ''}")
+    finally:
+        if args.storage == "mongo":
+            await server.storage.client.drop_database(db_name)
+        server.storage.close()
+
+    uncovered = uncovered_routes(server.app)
+    if uncovered:
+        # Upload and HLS routes need real audio files and ffmpeg
+        print(f"Not benchmarked: {', '.join(uncovered)}")
+    results = {
+        "meta": {
+            "catalog": args.catalog,
+            "songs": songs,
+            "plays": plays,
+            "users": users,
+            "seed": args.seed,
+            "concurrency": args.concurrency,
+            "requests": args.requests,
+            "transport": "http" if args.http else "asgi",
+            "storage": args.storage,
+            "play_history_storage": server.PLAY_HISTORY_STORAGE,
+            "python": platform.python_version(),
+            "started_at": datetime.utcnow().isoformat(),
+        },
+        "routes": routes,
+        "not_benchmarked": uncovered,
+    }
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(results, output, indent=2)
+        print(f"Results written to {args.output}")
+    if args.baseline:
+        with open(args.baseline) as baseline:
+            regressions = compare(results, json.load(baseline), args.tolerance)
+        if regressions:
+            print(f"\n{len(regressions)} route(s) regressed by more than {args.tolerance:.0%}")
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--catalog", choices=CATALOGS, default="10k", help="Preset data size")
+    parser.add_argument("--songs", type=int, help="Override the preset's song count")
+    parser.add_argument("--plays", type=int, help="Override the preset's play count")
+    parser.add_argument("--users", type=int, help="Override the preset's user count")
+    parser.add_argument("--requests", type=int, default=500, help="Requests per route")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--warmup", type=int, default=20, help="Unmeasured requests per route")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--storage", choices=["mongo", "memory"], default="mongo", help="Storage backend to run against")
+    parser.add_argument("--mongo-url", default="mongodb://localhost:27017", help="MongoDB to seed a throwaway database in")
+    parser.add_argument("--http", action="store_true", help="Serve through uvicorn instead of in-process ASGI")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--output", help="Write results as JSON")
+    parser.add_argument("--baseline", help="JSON results of an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.10, help="Allowed p95/throughput change")
+    sys.exit(asyncio.run(main(parser.parse_args())))
@@ -0,0 +1,80 @@
+"""Benchmark uncached search latency on a synthetic catalog.
+
+Indexes ``--songs`` songs whose titles, artists and albums draw words from a
+Zipf-skewed vocabulary (so terms like "the" and "love" have postings lists
+covering a large share of the catalog, as they do in real ones), then times
+each query with the result cache cleared. Prints the median and worst time
+per query. Run from the ``backend`` directory:
+
+    python -m benchmarks.search --songs 1000000
+"""
+import argparse
+import itertools
+import random
+import statistics
+import time
+
+from search_index import SearchIndex
+
+COMMON_WORDS = [
+    "the", "love", "night", "you", "me", "my", "heart", "dream", "baby", "time", "life", "world", "light",
+    "fire", "day", "home", "blue", "girl", "boy", "dance", "rain", "summer", "song", "road", "sky",
+]
+GENRES = ["Pop", "Rock", "Jazz", "Electronic", "Ambient", "Hip Hop", "Classical", "Folk", "Metal", "Soul"]
+QUERIES = ["love", "pop", "the night", "dream", "dreem", "the", "midnight rain", "electric 4217", "lo", "the ni"]
+
+
+def synthetic_songs(count, seed=0):
+    rng = random.Random(seed)
+    # The rest of the vocabulary: made-up words, rarer the further down the list
+    vocabulary = COMMON_WORDS + [
+        "".join(rng.choice("abcdefghijklmnopqrstuvwxyz") for _ in range(rng.randint(4, 9))) for _ in range(50_000)
+    ]
+    cum_weights = list(itertools.accumulate(1 / (rank + 1) for rank in range(len(vocabulary))))
+
+    def words(k):
+        return " ".join(rng.choices(vocabulary, cum_weights=cum_weights, k=k))
+
+    for index in range(count):
+        yield {
+            "id": f"{index:08d}",
+            "title": f"{words(rng.randint(1, 4))} {index}",
+            "artist": words(2),
+            "album": words(rng.randint(1, 3)),
+            "genre": rng.choice(GENRES),
+        }
+
+
+def main(songs, repeat):
+    index = SearchIndex()
+    started = time.perf_counter()
+    batch = []
+    for song in synthetic_songs(songs):
+        batch.append(song)
+        if len(batch) >= 10_000:
+            index.add_many(batch)
+            batch = []
+    index.add_many(batch)
+    indexed = time.perf_counter()
+    for term in index.unordered_terms():
+        index.order_by_impact(term)
+    print(f"Indexed {len(index)} songs in {indexed - started:.1f}s, "
+          f"ordered long postings lists in {time.perf_counter() - indexed:.1f}s\n")
+    print(f"{'query':<16} {'matches':>9} {'median ms':>10} {'max ms':>8}  top results")
+    for query in QUERIES:
+        timings = []
+        for _ in range(repeat):
+            index._results.clear()
+            started = time.perf_counter()
+            total, ranked = index.search(query, limit=20)
+            timings.append(time.perf_counter() - started)
+        print(f"{query:<16} {total:>9} {statistics.median(timings) * 1000:>10.1f} {max(timings) * 1000:>8.1f}  "
+              f"{', '.join(ranked[:3])}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--songs", type=int, default=200_000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+    main(args.songs, args.repeat)
@@ -0,0 +1,86 @@
+"""Benchmark the catalog serialization fast path.
+
+Serves ``GET /api/songs`` pages from a pre-filled catalog cache (so MongoDB is
+never touched) with ``FAST_SERIALIZATION`` off and on, checks both produce
+identical bytes, and reports the per-request time of each. Run from the
+``backend`` directory:
+
+    python -m benchmarks.serialization --songs 1000 --requests 200
+"""
+import argparse
+import asyncio
+import logging
+import random
+import statistics
+import time
+import uuid
+from datetime import datetime, timedelta
+
+import httpx
+
+import server
+
+
+def synthetic_songs(count):
+    start = datetime(2020, 1, 1)
+    songs = [
+        {
+            "id": str(uuid.uuid4()),
+            "title": f"Song {i}",
+            "artist": f"Artist {i % 500}",
+            "album": f"Album {i % 2000}",
+            "duration": random.randint(90, 420),
+            "genre": random.choice(["Pop", "Rock", "Jazz", "Electronic", "Ambient"]),
+            "audio_url": f"https://cdn.example.com/audio/{i}.mp3",
+            "cover_art": f"https://cdn.example.com/covers/{i % 2000}.jpg",
+            "release_date": start + timedelta(minutes=i),
+        }
+        for i in range(count)
+    ]
+    songs.sort(key=lambda song: song["id"])
+    return songs
+
+
+async def time_requests(client, url, requests):
+    timings = []
+    for _ in range(requests):
+        started = time.perf_counter()
+        response = await client.get(url)
+        timings.append(time.perf_counter() - started)
+        response.raise_for_status()
+    return timings, response.content
+
+
+async def main(songs, requests):
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    server.catalog_cache.max_songs = songs
+    server.catalog_cache.ttl = 3600
+    server.catalog_cache.set_listing(synthetic_songs(songs))
+    url = f"/api/songs?limit={min(songs, server.SONG_PAGE_SIZE)}"
+    transport = httpx.ASGITransport(app=server.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        results = {}
+        for fast in (False, True):
+            server.FAST_SERIALIZATION = fast
+            await time_requests(client, url, 10)  # warm up
+            results[fast] = await time_requests(client, url, requests)
+    server.storage.close()
+
+    if results[False][1] != results[True][1]:
+        raise SystemExit("Fast path output differs from the model path")
+    slow = statistics.median(results[False][0]) * 1000
+    fast = statistics.median(results[True][0]) * 1000
+    print(f"GET {url} x{requests}")
+    print(f"  pydantic + response_model: {slow:8.3f} ms/request (median)")
+    print(f"  orjson fast path:          {fast:8.3f} ms/request (median)")
+    print(f"  speedup:                   {slow / fast:8.2f}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--songs", type=int, default=1000)
+    parser.add_argument("--requests", type=int, default=200)
+    args = parser.parse_args()
+    if server.orjson is None:
+        raise SystemExit("orjson is required for the fast path")
+    asyncio.run(main(args.songs, args.requests))
@@ -0,0 +1,124 @@
+"""Write-through in-memory cache for song documents.
+
+``CatalogCache`` holds a bounded LRU of song documents keyed by ``id`` plus an
+optional snapshot of the whole catalog sorted by ``id`` (only kept while the
+catalog fits within the LRU bound). Entries expire after ``ttl`` seconds so
+writes made by other workers or external tools become visible without any
+cross-process invalidation.
+"""
+import bisect
+import time
+from collections import OrderedDict
+
+
+class CatalogCache:
+    def __init__(self, max_songs=10000, ttl=60.0, clock=time.monotonic):
+        self.max_songs = max_songs
+        self.ttl = ttl
+        self._clock = clock
+        self._songs = OrderedDict()  # id -> (expires_at, song)
+        self._listing = None         # (expires_at, [id, ...], [song, ...]) sorted by id
+        self._oversized_until = 0.0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, song_id):
+        entry = self._songs.get(song_id)
+        if entry is not None and entry[0] > self._clock():
+            self._songs.move_to_end(song_id)
+            self.hits += 1
+            return entry[1]
+        if entry is not None:
+            del self._songs[song_id]
+        self.misses += 1
+        return None
+
+    def get_many(self, song_ids):
+        """Return ``(found, missing)``: a dict of cached songs and a list of ids to fetch."""
+        found, missing = {}, []
+        for song_id in song_ids:
+            song = self.get(song_id)
+            if song is None:
+                missing.append(song_id)
+            else:
+                found[song_id] = song
+        return found, missing
+
+    def put(self, song):
+        self._songs[song["id"]] = (self._clock() + self.ttl, song)
+        self._songs.move_to_end(song["id"])
+        while len(self._songs) > self.max_songs:
+            self._songs.popitem(last=False)
+            self.evictions += 1
+
+    def put_many(self, songs):
+        for song in songs:
+            self.put(song)
+
+    def write_through(self, song):
+        """Record a song that was just written to the database."""
+        self.put(song)
+        if self._listing is None:
+            return
+        _, ids, songs = self._listing
+        if len(ids) >= self.max_songs:
+            self._listing = None
+            return
+        index = bisect.bisect_left(ids, song["id"])
+        if index < len(ids) and ids[index] == song["id"]:
+            songs[index] = song
+        else:
+            ids.insert(index, song["id"])
+            songs.insert(index, song)
+
+    def listing(self):
+        """The cached catalog sorted by id as ``(ids, songs)``, or None if it must be loaded."""
+        if self._listing is not None and self._listing[0] > self._clock():
+            self.hits += 1
+            return self._listing[1], self._listing[2]
+        self._listing = None
+        self.misses += 1
+        return None
+
+    def listing_oversized(self):
+        """True while a recent load found the catalog too large to snapshot."""
+        return self._oversized_until > self._clock()
+
+    def set_listing(self, songs):
+        """Snapshot the full catalog; ``songs`` must be sorted by id.
+
+        Returns ``(ids, songs)`` like ``listing()``, or None if the catalog is
+        too large to snapshot.
+        """
+        expires_at = self._clock() + self.ttl
+        if len(songs) > self.max_songs:
+            self._listing = None
+            self._oversized_until = expires_at
+            return None
+        self._listing = (expires_at, [song["id"] for song in songs], list(songs))
+        self.put_many(songs)
+        return self._listing[1], self._listing[2]
+
+    def invalidate_listing(self):
+        """Drop the catalog snapshot, e.g. after a bulk import."""
+        self._listing = None
+        self._oversized_until = 0.0
+
+    def invalidate(self):
+        self._songs.clear()
+        self._listing = None
+        self._oversized_until = 0.0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._songs),
+            "max_size": self.max_songs,
+            "ttl_seconds": self.ttl,
+            "listing_cached": self._listing is not None,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+        }
@@ -0,0 +1,348 @@
+"""Memory-mapped snapshot of the song catalog and its artist/album/genre summaries.
+
+A snapshot file holds one table per collection (``songs``, then each
+summary collection), each sorted by key and laid out for lookups straight
+from the mapping:
+
+    MAGIC
+    per table:  records | keys | record offsets | key offsets
+    footer (JSON) | footer offset (uint64) | footer length (uint32) | MAGIC
+
+Records are JSON documents and keys are their UTF-8 sort keys (the song id,
+or a summary's key fields joined by NUL), so byte order matches MongoDB's
+string order. Offsets are native ``uint64`` arrays with one extra entry
+marking the end of the last item. The footer records the catalog version
+the snapshot was taken at, the fields to decode as datetimes and where each
+table starts.
+
+``CatalogSnapshot`` maps a file read-only and answers the same catalog reads
+as the storage ``songs`` repository with a binary search over the keys,
+decoding only the documents it returns. Songs never change once stored, so
+lookups by id are valid from any snapshot; listings are only current while
+``version`` matches the catalog version. Files are replaced atomically and
+a mapping stays valid until its last reader lets go, so a newer snapshot
+can be swapped in under running requests.
+
+Write one from the command line (``server.py`` also re-exports it in the
+background when ``CATALOG_SNAPSHOT_PATH`` is set):
+
+    python catalog_snapshot.py catalog.snapshot
+    python catalog_snapshot.py catalog.snapshot --info
+"""
+import argparse
+import asyncio
+import json
+import mmap
+import os
+import shutil
+import struct
+import sys
+import tempfile
+from array import array
+from datetime import datetime
+from pathlib import Path
+
+from aggregates import SUMMARIES
+
+MAGIC = b"MSCATSN1"
+TRAILER = struct.Struct("<QI")
+EXPORT_BATCH_SIZE = 5000
+
+
+class SnapshotError(ValueError):
+    pass
+
+
+def summary_key(values):
+    """Sort key of a summary from its key field values, in ``SUMMARIES`` order."""
+    return "\x00".join(str(value) for value in values).encode()
+
+
+def _summary_values(collection, item):
+    return [item[summary_field] for summary_field, _ in SUMMARIES[collection]]
+
+
+def _encode(document, datetime_fields):
+    for field, value in document.items():
+        if isinstance(value, datetime):
+            datetime_fields.add(field)
+    return json.dumps(document, default=datetime.isoformat, separators=(",", ":")).encode()
+
+
+class SnapshotWriter:
+    """Write tables one at a time; keys must arrive in ascending order within a table."""
+
+    def __init__(self, file):
+        self._file = file
+        self._file.write(MAGIC)
+        self._tables = {}
+        self._datetime_fields = set()
+        self._table = None
+
+    def begin_table(self, name):
+        self._table = {
+            "name": name,
+            "records_at": self._file.tell(),
+            "record_offsets": array("Q", [0]),
+            "key_offsets": array("Q", [0]),
+            "keys": tempfile.TemporaryFile(),
+            "last_key": None,
+        }
+
+    def add_many(self, items):
+        """Append ``(key, document)`` pairs to the current table."""
+        table = self._table
+        record_offsets, key_offsets, keys = table["record_offsets"], table["key_offsets"], table["keys"]
+        for key, document in items:
+            if table["last_key"] is not None and key <= table["last_key"]:
+                raise SnapshotError(f"{table['name']} keys out of order at {key!r}")
+            table["last_key"] = key
+            record_offsets.append(record_offsets[-1] + self._file.write(_encode(document, self._datetime_fields)))
+            key_offsets.append(key_offsets[-1] + keys.write(key))
+
+    def end_table(self):
+        table, self._table = self._table, None
+        with table["keys"] as keys:
+            keys_at = self._file.tell()
+            keys.seek(0)
+            shutil.copyfileobj(keys, self._file)
+        # Offset arrays start 8-byte aligned so they can be read in place
+        self._file.write(b"\0" * (-self._file.tell() % 8))
+        record_offsets_at = self._file.tell()
+        table["record_offsets"].tofile(self._file)
+        key_offsets_at = self._file.tell()
+        table["key_offsets"].tofile(self._file)
+        self._tables[table["name"]] = {
+            "count": len(table["record_offsets"]) - 1,
+            "records": table["records_at"],
+            "keys": keys_at,
+            "record_offsets": record_offsets_at,
+            "key_offsets": key_offsets_at,
+        }
+
+    def finish(self, version):
+        footer = json.dumps({
+            "catalog_version": version,
+            "created_at": datetime.utcnow().isoformat(),
+            "byteorder": sys.byteorder,
+            "datetime_fields": sorted(self._datetime_fields),
+            "tables": self._tables,
+        }).encode()
+        footer_at = self._file.tell()
+        self._file.write(footer)
+        self._file.write(TRAILER.pack(footer_at, len(footer)))
+        self._file.write(MAGIC)
+
+
+class _Table:
+    def __init__(self, buffer, layout, decode):
+        self.count = layout["count"]
+        self._buffer = buffer
+        self._records = layout["records"]
+        self._keys = layout["keys"]
+        size = (self.count + 1) * 8
+        self._record_offsets = buffer[layout["record_offsets"]:layout["record_offsets"] + size].cast("Q")
+        self._key_offsets = buffer[layout["key_offsets"]:layout["key_offsets"] + size].cast("Q")
+        self._decode = decode
+
+    def key(self, index):
+        return bytes(self._buffer[self._keys + self._key_offsets[index]:self._keys + self._key_offsets[index + 1]])
+
+    def record(self, index):
+        start = self._records + self._record_offsets[index]
+        return self._decode(self._buffer[start:self._records + self._record_offsets[index + 1]])
+
+    def bisect_left(self, key):
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self.key(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def bisect_right(self, key):
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if key < self.key(middle):
+                high = middle
+            else:
+                low = middle + 1
+        return low
+
+    def find(self, key):
+        index = self.bisect_left(key)
+        if index < self.count and self.key(index) == key:
+            return index
+        return None
+
+
+def _project(song, fields):
+    if fields is None:
+        return song
+    return {"id": song["id"], **{field: song[field] for field in fields if field in song}}
+
+
+class CatalogSnapshot:
+    def __init__(self, path):
+        self.path = Path(path)
+        with open(self.path, "rb") as file:
+            self._stat = os.fstat(file.fileno())
+            try:
+                self._mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:  # empty file
+                raise SnapshotError(f"{path} is not a catalog snapshot")
+        buffer = memoryview(self._mmap)
+        if len(buffer) < len(MAGIC) * 2 + TRAILER.size or buffer[:len(MAGIC)] != MAGIC or buffer[-len(MAGIC):] != MAGIC:
+            raise SnapshotError(f"{path} is not a catalog snapshot")
+        footer_at, footer_length = TRAILER.unpack_from(buffer, len(buffer) - len(MAGIC) - TRAILER.size)
+        footer = json.loads(bytes(buffer[footer_at:footer_at + footer_length]))
+        if footer["byteorder"] != sys.byteorder:
+            raise SnapshotError(f"{path} was written on a {footer['byteorder']}-endian machine")
+        self.version = footer["catalog_version"]
+        self.created_at = footer["created_at"]
+        datetime_fields = footer["datetime_fields"]
+
+        def decode(data):
+            document = json.loads(bytes(data))
+            for field in datetime_fields:
+                if isinstance(document.get(field), str):
+                    document[field] = datetime.fromisoformat(document[field])
+            return document
+
+        self._tables = {name: _Table(buffer, layout, decode) for name, layout in footer["tables"].items()}
+        self._songs = self._tables["songs"]
+
+    def __len__(self):
+        return self._songs.count
+
+    def same_file(self, path):
+        """Whether ``path`` still names the file this snapshot was mapped from."""
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return False
+        return (stat.st_ino, stat.st_mtime_ns, stat.st_size) == (
+            self._stat.st_ino, self._stat.st_mtime_ns, self._stat.st_size
+        )
+
+    def stats(self):
+        return {"path": str(self.path), "version": self.version, "created_at": self.created_at, "songs": len(self)}
+
+    # Reads below mirror the storage ``songs`` repository
+
+    async def count(self):
+        return len(self)
+
+    async def find_page(self, after_id, limit):
+        songs = self._songs
+        start = songs.bisect_right(after_id.encode()) if after_id is not None else 0
+        return [songs.record(index) for index in range(start, min(start + limit, songs.count))]
+
+    async def iter_sorted(self, after_id=None, batch_size=500):
+        songs = self._songs
+        start = songs.bisect_right(after_id.encode()) if after_id is not None else 0
+        for batch_start in range(start, songs.count, batch_size):
+            for index in range(batch_start, min(batch_start + batch_size, songs.count)):
+                yield songs.record(index)
+            await asyncio.sleep(0)
+
+    async def iter_fields(self, fields, batch_size=5000):
+        async for song in self.iter_sorted(batch_size=batch_size):
+            yield _project(song, fields)
+
+    async def find_many(self, song_ids, fields=None):
+        found = []
+        for song_id in dict.fromkeys(song_ids):
+            index = self._songs.find(song_id.encode())
+            if index is not None:
+                found.append(_project(self._songs.record(index), fields))
+        return found
+
+    async def summaries_page(self, collection, after_key, limit):
+        table = self._tables[collection]
+        start = table.bisect_right(summary_key(after_key)) if after_key is not None else 0
+        return [table.record(index) for index in range(start, min(start + limit, table.count))]
+
+
+async def _song_items(songs):
+    async for song in songs.iter_sorted(batch_size=EXPORT_BATCH_SIZE):
+        yield song["id"].encode(), song
+
+
+async def _summary_items(songs, collection):
+    after_key = None
+    while True:
+        items = await songs.summaries_page(collection, after_key, EXPORT_BATCH_SIZE)
+        for item in items:
+            yield summary_key(_summary_values(collection, item)), item
+        if len(items) < EXPORT_BATCH_SIZE:
+            return
+        after_key = _summary_values(collection, items[-1])
+
+
+async def _write_table(writer, name, items):
+    writer.begin_table(name)
+    batch = []
+    async for item in items:
+        batch.append(item)
+        if len(batch) >= EXPORT_BATCH_SIZE:
+            # Encoding and writing block, so each batch goes to a thread
+            await asyncio.to_thread(writer.add_many, batch)
+            batch = []
+    await asyncio.to_thread(writer.add_many, batch)
+    writer.end_table()
+
+
+async def export_snapshot(storage, path):
+    """Write the catalog to ``path``, atomically replacing it; returns the catalog version written.
+
+    The version is read first, so songs added during the export at most make
+    the snapshot look older than it is.
+    """
+    path = Path(path)
+    version = (await storage.versions.load(["catalog"])).get("catalog", 0)
+    fd, temp_path = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.")
+    try:
+        with os.fdopen(fd, "wb") as file:
+            writer = SnapshotWriter(file)
+            await _write_table(writer, "songs", _song_items(storage.songs))
+            for collection in SUMMARIES:
+                await _write_table(writer, collection, _summary_items(storage.songs, collection))
+            writer.finish(version)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_path, path)
+    except BaseException:
+        Path(temp_path).unlink(missing_ok=True)
+        raise
+    return version
+
+
+async def _main(path, info):
+    if info:
+        snapshot = CatalogSnapshot(path)
+        print(json.dumps({
+            **snapshot.stats(),
+            "tables": {name: table.count for name, table in snapshot._tables.items()},
+        }, indent=2))
+        return 0
+    import server
+
+    try:
+        version = await export_snapshot(server.storage, path)
+    finally:
+        server.storage.close()
+    snapshot = CatalogSnapshot(path)
+    print(f"Wrote {len(snapshot)} songs at catalog version {version} to {path} ({path.stat().st_size} bytes)")
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export or inspect a catalog snapshot")
+    parser.add_argument("path", type=Path)
+    parser.add_argument("--info", action="store_true", help="Print the snapshot's version and table sizes")
+    args = parser.parse_args()
+    sys.exit(asyncio.run(_main(args.path, args.info)))
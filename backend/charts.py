@@ -0,0 +1,245 @@
+"""Trending charts from streaming count-min sketches.
+
+Every flushed batch of plays is counted per song, artist and genre in a
+sliding-window count-min sketch for each chart window. A window is a ring of
+``slots`` sub-sketches: when time moves into a new slot, the oldest one is
+subtracted from the running total and cleared, so a window reaches back to
+the start of its oldest live slot rather than exactly its nominal length.
+Next to each sketch a small set of heavy-hitter candidates holds the keys with
+the highest estimates, kept ranked, so reading a chart is a list slice.
+
+Counts are estimates: count-min never undercounts, and it overcounts by at
+most about ``e / width`` of the plays in the window. Sketches are checkpointed
+to the storage's ``chart_sketches`` repository so charts survive restarts; plays since
+the last checkpoint are lost on a crash.
+
+Each worker process only counts the plays it flushes. At a checkpoint it adds
+the plays counted since its last one to the saved sketches and takes the sum
+as its own counts, so every worker's charts cover all plays, lagging others'
+by up to a checkpoint interval. Checkpoints must not interleave; the caller
+holds a lock around them.
+"""
+import hashlib
+from datetime import datetime
+
+import numpy as np
+
+# window name -> (seconds, slots)
+WINDOWS = {"1h": (3600, 12), "24h": (86400, 24), "7d": (7 * 86400, 28)}
+DIMENSIONS = ("song", "artist", "genre")
+SKETCH_WIDTH = 2048
+SKETCH_DEPTH = 4
+CANDIDATES = 200
+
+EPOCH = datetime(1970, 1, 1)
+
+
+def timestamp(moment: datetime) -> float:
+    """Seconds since the epoch for a naive UTC datetime."""
+    return (moment - EPOCH).total_seconds()
+
+
+def sketch_columns(key, width=SKETCH_WIDTH, depth=SKETCH_DEPTH):
+    """The column of ``key`` in each sketch row (stable across processes)."""
+    digest = hashlib.blake2b(key.encode(), digest_size=8).digest()
+    first, second = int.from_bytes(digest[:4], "little"), int.from_bytes(digest[4:], "little") | 1
+    return [(first + row * second) % width for row in range(depth)]
+
+
+class WindowedSketch:
+    def __init__(self, window, slots, width=SKETCH_WIDTH, depth=SKETCH_DEPTH, capacity=CANDIDATES):
+        self.slot_seconds = window / slots
+        self.capacity = capacity
+        self._rows = np.arange(depth)
+        self._slots = np.zeros((slots, depth, width), np.int32)
+        self._unsaved = np.zeros((slots, depth, width), np.int32)  # counted here since the last merge
+        self._total = np.zeros((depth, width), np.int64)
+        self._slot = None  # absolute index of the newest slot
+        self._candidates = {}  # key -> (estimate, columns)
+        self._floor = None  # (estimate, key) of the weakest candidate once full
+        self._ranked = None
+
+    def _estimate(self, columns):
+        return int(self._total[self._rows, columns].min())
+
+    def advance(self, now):
+        """Expire slots that have left the window as of ``now`` (seconds)."""
+        slot = int(now // self.slot_seconds)
+        if self._slot is None:
+            self._slot = slot
+        if slot <= self._slot:
+            return
+        n_slots = len(self._slots)
+        for expired in range(max(self._slot + 1, slot - n_slots + 1), slot + 1):
+            ring = self._slots[expired % n_slots]
+            self._total -= ring
+            ring[:] = 0
+            self._unsaved[expired % n_slots] = 0
+        self._slot = slot
+        self._candidates = {
+            key: (estimate, columns)
+            for key, (_, columns) in self._candidates.items()
+            if (estimate := self._estimate(columns)) > 0
+        }
+        self._floor = None
+        self._ranked = None
+
+    def add(self, keys, columns, times):
+        """Count one play of ``keys[i]`` (with ``columns[i]``) at ``times[i]`` seconds."""
+        self.advance(max(times))
+        n_slots = len(self._slots)
+        oldest = self._slot - n_slots + 1
+        slots = (np.asarray(times) // self.slot_seconds).astype(np.int64)
+        live = slots >= oldest
+        if not live.any():
+            return
+        columns = np.asarray(columns)[live]
+        rings = np.repeat(slots[live] % n_slots, len(self._rows))
+        rows = np.tile(self._rows, len(columns))
+        np.add.at(self._slots, (rings, rows, columns.ravel()), 1)
+        np.add.at(self._unsaved, (rings, rows, columns.ravel()), 1)
+        np.add.at(self._total, (rows, columns.ravel()), 1)
+
+        seen = {}
+        for key, key_columns in zip((key for key, keep in zip(keys, live) if keep), columns):
+            seen.setdefault(key, key_columns)
+        for key, key_columns in seen.items():
+            self._offer(key, key_columns, self._estimate(key_columns))
+        self._ranked = None
+
+    def _offer(self, key, columns, estimate):
+        if key in self._candidates or len(self._candidates) < self.capacity:
+            self._candidates[key] = (estimate, columns)
+            if self._floor is not None and key == self._floor[1]:
+                self._floor = None
+            return
+        if self._floor is None:
+            self._floor = min((value[0], candidate) for candidate, value in self._candidates.items())
+        if estimate > self._floor[0]:
+            del self._candidates[self._floor[1]]
+            self._candidates[key] = (estimate, columns)
+            self._floor = None
+
+    def top(self, limit, now):
+        """``[(key, estimated plays), ...]`` for the window ending at ``now``, highest first."""
+        self.advance(now)
+        if self._ranked is None:
+            self._ranked = sorted(
+                ((key, estimate) for key, (estimate, _) in self._candidates.items()),
+                key=lambda item: (-item[1], item[0]),
+            )
+        return self._ranked[:limit]
+
+    def state(self):
+        return {
+            "slot": self._slot,
+            "counts": self._slots.tobytes(),
+            "candidates": list(self._candidates),
+        }
+
+    def merge(self, state, columns_of):
+        """Replace the counts with a saved ``state`` plus the plays counted here since the last merge.
+
+        ``state`` is None when nothing was saved yet. Returns the state to save back.
+        """
+        saved = WindowedSketch(
+            self.slot_seconds * len(self._slots), len(self._slots), self._total.shape[1], len(self._rows), self.capacity
+        )
+        if state is not None and saved.restore(state, columns_of) and saved._slot is not None:
+            # Line both rings up on the newer slot (another worker may have moved on already)
+            newest = max(saved._slot, saved._slot if self._slot is None else self._slot)
+            saved.advance((newest + 0.5) * self.slot_seconds)
+            self.advance((newest + 0.5) * self.slot_seconds)
+            self._slots = saved._slots + self._unsaved
+            self._total = self._slots.sum(axis=0, dtype=np.int64)
+            candidates = {**saved._candidates, **self._candidates}
+            self._candidates = {}
+            self._floor = None
+            for key, (_, columns) in candidates.items():
+                estimate = self._estimate(columns)
+                if estimate > 0:
+                    self._offer(key, columns, estimate)
+            self._ranked = None
+        self._unsaved[:] = 0
+        return self.state()
+
+    def restore(self, state, columns_of):
+        if self._slots.nbytes != len(state["counts"]):
+            return False
+        self._slots = np.frombuffer(state["counts"], np.int32).reshape(self._slots.shape).copy()
+        self._total = self._slots.sum(axis=0, dtype=np.int64)
+        self._slot = state["slot"]
+        self._candidates = {}
+        for key in state["candidates"]:
+            columns = np.asarray(columns_of(key))
+            self._candidates[key] = (self._estimate(columns), columns)
+        self._floor = None
+        self._ranked = None
+        return True
+
+
+class TrendingCharts:
+    def __init__(self, windows=WINDOWS, width=SKETCH_WIDTH, depth=SKETCH_DEPTH, capacity=CANDIDATES):
+        self.width = width
+        self.depth = depth
+        self.sketches = {
+            (dimension, window): WindowedSketch(seconds, slots, width, depth, capacity)
+            for dimension in DIMENSIONS
+            for window, (seconds, slots) in windows.items()
+        }
+        self._columns = {}
+
+    def _columns_of(self, key):
+        columns = self._columns.get(key)
+        if columns is None:
+            if len(self._columns) >= 100_000:
+                self._columns.clear()
+            columns = self._columns[key] = sketch_columns(key, self.width, self.depth)
+        return columns
+
+    def add(self, plays):
+        """Count plays given as ``(played_at, {dimension: key})``."""
+        if not plays:
+            return
+        times = [timestamp(played_at) for played_at, _ in plays]
+        for dimension in DIMENSIONS:
+            keys = [play_keys[dimension] for _, play_keys in plays]
+            columns = np.array([self._columns_of(key) for key in keys], dtype=np.int64)
+            for (sketch_dimension, _), sketch in self.sketches.items():
+                if sketch_dimension == dimension:
+                    sketch.add(keys, columns, times)
+
+    def top(self, dimension, window, limit, now=None):
+        now = timestamp(now or datetime.utcnow())
+        return self.sketches[dimension, window].top(limit, now)
+
+    def _compatible(self, state):
+        return (state.get("width"), state.get("depth")) == (self.width, self.depth)
+
+    async def checkpoint(self, store):
+        """Add the plays counted since the last checkpoint to the saved sketches, and adopt the sums."""
+        saved = {key: state for key, state in await store.load_all() if self._compatible(state)}
+        saved_at = datetime.utcnow()
+        # Merged without awaiting in between, so no plays are counted after a
+        # sketch's state is taken but before its unsaved counts are reset
+        states = {
+            f"{dimension}:{window}": {
+                **sketch.merge(saved.get(f"{dimension}:{window}"), self._columns_of),
+                "width": self.width, "depth": self.depth, "saved_at": saved_at,
+            }
+            for (dimension, window), sketch in self.sketches.items()
+        }
+        for key, state in states.items():
+            await store.save(key, state)
+
+    async def restore(self, store):
+        """Load the last checkpoint; returns how many sketches were restored."""
+        restored = 0
+        for key, state in await store.load_all():
+            dimension, _, window = key.partition(":")
+            sketch = self.sketches.get((dimension, window))
+            if sketch is None or not self._compatible(state):
+                continue
+            if sketch.restore(state, self._columns_of):
+                restored += 1
+        return restored
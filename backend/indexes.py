@@ -0,0 +1,197 @@
+"""MongoDB index registry and query-plan audit.
+
+Every index the API relies on is declared in ``INDEXES`` and created from the
+startup hook in ``server.py``. ``QUERY_SHAPES`` mirrors the filters and sorts
+issued by the request handlers and background tasks so the audit command can
+``explain()`` each one and fail when a query would fall back to a collection
+scan:
+
+    python indexes.py ensure
+    python indexes.py audit
+"""
+import argparse
+import asyncio
+import logging
+import os
+import sys
+from pathlib import Path
+
+from bson import ObjectId
+from pymongo import ASCENDING, DESCENDING, IndexModel
+
+logger = logging.getLogger(__name__)
+
+INDEXES = {
+    "songs": [
+        IndexModel([("id", ASCENDING)], unique=True, name="songs_id_unique"),
+        IndexModel(
+            [("content_hash", ASCENDING)],
+            unique=True,
+            partialFilterExpression={"content_hash": {"$type": "string"}},
+            name="songs_content_hash_unique",
+        ),
+    ],
+    "playlists": [
+        IndexModel([("id", ASCENDING)], unique=True, name="playlists_id_unique"),
+        IndexModel([("user_id", ASCENDING)], name="playlists_user_id"),
+        IndexModel([("is_public", ASCENDING)], name="playlists_is_public"),
+    ],
+    "users": [
+        IndexModel([("email", ASCENDING)], unique=True, name="users_email_unique"),
+        IndexModel([("id", ASCENDING)], unique=True, name="users_id_unique"),
+    ],
+    "artists": [
+        IndexModel([("name", ASCENDING)], unique=True, name="artists_name_unique"),
+    ],
+    "albums": [
+        IndexModel([("name", ASCENDING), ("artist", ASCENDING)], unique=True, name="albums_name_artist_unique"),
+    ],
+    "genres": [
+        IndexModel([("name", ASCENDING)], unique=True, name="genres_name_unique"),
+    ],
+    "play_history": [
+        # Retried batches skip the plays an earlier attempt wrote
+        IndexModel([("id", ASCENDING)], unique=True, name="play_history_id_unique"),
+        IndexModel(
+            [("user_id", ASCENDING), ("played_at", DESCENDING)],
+            name="play_history_user_played_at",
+        ),
+        # The recommendation rebuild scans a time window across all users
+        IndexModel([("played_at", ASCENDING)], name="play_history_played_at"),
+    ],
+    "play_history_buckets": [
+        IndexModel([("user_id", ASCENDING), ("bucket", DESCENDING)], name="play_history_buckets_user_bucket"),
+        IndexModel([("bucket", ASCENDING)], name="play_history_buckets_bucket"),
+    ],
+    "song_daily_plays": [
+        IndexModel([("song_id", ASCENDING), ("day", ASCENDING)], unique=True, name="song_daily_plays_song_day"),
+    ],
+    "user_daily_plays": [
+        IndexModel([("user_id", ASCENDING), ("day", ASCENDING)], unique=True, name="user_daily_plays_user_day"),
+    ],
+    "revoked_tokens": [
+        # Revocations are dropped once the token would have expired anyway
+        IndexModel([("expires_at", ASCENDING)], expireAfterSeconds=0, name="revoked_tokens_expires_at_ttl"),
+        IndexModel([("revoked_at", ASCENDING)], name="revoked_tokens_revoked_at"),
+    ],
+    # GridFS indexes files by (filename, uploadDate); workers look up the newest model by date alone
+    "recommendation_models.files": [
+        IndexModel([("uploadDate", DESCENDING)], name="recommendation_models_upload_date"),
+    ],
+}
+
+# (handler, collection, filter, sort) for every query a handler or background
+# task issues that is expected to be served from an index. The deliberate full
+# scans are left out: building the search index and summaries over every song,
+# the regex search fallback, and loading the handful of chart sketches.
+QUERY_SHAPES = [
+    ("get_songs", "songs", {"id": {"$gt": "x"}}, [("id", ASCENDING)]),
+    ("get_song", "songs", {"id": "x"}, None),
+    ("get_playlist_songs", "songs", {"id": {"$in": ["x", "y"]}}, None),
+    ("upload_song", "songs", {"content_hash": "x"}, None),
+    ("register", "users", {"email": "x"}, None),
+    ("login", "users", {"email": "x"}, None),
+    ("get_playlists", "playlists", {"user_id": "x"}, None),
+    ("get_playlists", "playlists", {"is_public": True}, None),
+    ("get_playlist", "playlists", {"id": "x"}, None),
+    ("get_playlist_songs", "playlists", {"id": "x"}, None),
+    ("add_song_to_playlist", "playlists", {"id": "x"}, None),
+    ("remove_song_from_playlist", "playlists", {"id": "x"}, None),
+    ("get_play_history", "play_history", {"user_id": "x"}, [("played_at", DESCENDING)]),
+    ("get_play_history", "play_history_buckets", {"user_id": "x"}, [("bucket", DESCENDING)]),
+    ("rebuild_recommendations", "play_history", {"played_at": {"$gte": 0, "$lt": 1}}, None),
+    ("rebuild_recommendations", "play_history_buckets", {"bucket": {"$gte": 0, "$lt": 1}}, None),
+    ("get_user_daily_plays", "user_daily_plays", {"user_id": "x", "day": {"$gte": 0}}, [("day", ASCENDING)]),
+    ("get_song_daily_plays", "song_daily_plays", {"song_id": "x", "day": {"$gte": 0}}, [("day", ASCENDING)]),
+    ("get_artists", "artists", {"name": {"$gt": "x"}}, [("name", ASCENDING)]),
+    ("get_albums", "albums", {"$or": [{"name": {"$gt": "x"}}, {"name": "x", "artist": {"$gt": "y"}}]},
+     [("name", ASCENDING), ("artist", ASCENDING)]),
+    ("get_genres", "genres", {"name": {"$gt": "x"}}, [("name", ASCENDING)]),
+    ("refresh_revocations", "revoked_tokens", {"expires_at": {"$gt": 0}}, None),
+    ("refresh_revocations", "revoked_tokens", {"revoked_at": {"$gte": 0}}, None),
+    ("logout", "revoked_tokens", {"_id": "x"}, None),
+    ("login", "users", {"id": "x"}, None),
+    ("refresh_search_index", "songs", {"_id": {"$gte": ObjectId("0" * 24)}}, None),
+    ("bulk_update_playlists", "playlists", {"id": {"$in": ["x", "y"]}}, None),
+    ("bulk_update_playlists", "playlists", {"id": {"$in": ["x", "y"]}, "applied_writes": "w"}, None),
+    ("bulk_update_playlists", "playlists", {"id": "x", "revision": 1, "applied_writes": "w"}, None),
+    ("write_plays", "play_history_buckets",
+     {"user_id": "x", "bucket": 0, "count": {"$lte": 1}, "applied.w": {"$ne": 1}}, None),
+    ("write_plays", "play_history_buckets",
+     {"user_id": {"$in": ["x", "y"]}, "bucket": {"$in": [0, 1]}, "applied.w": 1}, None),
+    ("write_plays", "song_daily_plays", {"song_id": "x", "day": 0, "applied.w": {"$ne": 1}}, None),
+    ("write_plays", "user_daily_plays", {"user_id": "x", "day": 0, "applied.w": {"$ne": 1}}, None),
+    ("content_versions", "versions", {"_id": {"$in": ["catalog", "playlists"]}}, None),
+    ("content_versions", "versions", {"_id": "playlists"}, None),
+    ("leader_lock", "locks", {"_id": "x", "$or": [{"expires_at": {"$lte": 0}}, {"owner": "y"}]}, None),
+    ("leader_lock", "locks", {"_id": "x", "owner": "y"}, None),
+    ("save_charts", "chart_sketches", {"_id": "x"}, None),
+    ("update_recommendations", "recommendation_models.files", {}, [("uploadDate", DESCENDING)]),
+]
+
+
+async def ensure_indexes(db):
+    """Create every registered index. Existing indexes are left untouched."""
+    for collection, models in INDEXES.items():
+        names = await db[collection].create_indexes(models)
+        logger.info("Ensured indexes on %s: %s", collection, ", ".join(names))
+
+
+def _plan_stages(plan):
+    """Yield every stage name in an explain() plan tree."""
+    if isinstance(plan, dict):
+        if "stage" in plan:
+            yield plan["stage"]
+        for value in plan.values():
+            yield from _plan_stages(value)
+    elif isinstance(plan, list):
+        for item in plan:
+            yield from _plan_stages(item)
+
+
+async def audit_query_plans(db):
+    """Explain every registered query shape.
+
+    Returns a list of ``(handler, collection, filter, stages)`` tuples for the
+    shapes whose winning plan contains a COLLSCAN.
+    """
+    failures = []
+    for handler, collection, query, sort in QUERY_SHAPES:
+        command = {"find": collection, "filter": query}
+        if sort:
+            command["sort"] = dict(sort)
+        explained = await db.command("explain", command, verbosity="queryPlanner")
+        winning_plan = explained["queryPlanner"]["winningPlan"]
+        stages = list(_plan_stages(winning_plan))
+        status = "COLLSCAN" if "COLLSCAN" in stages else "ok"
+        logger.info("%-28s %-14s %s [%s]", handler, collection, status, " > ".join(stages))
+        if status == "COLLSCAN":
+            failures.append((handler, collection, query, stages))
+    return failures
+
+
+async def _main(command):
+    from dotenv import load_dotenv
+    from motor.motor_asyncio import AsyncIOMotorClient
+
+    load_dotenv(Path(__file__).parent / '.env')
+    client = AsyncIOMotorClient(os.environ['MONGO_URL'])
+    db = client[os.environ['DB_NAME']]
+    try:
+        if command == "ensure":
+            await ensure_indexes(db)
+            return 0
+        failures = await audit_query_plans(db)
+        for handler, collection, query, stages in failures:
+            logger.error("%s: COLLSCAN on %s for %s", handler, collection, query)
+        return 1 if failures else 0
+    finally:
+        client.close()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("command", choices=["ensure", "audit"])
+    args = parser.parse_args()
+    sys.exit(asyncio.run(_main(args.command)))
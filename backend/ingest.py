@@ -0,0 +1,198 @@
+"""Streaming bulk import of NDJSON or CSV song feeds.
+
+Feeds are parsed incrementally from a stream of byte chunks, validated row by
+row and inserted in batches, where a duplicate only fails its own row.
+Artist/album/genre summaries are folded per batch and written with it, so an
+import that fails part way leaves them matching the songs it inserted.
+Rows that fail to parse, validate or insert are listed in the returned report
+(up to ``MAX_REPORTED_ERRORS``).
+
+The same pipeline is available from the command line:
+
+    python ingest.py feed.ndjson
+    python ingest.py feed.csv --batch-size 5000
+"""
+import argparse
+import asyncio
+import codecs
+import csv
+import json
+from collections import deque
+from pathlib import Path
+
+from pydantic import ValidationError
+
+from aggregates import summarize
+
+IMPORT_BATCH_SIZE = 1000
+MAX_REPORTED_ERRORS = 1000
+READ_CHUNK_SIZE = 1024 * 1024
+# Longest CSV record whose quoted fields span lines before the opening quote is taken for a stray one
+MAX_RECORD_LENGTH = 64 * 1024
+
+
+async def _iter_lines(chunks):
+    decoder = codecs.getincrementaldecoder("utf-8-sig")()
+    pending = ""
+    async for chunk in chunks:
+        pending += decoder.decode(chunk)
+        *lines, pending = pending.split("\n")
+        for line in lines:
+            yield line
+    pending += decoder.decode(b"", final=True)
+    if pending:
+        yield pending
+
+
+async def _iter_ndjson(chunks):
+    row_number = 0
+    async for line in _iter_lines(chunks):
+        row_number += 1
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError as exc:
+            yield row_number, None, f"Invalid JSON: {exc}"
+            continue
+        if not isinstance(row, dict):
+            yield row_number, None, "Expected a JSON object"
+            continue
+        yield row_number, row, None
+
+
+async def _iter_csv(chunks):
+    header = None
+    row_number = 0
+    record, length, quoted = [], 0, False
+    replay = deque()  # lines to parse again after giving up on a record
+    lines = _iter_lines(chunks)
+    while True:
+        if replay:
+            line = replay.popleft()
+        else:
+            try:
+                line = await anext(lines)
+            except StopAsyncIteration:
+                if not record:
+                    return
+                line = None
+        if line is not None:
+            record.append(line)
+            length += len(line) + 1
+            # A quoted field can span lines; the record is complete once quotes balance
+            if line.count('"') % 2:
+                quoted = not quoted
+            if quoted and length <= MAX_RECORD_LENGTH:
+                continue
+        if not quoted:
+            row_number += 1
+            values = next(csv.reader(["\n".join(record).rstrip("\r")]), [])
+            record, length = [], 0
+            if header is None:
+                header = [name.strip() for name in values]
+            elif values and len(values) != len(header):
+                yield row_number, None, f"Expected {len(header)} columns, got {len(values)}"
+            elif values:
+                yield row_number, dict(zip(header, values)), None
+            continue
+        row_number += 1
+        if line is None:
+            yield row_number, None, "Unterminated quoted field"
+        else:
+            yield row_number, None, f"Quoted field not closed within {MAX_RECORD_LENGTH} characters"
+        # Likely a stray quote: parse again from the next line
+        replay.extendleft(reversed(record[1:]))
+        record, length, quoted = [], 0, False
+
+
+def iter_records(chunks, feed_format):
+    """Yield ``(row_number, row_dict, error)`` from an async iterable of byte chunks."""
+    return _iter_csv(chunks) if feed_format == "csv" else _iter_ndjson(chunks)
+
+
+def _record_error(report, row_number, error):
+    report["failed"] += 1
+    if len(report["errors"]) < MAX_REPORTED_ERRORS:
+        report["errors"].append({"row": row_number, "error": error})
+
+
+def new_report():
+    return {"received": 0, "inserted": 0, "failed": 0, "errors": []}
+
+
+async def import_songs(songs, records, build_song, on_batch=None, batch_size=IMPORT_BATCH_SIZE, report=None):
+    """Validate and insert songs from ``iter_records`` output into the ``songs`` repository.
+
+    ``build_song(row)`` returns the document to insert or raises
+    ``ValidationError``; ``on_batch(songs)`` is called with each batch of
+    inserted songs. Pass ``report`` (from ``new_report``) to see what was
+    inserted even if the import raises part way; it is also returned.
+    """
+    report = new_report() if report is None else report
+    batch, batch_rows = [], []
+
+    async def flush():
+        failed = await songs.insert_many(batch)
+        inserted = [song for index, song in enumerate(batch) if index not in failed]
+        for index, message in sorted(failed.items()):
+            _record_error(report, batch_rows[index], message)
+        report["inserted"] += len(inserted)
+        if inserted:
+            await songs.add_to_summaries(summarize(inserted))
+            if on_batch is not None:
+                on_batch(inserted)
+        batch.clear()
+        batch_rows.clear()
+
+    async for row_number, row, error in records:
+        report["received"] += 1
+        if error is None:
+            try:
+                song = build_song(row)
+            except ValidationError as exc:
+                error = "; ".join(
+                    f"{'.'.join(str(part) for part in detail['loc'])}: {detail['msg']}" for detail in exc.errors()
+                )
+        if error is not None:
+            _record_error(report, row_number, error)
+            continue
+        batch.append(song)
+        batch_rows.append(row_number)
+        if len(batch) >= batch_size:
+            await flush()
+    if batch:
+        await flush()
+    return report
+
+
+async def _read_file(path):
+    with open(path, "rb") as file:
+        while chunk := await asyncio.to_thread(file.read, READ_CHUNK_SIZE):
+            yield chunk
+
+
+async def _main(path, feed_format, batch_size):
+    import server
+
+    report = new_report()
+    try:
+        records = iter_records(_read_file(path), feed_format)
+        await import_songs(server.storage.songs, records, server.build_song, batch_size=batch_size, report=report)
+    finally:
+        if report["inserted"]:
+            # Running servers see the new version and refresh their caches
+            await server.storage.versions.increment("catalog")
+        server.storage.close()
+    print(json.dumps(report, indent=2))
+    return 1 if report["failed"] else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Bulk import a song feed")
+    parser.add_argument("path", type=Path)
+    parser.add_argument("--format", choices=["ndjson", "csv"], help="defaults to the file extension")
+    parser.add_argument("--batch-size", type=int, default=IMPORT_BATCH_SIZE)
+    args = parser.parse_args()
+    feed_format = args.format or ("csv" if args.path.suffix.lower() == ".csv" else "ndjson")
+    raise SystemExit(asyncio.run(_main(args.path, feed_format, args.batch_size)))
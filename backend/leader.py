@@ -0,0 +1,68 @@
+"""A storage-backed lock for work only one server process should do at a time.
+
+When several workers start together, startup steps that check and then write
+(seeding the sample catalog, building summaries) must not interleave.
+``LeaderLock`` wraps them: the first process to take the lock runs the steps
+while the others wait their turn, and by then find the work done. The lock
+expires after ``ttl`` seconds so a crashed holder cannot block startup for
+good; while held it is renewed in the background.
+"""
+import asyncio
+import logging
+import os
+import socket
+import uuid
+from contextlib import suppress
+from datetime import datetime, timedelta
+
+logger = logging.getLogger(__name__)
+
+
+class LeaderLock:
+    def __init__(self, locks, name, ttl=60.0, poll_interval=0.5):
+        """``locks`` is the storage's ``locks`` repository."""
+        self._locks = locks
+        self.name = name
+        self.ttl = ttl
+        self.poll_interval = poll_interval
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._renew_task = None
+
+    def _expires_at(self):
+        return datetime.utcnow() + timedelta(seconds=self.ttl)
+
+    async def acquire(self, wait=True):
+        """Take the lock, waiting for it unless ``wait`` is false; returns whether it was taken."""
+        waited = False
+        while not await self._locks.acquire(self.name, self.owner, self._expires_at()):
+            if not wait:
+                return False
+            if not waited:
+                logger.info("Waiting for the %s lock held by another process", self.name)
+                waited = True
+            await asyncio.sleep(self.poll_interval)
+        self._renew_task = asyncio.create_task(self._renew())
+        return True
+
+    async def release(self):
+        self._renew_task.cancel()
+        with suppress(asyncio.CancelledError):
+            await self._renew_task
+        self._renew_task = None
+        await self._locks.release(self.name, self.owner)
+
+    async def __aenter__(self):
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.release()
+
+    async def _renew(self):
+        while True:
+            await asyncio.sleep(self.ttl / 3)
+            try:
+                if not await self._locks.acquire(self.name, self.owner, self._expires_at()):
+                    logger.warning("Lost the %s lock to another process", self.name)
+            except Exception:
+                logger.exception("Renewing the %s lock failed", self.name)
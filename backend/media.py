@@ -0,0 +1,148 @@
+"""Serving audio files from the local media directory.
+
+``RangeFileResponse`` answers single ``Range`` requests with 206 partial
+content, honours ``If-None-Match``/``If-Range`` against a strong ETag, and
+streams the file in fixed-size chunks so a response never holds more than one
+chunk in memory. When the ASGI server advertises the ``http.response.zerocopy``
+extension the file descriptor is handed to the server instead (``sendfile``).
+
+``save_upload`` stores uploaded files content-addressed by their SHA-256.
+"""
+import hashlib
+import mimetypes
+import os
+import re
+import uuid
+from email.utils import formatdate
+
+import anyio
+from starlette.responses import Response
+
+CHUNK_SIZE = 64 * 1024
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+_RANGE_RE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+class RangeNotSatisfiable(Exception):
+    pass
+
+
+def parse_range(header, size):
+    """Return ``(start, end)`` (inclusive) for a single byte range, or None to send the whole file."""
+    match = _RANGE_RE.match(header.strip())
+    if not match:
+        # Malformed or multi-range requests get the full representation
+        return None
+    first, last = match.groups()
+    if not first and not last:
+        return None
+    if not first:
+        length = int(last)
+        if length == 0:
+            raise RangeNotSatisfiable()
+        return max(size - length, 0), size - 1
+    start = int(first)
+    end = min(int(last), size - 1) if last else size - 1
+    if start >= size or end < start:
+        raise RangeNotSatisfiable()
+    return start, end
+
+
+async def save_upload(upload, media_dir, suffix):
+    """Stream an ``UploadFile`` into ``media_dir`` in fixed-size chunks.
+
+    The file is named after its SHA-256, so identical uploads share one file.
+    Returns ``(hex_digest, file_name)``.
+    """
+    incoming = media_dir / ".incoming"
+    incoming.mkdir(parents=True, exist_ok=True)
+    temp_path = incoming / uuid.uuid4().hex
+    digest = hashlib.sha256()
+    try:
+        async with await anyio.open_file(temp_path, "wb") as out:
+            while chunk := await upload.read(UPLOAD_CHUNK_SIZE):
+                # hashlib releases the GIL on large buffers
+                await anyio.to_thread.run_sync(digest.update, chunk)
+                await out.write(chunk)
+        file_name = f"{digest.hexdigest()}{suffix}"
+        if (media_dir / file_name).exists():
+            temp_path.unlink()
+        else:
+            os.replace(temp_path, media_dir / file_name)
+    except BaseException:
+        temp_path.unlink(missing_ok=True)
+        raise
+    return digest.hexdigest(), file_name
+
+
+def file_etag(stat_result):
+    return f'"{stat_result.st_mtime_ns:x}-{stat_result.st_size:x}"'
+
+
+class RangeFileResponse(Response):
+    def __init__(self, path, request_headers, etag=None, media_type=None, cache_control="public, max-age=86400"):
+        self.path = path
+        stat_result = os.stat(path)
+        self.file_size = stat_result.st_size
+        self.etag = etag or file_etag(stat_result)
+        super().__init__(media_type=media_type or mimetypes.guess_type(str(path))[0] or "application/octet-stream")
+        self.headers.update({
+            "accept-ranges": "bytes",
+            "etag": self.etag,
+            "last-modified": formatdate(stat_result.st_mtime, usegmt=True),
+            "cache-control": cache_control,
+        })
+        self.start, self.end = 0, self.file_size - 1
+
+        if_none_match = request_headers.get("if-none-match")
+        if if_none_match and self.etag in [tag.strip() for tag in if_none_match.split(",")]:
+            self.status_code = 304
+            del self.headers["content-type"]
+            self.headers["content-length"] = "0"
+            self.end = -1
+            return
+
+        range_header = request_headers.get("range")
+        if_range = request_headers.get("if-range")
+        if range_header and (not if_range or if_range.strip() == self.etag):
+            try:
+                byte_range = parse_range(range_header, self.file_size)
+            except RangeNotSatisfiable:
+                self.status_code = 416
+                self.headers["content-range"] = f"bytes */{self.file_size}"
+                self.headers["content-length"] = "0"
+                self.end = -1
+                return
+            if byte_range is not None:
+                self.start, self.end = byte_range
+                self.status_code = 206
+                self.headers["content-range"] = f"bytes {self.start}-{self.end}/{self.file_size}"
+        self.headers["content-length"] = str(self.end - self.start + 1)
+
+    async def __call__(self, scope, receive, send):
+        await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+        count = self.end - self.start + 1
+        if scope["method"] == "HEAD" or count <= 0:
+            await send({"type": "http.response.body", "body": b""})
+            return
+        if "http.response.zerocopy" in scope.get("extensions", {}):
+            with open(self.path, "rb") as file:
+                await send({
+                    "type": "http.response.zerocopy",
+                    "file": file.fileno(),
+                    "offset": self.start,
+                    "count": count,
+                })
+            return
+        async with await anyio.open_file(self.path, "rb") as file:
+            await file.seek(self.start)
+            while count > 0:
+                chunk = await file.read(min(CHUNK_SIZE, count))
+                if not chunk:
+                    break
+                count -= len(chunk)
+                await send({"type": "http.response.body", "body": chunk, "more_body": count > 0})
+            if count > 0:
+                # File shrank underneath us; end the body rather than hang
+                await send({"type": "http.response.body", "body": b""})
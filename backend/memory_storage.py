@@ -0,0 +1,421 @@
+"""In-process storage engine with the same repositories as ``storage.MongoStorage``.
+
+Everything lives in dicts keyed like the unique indexes, with sorted lists
+where MongoDB would walk an index in order: song ids for keyset pagination,
+summary keys for the artist/album/genre listings, and plays by ``played_at``
+per user and overall. Reads never copy songs, which are immutable once
+stored; playlists are copied in and out since they change in place.
+
+Nothing is persisted and every process has its own data, so this backend is
+for benchmarks, tests and single-process development (``STORAGE_BACKEND=memory``).
+Its repositories are coroutines like Motor's but never wait on I/O.
+"""
+import asyncio
+import bisect
+from collections import Counter, defaultdict
+from datetime import datetime, timedelta
+
+from pymongo.errors import DuplicateKeyError
+
+from aggregates import SUMMARIES
+from play_history import BUCKET_SPANS, bucket_start
+from playlist_ops import PlaylistRevisionConflict
+from versioning import VERSION_LOG_SIZE
+
+
+def _duplicate(collection, field, value):
+    message = f"E11000 duplicate key error collection: {collection} dup key: {{ {field}: {value!r} }}"
+    return DuplicateKeyError(message, 11000)
+
+
+def _project(song, fields):
+    if fields is None:
+        return song
+    return {"id": song["id"], **{field: song[field] for field in fields if field in song}}
+
+
+class MemorySongs:
+    def __init__(self):
+        self._songs = {}  # id -> song, in insertion order
+        self._ids = []  # sorted
+        self._by_hash = {}
+        self._inserted = []  # (inserted at, id), oldest first
+        self._summaries = {collection: {} for collection in SUMMARIES}  # key tuple -> totals
+        self._summary_keys = {collection: [] for collection in SUMMARIES}  # sorted key tuples
+
+    def _check(self, song):
+        if song["id"] in self._songs:
+            raise _duplicate("songs", "id", song["id"])
+        content_hash = song.get("content_hash")
+        if isinstance(content_hash, str) and content_hash in self._by_hash:
+            raise _duplicate("songs", "content_hash", content_hash)
+
+    def _store(self, song):
+        song = {key: value for key, value in song.items() if key != "_id"}
+        self._songs[song["id"]] = song
+        self._inserted.append((datetime.utcnow(), song["id"]))
+        if isinstance(song.get("content_hash"), str):
+            self._by_hash[song["content_hash"]] = song["id"]
+
+    async def count(self):
+        return len(self._songs)
+
+    async def insert(self, song):
+        self._check(song)
+        self._store(song)
+        bisect.insort(self._ids, song["id"])
+
+    async def insert_many(self, songs):
+        failed = {}
+        added = []
+        for index, song in enumerate(songs):
+            try:
+                self._check(song)
+            except DuplicateKeyError as exc:
+                failed[index] = str(exc)
+                continue
+            self._store(song)
+            added.append(song["id"])
+        # Sorting the appended run merges it in linear time
+        self._ids.extend(added)
+        self._ids.sort()
+        return failed
+
+    async def find_page(self, after_id, limit):
+        start = bisect.bisect_right(self._ids, after_id) if after_id is not None else 0
+        return [self._songs[song_id] for song_id in self._ids[start:start + limit]]
+
+    async def iter_sorted(self, after_id=None, batch_size=500):
+        while True:
+            songs = await self.find_page(after_id, batch_size)
+            for song in songs:
+                yield song
+            if len(songs) < batch_size:
+                return
+            after_id = songs[-1]["id"]
+            await asyncio.sleep(0)
+
+    async def iter_fields(self, fields, batch_size=5000):
+        songs = list(self._songs.values())
+        for start in range(0, len(songs), batch_size):
+            for song in songs[start:start + batch_size]:
+                yield _project(song, fields)
+            await asyncio.sleep(0)
+
+    async def iter_inserted_since(self, since, fields, batch_size=5000):
+        start = bisect.bisect_left(self._inserted, (since,))
+        for index, (_, song_id) in enumerate(self._inserted[start:], 1):
+            yield _project(self._songs[song_id], fields)
+            if index % batch_size == 0:
+                await asyncio.sleep(0)
+
+    async def find_many(self, song_ids, fields=None):
+        return [_project(self._songs[song_id], fields) for song_id in dict.fromkeys(song_ids) if song_id in self._songs]
+
+    async def find_by_content_hash(self, content_hash):
+        song_id = self._by_hash.get(content_hash)
+        return self._songs[song_id] if song_id is not None else None
+
+    async def scan(self, text, fields, offset, limit):
+        needle = text.lower()
+        matches = []
+        for song in self._songs.values():
+            if any(needle in str(song.get(field, "")).lower() for field in fields):
+                if offset:
+                    offset -= 1
+                    continue
+                matches.append(song)
+                if len(matches) >= limit:
+                    break
+        return matches
+
+    async def add_to_summaries(self, summaries):
+        for collection, totals_by_key in summaries.items():
+            stored = self._summaries[collection]
+            for key, totals in totals_by_key.items():
+                existing = stored.get(key)
+                if existing is None:
+                    stored[key] = dict(totals)
+                    bisect.insort(self._summary_keys[collection], key)
+                else:
+                    existing["song_count"] += totals["song_count"]
+                    existing["total_duration"] += totals["total_duration"]
+
+    async def ensure_summaries(self):
+        # Kept up to date as songs are added; there is nothing to build
+        return False
+
+    async def summaries_page(self, collection, after_key, limit):
+        key_fields = [summary_field for summary_field, _ in SUMMARIES[collection]]
+        keys = self._summary_keys[collection]
+        start = bisect.bisect_right(keys, tuple(after_key)) if after_key is not None else 0
+        stored = self._summaries[collection]
+        return [{**dict(zip(key_fields, key)), **stored[key]} for key in keys[start:start + limit]]
+
+
+class MemoryUsers:
+    def __init__(self):
+        self._users = {}  # email -> user
+        self._emails = {}  # id -> email
+
+    async def find_by_email(self, email):
+        user = self._users.get(email)
+        return dict(user) if user is not None else None
+
+    async def insert(self, user):
+        if user["email"] in self._users:
+            raise _duplicate("users", "email", user["email"])
+        self._users[user["email"]] = dict(user)
+        self._emails[user["id"]] = user["email"]
+
+    async def set_password_hash(self, user_id, password_hash):
+        email = self._emails.get(user_id)
+        if email is not None:
+            self._users[email]["password_hash"] = password_hash
+
+
+def _copy_playlist(playlist):
+    return {**playlist, "song_ids": list(playlist.get("song_ids", []))}
+
+
+class MemoryPlaylists:
+    def __init__(self):
+        self._playlists = {}  # id -> playlist, in insertion order
+        self._by_user = defaultdict(list)
+        self._public = []
+
+    async def list(self, user_id=None, limit=100):
+        playlist_ids = self._by_user.get(user_id, []) if user_id else self._public
+        return [_copy_playlist(self._playlists[playlist_id]) for playlist_id in playlist_ids[:limit]]
+
+    async def insert(self, playlist):
+        if playlist["id"] in self._playlists:
+            raise _duplicate("playlists", "id", playlist["id"])
+        self._playlists[playlist["id"]] = _copy_playlist(playlist)
+        self._by_user[playlist["user_id"]].append(playlist["id"])
+        if playlist.get("is_public"):
+            self._public.append(playlist["id"])
+
+    async def get(self, playlist_id):
+        playlist = self._playlists.get(playlist_id)
+        return _copy_playlist(playlist) if playlist is not None else None
+
+    async def exists(self, playlist_id):
+        return playlist_id in self._playlists
+
+    async def add_song(self, playlist_id, song_id):
+        playlist = self._playlists.get(playlist_id)
+        if playlist is None or song_id in playlist["song_ids"]:
+            return False
+        playlist["song_ids"].append(song_id)
+        playlist["revision"] = playlist.get("revision", 0) + 1
+        return True
+
+    async def remove_song(self, playlist_id, song_id):
+        playlist = self._playlists.get(playlist_id)
+        if playlist is None or song_id not in playlist["song_ids"]:
+            return False
+        playlist["song_ids"] = [existing for existing in playlist["song_ids"] if existing != song_id]
+        playlist["revision"] = playlist.get("revision", 0) + 1
+        return True
+
+    async def song_window(self, playlist_id, offset, limit):
+        playlist = self._playlists.get(playlist_id)
+        if playlist is None:
+            return None
+        song_ids = playlist["song_ids"]
+        return {"total": len(song_ids), "song_ids": song_ids[offset:offset + limit], "revision": playlist.get("revision", 0)}
+
+    async def find_states(self, playlist_ids):
+        return {
+            playlist_id: {
+                "id": playlist_id,
+                "song_ids": list(self._playlists[playlist_id]["song_ids"]),
+                "revision": self._playlists[playlist_id].get("revision", 0),
+            }
+            for playlist_id in playlist_ids
+            if playlist_id in self._playlists
+        }
+
+    async def apply_updates(self, updates):
+        stale = [
+            update.playlist_id for update in updates
+            if update.playlist_id not in self._playlists
+            or self._playlists[update.playlist_id].get("revision", 0) != update.revision
+        ]
+        if stale:
+            raise PlaylistRevisionConflict(stale)
+        for update in updates:
+            playlist = self._playlists[update.playlist_id]
+            playlist["song_ids"] = list(update.song_ids)
+            playlist["revision"] = update.revision + 1
+
+
+def _insert_by_time(plays, play):
+    """Insert keeping ``plays`` ordered by ``played_at``; plays mostly arrive in order."""
+    index = len(plays)
+    while index and plays[index - 1]["played_at"] > play["played_at"]:
+        index -= 1
+    plays.insert(index, play)
+
+
+def _first_at_or_after(plays, moment):
+    low, high = 0, len(plays)
+    while low < high:
+        middle = (low + high) // 2
+        if plays[middle]["played_at"] < moment:
+            low = middle + 1
+        else:
+            high = middle
+    return low
+
+
+class MemoryPlays:
+    def __init__(self):
+        self._plays = []  # every play, by played_at
+        self._by_user = defaultdict(list)  # user id -> plays by played_at
+        self._song_daily = defaultdict(Counter)  # song id -> {day: plays}
+        self._user_daily = defaultdict(Counter)
+
+    async def write(self, plays, batch=None, retry=False):
+        # Nothing is written until the whole batch is, so a retry has nothing to skip
+        plays = sorted(
+            ({field: play[field] for field in ("id", "user_id", "song_id", "played_at")} for play in plays),
+            key=lambda play: play["played_at"],
+        )
+        for play in plays:
+            _insert_by_time(self._plays, play)
+            _insert_by_time(self._by_user[play["user_id"]], play)
+            day = bucket_start(play["played_at"], BUCKET_SPANS["day"])
+            self._song_daily[play["song_id"]][day] += 1
+            self._user_daily[play["user_id"]][day] += 1
+
+    async def recent(self, user_id, limit):
+        plays = self._by_user.get(user_id, [])
+        return plays[:-limit - 1:-1] if limit else []
+
+    async def iter_since(self, since, until=None, batch_size=10000):
+        plays = self._plays
+        end = len(plays) if until is None else _first_at_or_after(plays, until)
+        for start in range(_first_at_or_after(plays, since), end, batch_size):
+            for play in plays[start:min(start + batch_size, end)]:
+                yield play
+            await asyncio.sleep(0)
+
+    @staticmethod
+    def _daily(counts, days):
+        since = bucket_start(datetime.utcnow(), BUCKET_SPANS["day"]) - timedelta(days=days - 1)
+        return [{"day": day, "plays": plays} for day, plays in sorted(counts.items()) if day >= since][:days]
+
+    async def daily_for_user(self, user_id, days):
+        return self._daily(self._user_daily.get(user_id, {}), days)
+
+    async def daily_for_song(self, song_id, days):
+        return self._daily(self._song_daily.get(song_id, {}), days)
+
+
+class MemoryVersions:
+    def __init__(self):
+        self._values = {}
+        self._logs = {}
+
+    async def load(self, names):
+        return {name: self._values[name] for name in names if name in self._values}
+
+    async def increment(self, name):
+        self._values[name] = self._values.get(name, 0) + 1
+        return self._values[name]
+
+    async def increment_logged(self, name, entry):
+        self._logs.setdefault(name, []).append(entry)
+        del self._logs[name][:-VERSION_LOG_SIZE]
+        return await self.increment(name)
+
+    async def load_log(self, name):
+        return self._values.get(name, 0), list(self._logs.get(name, []))
+
+
+class MemoryRevokedTokens:
+    def __init__(self):
+        self._revoked = {}  # jti -> (expires_at, revoked_at)
+
+    async def add(self, jti, expires_at):
+        self._revoked.setdefault(jti, (expires_at, datetime.utcnow()))
+
+    async def unexpired(self, now):
+        return [(jti, expires_at) for jti, (expires_at, _) in self._revoked.items() if expires_at > now]
+
+    async def revoked_since(self, moment):
+        # Drop expired revocations here, as the TTL index does in MongoDB
+        now = datetime.utcnow()
+        self._revoked = {jti: entry for jti, entry in self._revoked.items() if entry[0] > now}
+        return [(jti, expires_at) for jti, (expires_at, revoked_at) in self._revoked.items() if revoked_at >= moment]
+
+
+class MemoryChartSketches:
+    def __init__(self):
+        self._states = {}
+
+    async def save(self, key, state):
+        self._states[key] = dict(state)
+
+    async def load_all(self):
+        return [(key, dict(state)) for key, state in self._states.items()]
+
+
+class MemoryRecommendationModels:
+    def __init__(self):
+        self._latest = None  # (id, built_until, data)
+
+    async def latest(self):
+        if self._latest is None:
+            return None
+        model_id, built_until, _ = self._latest
+        return {"id": model_id, "built_until": built_until}
+
+    async def load(self, model_id):
+        return self._latest[2]
+
+    async def save(self, data, built_until):
+        model_id = self._latest[0] + 1 if self._latest else 1
+        self._latest = (model_id, built_until, data)
+        return model_id
+
+
+class MemoryLocks:
+    def __init__(self):
+        self._locks = {}  # name -> (owner, expires_at)
+
+    async def acquire(self, name, owner, expires_at):
+        holder, held_until = self._locks.get(name, (owner, None))
+        if holder != owner and held_until > datetime.utcnow():
+            return False
+        self._locks[name] = (owner, expires_at)
+        return True
+
+    async def release(self, name, owner):
+        if self._locks.get(name, (None, None))[0] == owner:
+            del self._locks[name]
+
+
+class MemoryStorage:
+    def __init__(self):
+        self.songs = MemorySongs()
+        self.users = MemoryUsers()
+        self.playlists = MemoryPlaylists()
+        self.plays = MemoryPlays()
+        self.versions = MemoryVersions()
+        self.revoked_tokens = MemoryRevokedTokens()
+        self.chart_sketches = MemoryChartSketches()
+        self.recommendation_models = MemoryRecommendationModels()
+        self.locks = MemoryLocks()
+
+    async def ensure_indexes(self):
+        pass
+
+    def pin_reads(self, kind, playlist_ids=None):
+        # There is only one copy of the data to read
+        pass
+
+    def close(self):
+        pass
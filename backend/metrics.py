@@ -0,0 +1,291 @@
+"""Prometheus metrics for the API and its MongoDB traffic.
+
+A deliberately small, dependency-free take on the Prometheus client: labelled
+counters, gauges and fixed-bucket histograms that render in the text
+exposition format. Recording is a dict lookup and a few additions under a
+per-metric lock, cheap enough to run on every request and every command.
+
+``MetricsMiddleware`` times each HTTP request by route template, method and
+status. ``MongoCommandMetrics`` and ``MongoPoolMetrics`` are pymongo event
+listeners for per-collection command timings, commands per server (how
+reads fan out over a replica set) and connection checkout waits; pass them
+to the client with ``event_listeners=[...]``.
+"""
+import bisect
+import threading
+import time
+
+from pymongo import monitoring
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+HTTP_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+MONGO_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=""):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            series = list(self._series.items())
+        for label_values, value in sorted(series):
+            lines.extend(self._render_series(label_values, value))
+        return lines
+
+    def _render_series(self, label_values, value):
+        yield f"{self.name}{_format_labels(self.labels, label_values)} {_format_value(value)}"
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._series[label_values] = self._series.get(label_values, 0) + amount
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._series[label_values] = self._series.get(label_values, 0) + amount
+
+    def dec(self, *label_values, amount=1):
+        self.inc(*label_values, amount=-amount)
+
+    def set(self, value, *label_values):
+        with self._lock:
+            self._series[label_values] = value
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labels=(), buckets=HTTP_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, *label_values):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                # per-bucket counts (last one is +Inf), sum
+                series = self._series[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    def render(self):
+        with self._lock:
+            snapshot = {labels: (list(counts), total) for labels, (counts, total) in self._series.items()}
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for label_values, (counts, total) in sorted(snapshot.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = 'le="' + _format_value(bound) + '"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labels, label_values, le)} {cumulative}")
+            labels = _format_labels(self.labels, label_values)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, labels=()):
+        return self.register(Counter(name, documentation, labels))
+
+    def gauge(self, name, documentation, labels=()):
+        return self.register(Gauge(name, documentation, labels))
+
+    def histogram(self, name, documentation, labels=(), buckets=HTTP_BUCKETS):
+        return self.register(Histogram(name, documentation, labels, buckets))
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+http_requests = REGISTRY.counter(
+    "http_requests_total", "HTTP requests by route template, method and status.", ("method", "route", "status")
+)
+http_duration = REGISTRY.histogram(
+    "http_request_duration_seconds", "Time to serve an HTTP request, including the response body.", ("method", "route")
+)
+http_in_flight = REGISTRY.gauge("http_requests_in_flight", "HTTP requests currently being served.")
+mongo_duration = REGISTRY.histogram(
+    "mongodb_command_duration_seconds", "MongoDB command round-trip time by collection and command.",
+    ("collection", "command"), MONGO_BUCKETS,
+)
+mongo_failures = REGISTRY.counter(
+    "mongodb_command_failures_total", "MongoDB commands that returned an error.", ("collection", "command")
+)
+mongo_server_commands = REGISTRY.counter(
+    "mongodb_server_commands_total", "MongoDB commands sent, by server address and command.", ("server", "command")
+)
+mongo_reads = REGISTRY.counter(
+    "mongodb_reads_total",
+    "Catalog, analytics and playlist reads by the read preference they were sent with (pinned: to the primary after a write).",
+    ("kind", "read_preference"),
+)
+play_buffer_dropped = REGISTRY.counter(
+    "play_buffer_dropped_total", "Buffered plays dropped after every attempt to write them failed."
+)
+pool_wait = REGISTRY.histogram(
+    "mongodb_pool_checkout_wait_seconds", "Time spent waiting to check a connection out of the pool.",
+    buckets=MONGO_BUCKETS,
+)
+pool_failures = REGISTRY.counter(
+    "mongodb_pool_checkout_failures_total", "Connection checkouts that failed, by reason.", ("reason",)
+)
+pool_connections = REGISTRY.gauge(
+    "mongodb_pool_connections_checked_out", "Connections currently checked out of the pool."
+)
+
+
+class MetricsMiddleware:
+    """ASGI middleware recording request counts, latencies and concurrency."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        status = 500
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        http_in_flight.inc()
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            elapsed = time.perf_counter() - started
+            http_in_flight.dec()
+            # The router leaves the matched route in the scope; label by its
+            # template so ids in paths do not explode the series count
+            route = scope.get("route")
+            route = getattr(route, "path", None) or "unmatched"
+            method = scope["method"]
+            http_requests.inc(method, route, status)
+            http_duration.observe(elapsed, method, route)
+
+
+def _collection(event):
+    target = event.command.get(event.command_name)
+    if isinstance(target, str):
+        return target
+    # getMore names the collection separately; admin commands have none
+    target = event.command.get("collection")
+    return target if isinstance(target, str) else ""
+
+
+class MongoCommandMetrics(monitoring.CommandListener):
+    def __init__(self):
+        self._started = {}
+
+    def started(self, event):
+        self._started[event.request_id, event.connection_id] = _collection(event)
+        host, port = event.connection_id
+        mongo_server_commands.inc(f"{host}:{port}", event.command_name)
+
+    def succeeded(self, event):
+        collection = self._started.pop((event.request_id, event.connection_id), "")
+        mongo_duration.observe(event.duration_micros / 1e6, collection, event.command_name)
+
+    def failed(self, event):
+        collection = self._started.pop((event.request_id, event.connection_id), "")
+        mongo_duration.observe(event.duration_micros / 1e6, collection, event.command_name)
+        mongo_failures.inc(collection, event.command_name)
+
+
+class MongoPoolMetrics(monitoring.ConnectionPoolListener):
+    """Checkout waits, timed per thread: pymongo checks out on the thread running the operation."""
+
+    def __init__(self):
+        self._local = threading.local()
+
+    def connection_check_out_started(self, event):
+        self._local.started = time.perf_counter()
+
+    def connection_checked_out(self, event):
+        started = getattr(self._local, "started", None)
+        if started is not None:
+            pool_wait.observe(time.perf_counter() - started)
+            self._local.started = None
+        pool_connections.inc()
+
+    def connection_check_out_failed(self, event):
+        started = getattr(self._local, "started", None)
+        if started is not None:
+            pool_wait.observe(time.perf_counter() - started)
+            self._local.started = None
+        pool_failures.inc(event.reason)
+
+    def connection_checked_in(self, event):
+        pool_connections.dec()
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        pass
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        pass
@@ -0,0 +1,134 @@
+"""Write-behind buffer for play events.
+
+``PlayWriteBuffer`` acknowledges plays as soon as they are queued and writes
+them in batches from a background task, flushing whenever ``batch_size``
+events are waiting or ``flush_interval`` seconds have passed since the first
+event of a batch. The queue is bounded: once ``max_pending`` events are
+waiting, ``add`` waits up to ``put_timeout`` seconds for room and then raises
+``BufferFull`` so callers can shed load instead of growing memory.
+
+A batch whose write fails is retried ``max_retries`` times, ``retry_delay``
+seconds apart at first and doubling, while new plays wait in the queue. Only
+then is it dropped (counted in ``failed`` and ``play_buffer_dropped_total``).
+A retried batch may have been partly written by the failed attempt, so
+``write_batch(batch, key, retry)`` gets the same ``(writer, sequence)`` key on
+every attempt for writing it idempotently; batches are numbered in the order
+they are written and never overlap.
+"""
+import asyncio
+import logging
+import uuid
+from contextlib import suppress
+
+from metrics import play_buffer_dropped
+
+logger = logging.getLogger(__name__)
+
+
+class BufferFull(Exception):
+    pass
+
+
+class PlayWriteBuffer:
+    def __init__(self, write_batch, batch_size=500, flush_interval=0.25,
+                 max_pending=50000, put_timeout=1.0, max_retries=3, retry_delay=0.5):
+        self._write_batch = write_batch
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.put_timeout = put_timeout
+        self.max_pending = max_pending
+        self._queue = None
+        self._batch = []
+        self._task = None
+        self._inflight = None
+        self.writer_id = uuid.uuid4().hex
+        self._sequence = 0
+        self.accepted = 0
+        self.flushed = 0
+        self.failed = 0
+
+    def start(self):
+        # Created here so the queue belongs to the running event loop
+        self._queue = asyncio.Queue(maxsize=self.max_pending)
+        self._task = asyncio.create_task(self._run())
+
+    async def add(self, event):
+        try:
+            self._queue.put_nowait(event)
+        except asyncio.QueueFull:
+            try:
+                await asyncio.wait_for(self._queue.put(event), self.put_timeout)
+            except asyncio.TimeoutError:
+                raise BufferFull()
+        self.accepted += 1
+
+    async def stop(self):
+        """Stop the background writer and flush everything still buffered."""
+        if self._task is not None:
+            self._task.cancel()
+            with suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+        if self._inflight is not None:
+            await self._inflight
+        pending, self._batch = self._batch, []
+        # Never started: nothing was queued
+        while self._queue is not None and not self._queue.empty():
+            pending.append(self._queue.get_nowait())
+        for start in range(0, len(pending), self.batch_size):
+            await self._flush(pending[start:start + self.batch_size])
+
+    def stats(self):
+        return {
+            "pending": (self._queue.qsize() if self._queue else 0) + len(self._batch),
+            "accepted": self.accepted,
+            "flushed": self.flushed,
+            "failed": self.failed,
+        }
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            self._batch = [await self._queue.get()]
+            deadline = loop.time() + self.flush_interval
+            while len(self._batch) < self.batch_size:
+                try:
+                    self._batch.append(self._queue.get_nowait())
+                    continue
+                except asyncio.QueueEmpty:
+                    pass
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    self._batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            batch, self._batch = self._batch, []
+            # Shielded so a shutdown during a write lets it finish; stop() awaits it.
+            self._inflight = asyncio.ensure_future(self._flush(batch))
+            await asyncio.shield(self._inflight)
+            self._inflight = None
+
+    async def _flush(self, batch):
+        if not batch:
+            return
+        self._sequence += 1
+        key = (self.writer_id, self._sequence)
+        delay = self.retry_delay
+        for attempt in range(self.max_retries + 1):
+            try:
+                await self._write_batch(batch, key, attempt > 0)
+                self.flushed += len(batch)
+                return
+            except Exception:
+                if attempt == self.max_retries:
+                    self.failed += len(batch)
+                    play_buffer_dropped.inc(amount=len(batch))
+                    logger.exception("Dropped %d buffered plays after %d attempts", len(batch), attempt + 1)
+                    return
+                logger.warning("Failed to write %d buffered plays, retrying in %gs", len(batch), delay, exc_info=True)
+            await asyncio.sleep(delay)
+            delay *= 2
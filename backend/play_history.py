@@ -0,0 +1,168 @@
+"""Bucketed play-history storage and daily play-count rollups.
+
+In bucket mode each user's plays are packed into one document per hour or day
+(``play_history_buckets``), capped at ``MAX_BUCKET_PLAYS`` entries so a busy
+user simply opens a second document for the same period: plays that would
+overflow the open document start new ones instead. Reading the latest plays
+then touches one or two documents instead of sorting every event.
+
+Independently of the storage mode, every flushed batch is folded into
+``song_daily_plays`` and ``user_daily_plays`` so analytics never read raw
+events.
+
+A failed batch is written again in full, so every write is idempotent. Each
+batch has a key ``(writer, sequence)``: ``writer`` names the process's play
+buffer, which numbers its batches and retries one before starting the next.
+Bucket and rollup documents record in ``applied.<writer>`` the last sequence
+each writer added to them, and updates skip documents that already have it.
+Events are deduplicated by the unique index on their ``id``.
+"""
+from collections import Counter, defaultdict
+from datetime import datetime, timedelta
+
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+BUCKET_SPANS = {"hour": timedelta(hours=1), "day": timedelta(days=1)}
+MAX_BUCKET_PLAYS = 1000
+DUPLICATE_KEY = 11000
+
+
+def bucket_start(moment: datetime, span: timedelta) -> datetime:
+    return datetime.min + ((moment - datetime.min) // span) * span
+
+
+def raise_unless_duplicates(exc: BulkWriteError):
+    """Re-raise a bulk write error unless every failure was a duplicate key."""
+    details = exc.details
+    if details.get("writeConcernErrors") or any(error["code"] != DUPLICATE_KEY for error in details["writeErrors"]):
+        raise exc
+
+
+async def _buckets_with_batch(db, keys, field, sequence):
+    """``{(user_id, bucket): opened}`` for the keys with a document holding the batch,
+    ``opened`` when the batch started that document."""
+    query = {
+        "user_id": {"$in": list({user_id for user_id, _ in keys})},
+        "bucket": {"$in": list({start for _, start in keys})},
+        field: sequence,
+    }
+    cursor = db.play_history_buckets.find(query, {"_id": 1, "user_id": 1, "bucket": 1})
+    return {(bucket["user_id"], bucket["bucket"]): isinstance(bucket["_id"], str) async for bucket in cursor}
+
+
+async def write_play_buckets(db, plays, span, batch, retry=False):
+    writer, sequence = batch
+    field = f"applied.{writer}"
+    buckets = defaultdict(list)
+    for play in plays:
+        key = (play["user_id"], bucket_start(play["played_at"], span))
+        buckets[key].append({"id": play["id"], "song_id": play["song_id"], "played_at": play["played_at"]})
+    opening = {}
+    if retry:
+        # The failed attempt may have landed in some buckets already; the
+        # documents it started may not all have been inserted
+        for key, opened in (await _buckets_with_batch(db, buckets, field, sequence)).items():
+            entries = buckets.pop(key)
+            if opened:
+                opening[key] = entries
+    # Plays go to an open document for their period only if they all fit
+    fitting = [(key, entries) for key, entries in buckets.items() if len(entries) <= MAX_BUCKET_PLAYS]
+    operations = [
+        UpdateOne(
+            {"user_id": user_id, "bucket": start, "count": {"$lte": MAX_BUCKET_PLAYS - len(entries)},
+             field: {"$ne": sequence}},
+            {"$push": {"plays": {"$each": entries}}, "$inc": {"count": len(entries)}, "$set": {field: sequence}},
+        )
+        for (user_id, start), entries in fitting
+    ]
+    matched = 0
+    if operations:
+        matched = (await db.play_history_buckets.bulk_write(operations, ordered=False)).matched_count
+    if matched < len(buckets):
+        added = await _buckets_with_batch(db, buckets, field, sequence) if matched else {}
+        opening.update((key, entries) for key, entries in buckets.items() if key not in added)
+    if not opening:
+        return
+    # Start documents for the rest, as many as their plays fill; their ids are
+    # derived from the batch, so a retry inserting them again cannot duplicate them
+    documents = []
+    for (user_id, start), entries in opening.items():
+        for index in range(0, len(entries), MAX_BUCKET_PLAYS):
+            chunk = entries[index:index + MAX_BUCKET_PLAYS]
+            documents.append({
+                "_id": f"{writer}:{sequence}:{index}:{user_id}:{start.isoformat()}",
+                "user_id": user_id,
+                "bucket": start,
+                "count": len(chunk),
+                "plays": chunk,
+                "applied": {writer: sequence},
+            })
+    try:
+        await db.play_history_buckets.insert_many(documents, ordered=False)
+    except BulkWriteError as exc:
+        raise_unless_duplicates(exc)
+
+
+async def recent_plays_from_buckets(db, user_id, limit):
+    plays = []
+    boundary = None
+    cursor = db.play_history_buckets.find({"user_id": user_id}, {"_id": 0, "bucket": 1, "plays": 1}).sort("bucket", -1)
+    async for bucket in cursor.batch_size(4):
+        # A period can span several documents; read all of the last one needed
+        if len(plays) >= limit and bucket["bucket"] != boundary:
+            break
+        plays.extend(bucket["plays"])
+        boundary = bucket["bucket"]
+    plays.sort(key=lambda play: play["played_at"], reverse=True)
+    return [{**play, "user_id": user_id} for play in plays[:limit]]
+
+
+async def iter_bucket_plays(db, since, until=None):
+    """Every bucketed play at or after ``since`` (and before ``until``), bucket by bucket."""
+    bucket_range = {"$gte": since - max(BUCKET_SPANS.values())}
+    if until is not None:
+        bucket_range["$lt"] = until
+    cursor = db.play_history_buckets.find({"bucket": bucket_range}, {"_id": 0, "user_id": 1, "plays": 1})
+    async for bucket in cursor.batch_size(100):
+        for play in bucket["plays"]:
+            if play["played_at"] >= since and (until is None or play["played_at"] < until):
+                yield {**play, "user_id": bucket["user_id"]}
+
+
+async def record_daily_plays(db, plays, batch):
+    writer, sequence = batch
+    field = f"applied.{writer}"
+    song_counts = Counter()
+    user_counts = Counter()
+    for play in plays:
+        day = bucket_start(play["played_at"], BUCKET_SPANS["day"])
+        song_counts[play["song_id"], day] += 1
+        user_counts[play["user_id"], day] += 1
+    for collection, key_field, counts in (
+        ("song_daily_plays", "song_id", song_counts),
+        ("user_daily_plays", "user_id", user_counts),
+    ):
+        updates = [
+            ({key_field: key, "day": day, field: {"$ne": sequence}}, {"$inc": {"plays": count}, "$set": {field: sequence}})
+            for (key, day), count in counts.items()
+        ]
+        if not updates:
+            continue
+        try:
+            await db[collection].bulk_write([UpdateOne(*update, upsert=True) for update in updates], ordered=False)
+        except BulkWriteError as exc:
+            raise_unless_duplicates(exc)
+            # An upsert hits the unique (key, day) index when the document has this
+            # batch already, or when another writer created it first: update it then
+            await db[collection].bulk_write(
+                [UpdateOne(*updates[error["index"]]) for error in exc.details["writeErrors"]], ordered=False
+            )
+
+
+async def daily_plays(db, collection, key_field, key, days):
+    since = bucket_start(datetime.utcnow(), BUCKET_SPANS["day"]) - timedelta(days=days - 1)
+    rows = await db[collection].find(
+        {key_field: key, "day": {"$gte": since}}, {"_id": 0, "day": 1, "plays": 1}
+    ).sort("day", 1).to_list(days)
+    return rows
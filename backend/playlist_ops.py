@@ -0,0 +1,112 @@
+"""Batched playlist mutations with optimistic revision checks.
+
+``plan_updates`` replays a batch of add/remove/move operations against the
+current playlists in memory and turns each playlist's result into a single
+update guarded by its revision, so a playlist changes all at once or not at
+all when another writer got there first. ``mongo_update`` writes pure
+appends as ``$addToSet`` and pure removals as ``$pull``; anything involving
+positions sets the new order.
+"""
+from collections import namedtuple
+
+from pymongo import UpdateOne
+
+# The playlist's new ``song_ids`` if it is still at ``revision``; ``appended``
+# or ``removed`` is set when the batch only appended or only removed songs, and
+# ``previous`` holds the ``song_ids`` it replaces
+PlannedUpdate = namedtuple("PlannedUpdate", "playlist_id revision song_ids appended removed previous")
+APPLIED_WRITES_KEPT = 16
+
+
+class PlaylistOperationError(ValueError):
+    pass
+
+
+class PlaylistRevisionConflict(Exception):
+    """Some playlists of a batch were no longer at their planned revision, so none was updated.
+
+    ``changed`` lists playlists whose update landed and was reverted, which
+    moved their revision on by two.
+    """
+
+    def __init__(self, playlist_ids, changed=()):
+        super().__init__(f"Playlist revision changed: {', '.join(playlist_ids)}")
+        self.playlist_ids = list(playlist_ids)
+        self.changed = list(changed)
+
+
+def revision_filter(playlist_id, revision):
+    # Playlists created before revisions existed have no field, which `None` matches
+    return {"id": playlist_id, "revision": {"$in": [0, None]} if revision == 0 else revision}
+
+
+def _apply(song_ids, operation):
+    op, song_id, position = operation.op, operation.song_id, operation.position
+    if op == "add":
+        if song_id not in song_ids:
+            song_ids.insert(len(song_ids) if position is None else position, song_id)
+    elif op == "remove":
+        song_ids[:] = [existing for existing in song_ids if existing != song_id]
+    elif op == "move":
+        if song_id not in song_ids:
+            raise PlaylistOperationError(f"Song {song_id} is not in playlist {operation.playlist_id}")
+        song_ids.remove(song_id)
+        song_ids.insert(len(song_ids) if position is None else position, song_id)
+
+
+def mongo_update(update, write_id=None):
+    """The ``UpdateOne`` applying a ``PlannedUpdate``.
+
+    With ``write_id`` the update also records it in ``applied_writes`` (the
+    last ``APPLIED_WRITES_KEPT``), so the writer can tell its update applied
+    even if another write moved the revision the same way.
+    """
+    if update.appended is not None:
+        change = {"$addToSet": {"song_ids": {"$each": update.appended}}}
+    elif update.removed is not None:
+        change = {"$pull": {"song_ids": {"$in": update.removed}}}
+    else:
+        change = {"$set": {"song_ids": update.song_ids}}
+    change["$set"] = {**change.get("$set", {}), "revision": update.revision + 1}
+    if write_id is not None:
+        change["$push"] = {"applied_writes": {"$each": [write_id], "$slice": -APPLIED_WRITES_KEPT}}
+    return UpdateOne(revision_filter(update.playlist_id, update.revision), change)
+
+
+def revert_update(update, write_id):
+    """The ``UpdateOne`` undoing a ``mongo_update(update, write_id)`` nothing has changed since."""
+    return UpdateOne(
+        {"id": update.playlist_id, "revision": update.revision + 1, "applied_writes": write_id},
+        {"$set": {"song_ids": update.previous, "revision": update.revision + 2}, "$pull": {"applied_writes": write_id}},
+    )
+
+
+def plan_updates(playlists, operations):
+    """Return ``({playlist_id: new_revision}, [PlannedUpdate, ...])``.
+
+    ``playlists`` maps playlist id to its current document (``song_ids`` and
+    ``revision``); ``operations`` are applied in order.
+    """
+    by_playlist = {}
+    for operation in operations:
+        by_playlist.setdefault(operation.playlist_id, []).append(operation)
+
+    revisions, updates = {}, []
+    for playlist_id, playlist_operations in by_playlist.items():
+        playlist = playlists[playlist_id]
+        current = playlist.get("song_ids", [])
+        song_ids = list(current)
+        for operation in playlist_operations:
+            _apply(song_ids, operation)
+        if song_ids == current:
+            revisions[playlist_id] = playlist.get("revision", 0)
+            continue
+
+        kinds = {operation.op for operation in playlist_operations}
+        positioned = any(operation.position is not None for operation in playlist_operations)
+        appended = song_ids[len(current):] if kinds == {"add"} and not positioned else None
+        removed = [operation.song_id for operation in playlist_operations] if kinds == {"remove"} else None
+        revision = playlist.get("revision", 0)
+        updates.append(PlannedUpdate(playlist_id, revision, song_ids, appended, removed, current))
+        revisions[playlist_id] = revision + 1
+    return revisions, updates
@@ -0,0 +1,85 @@
+"""In-memory recently-played lists.
+
+``RecentPlays`` keeps a bounded ring of each active user's latest plays,
+newest first, and evicts the least recently used users beyond ``max_users``.
+Plays are recorded as they are accepted, before the play buffer writes them.
+A user's ring only serves reads once it has been warmed from MongoDB; plays
+recorded before that are merged with the stored history on warming, so none
+are lost or duplicated. Warm rings are re-read after ``ttl`` seconds to pick
+up plays accepted by other processes.
+"""
+import time
+from collections import OrderedDict, deque
+
+PLAY_FIELDS = ("id", "user_id", "song_id", "played_at")
+
+
+class _Ring:
+    __slots__ = ("plays", "warmed_at")
+
+    def __init__(self, size):
+        self.plays = deque(maxlen=size)
+        self.warmed_at = None
+
+
+class RecentPlays:
+    def __init__(self, size=50, max_users=10000, ttl=300.0, clock=time.monotonic):
+        self.size = size
+        self.max_users = max_users
+        self.ttl = ttl
+        self._clock = clock
+        self._rings = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def _ring(self, user_id):
+        ring = self._rings.get(user_id)
+        if ring is None:
+            ring = self._rings[user_id] = _Ring(self.size)
+            while len(self._rings) > self.max_users:
+                self._rings.popitem(last=False)
+        else:
+            self._rings.move_to_end(user_id)
+        return ring
+
+    def record(self, play):
+        ring = self._ring(play["user_id"])
+        play = {field: play.get(field) for field in PLAY_FIELDS}
+        if not ring.plays or ring.plays[0]["played_at"] <= play["played_at"]:
+            ring.plays.appendleft(play)
+        else:
+            self._merge(ring, [play])
+
+    def get(self, user_id):
+        """The user's latest plays, newest first, or None if they must be read from MongoDB."""
+        ring = self._rings.get(user_id)
+        if ring is None or ring.warmed_at is None or self._clock() - ring.warmed_at > self.ttl:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._rings.move_to_end(user_id)
+        return list(ring.plays)
+
+    def warm(self, user_id, stored_plays):
+        """Merge plays read from MongoDB into the ring and return its contents."""
+        ring = self._ring(user_id)
+        self._merge(ring, [{field: play.get(field) for field in PLAY_FIELDS} for play in stored_plays])
+        ring.warmed_at = self._clock()
+        return list(ring.plays)
+
+    def _merge(self, ring, plays):
+        by_id = {play["id"]: play for play in plays}
+        by_id.update((play["id"], play) for play in ring.plays)
+        merged = sorted(by_id.values(), key=lambda play: play["played_at"], reverse=True)
+        ring.plays.clear()
+        ring.plays.extend(merged[:self.size])
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "users": len(self._rings),
+            "max_users": self.max_users,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+        }
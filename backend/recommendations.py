@@ -0,0 +1,333 @@
+"""Item-to-item recommendations from listening sessions.
+
+A user's plays are split into sessions wherever two consecutive plays are more
+than ``session_gap`` seconds apart. Two songs co-occur when they are played in
+the same session, and their similarity is the cosine of their session
+vectors::
+
+    sim(i, j) = sessions(i and j) / sqrt(sessions(i) * sessions(j))
+
+``build_model`` computes the co-occurrence matrix and the ``top_k`` neighbours
+of every song with NumPy; it is CPU-bound and runs in a worker process.
+Between rebuilds ``ItemRecommender.observe`` folds newly recorded plays into
+the counts and re-ranks the neighbours of the songs they touch, so serving a
+recommendation only merges a few precomputed neighbour lists.
+
+With several workers one of them rebuilds and publishes the model
+(``export``/``dump_model``); the others ``install`` it (``load_model``) and
+catch up on the plays recorded since it was built.
+"""
+import asyncio
+import heapq
+import io
+import threading
+from array import array
+from collections import defaultdict
+from datetime import datetime
+from operator import itemgetter
+
+import numpy as np
+
+SESSION_GAP = 30 * 60
+MAX_SESSION_SONGS = 50
+TOP_K = 20
+PAIR_CHUNK_SIZE = 5_000_000
+MAX_OPEN_SESSIONS = 100_000
+REBUILD_CHUNK_SIZE = 10_000
+
+
+def _session_pairs(songs, lengths):
+    """Both orderings of every pair of songs sharing a session (``songs`` grouped by session)."""
+    per_song = np.repeat(lengths, lengths)
+    left = np.repeat(np.arange(len(songs)), per_song)
+    session_start = np.repeat(np.repeat(np.cumsum(lengths) - lengths, lengths), per_song)
+    offset = np.arange(len(left)) - np.repeat(np.cumsum(per_song) - per_song, per_song)
+    right = session_start + offset
+    distinct = left != right
+    return songs[left[distinct]], songs[right[distinct]]
+
+
+def _row_ranks(rows):
+    """Position of each entry within its run of equal ``rows`` values."""
+    starts = np.flatnonzero(np.r_[True, rows[1:] != rows[:-1]]) if len(rows) else np.empty(0, np.int64)
+    lengths = np.diff(np.r_[starts, len(rows)])
+    return np.arange(len(rows)) - np.repeat(starts, lengths), lengths
+
+
+def build_model(user_codes, song_codes, timestamps, n_songs,
+                session_gap=SESSION_GAP, max_session_songs=MAX_SESSION_SONGS, top_k=TOP_K):
+    """Co-occurrence counts and top-k neighbours from parallel arrays of plays.
+
+    Returns a dict of arrays: ``sessions`` (sessions per song), the
+    co-occurrence matrix in CSR form (``indptr``, ``indices``, ``counts``) and
+    the neighbour lists in CSR form (``top_indptr``, ``top_indices``,
+    ``top_scores``, best first).
+    """
+    n = np.int64(max(n_songs, 1))
+    order = np.lexsort((timestamps, user_codes))
+    users, songs, times = user_codes[order], song_codes[order].astype(np.int64), timestamps[order]
+    boundary = np.ones(len(users), bool)
+    boundary[1:] = (users[1:] != users[:-1]) | (np.diff(times) > session_gap)
+    session = np.cumsum(boundary) - 1
+
+    # Each song once per session, kept in the order it was first played
+    _, first = np.unique(session * n + songs, return_index=True)
+    first.sort()
+    session, songs = session[first], songs[first]
+    position, _ = _row_ranks(session)
+    session, songs = session[position < max_session_songs], songs[position < max_session_songs]
+    sessions = np.bincount(songs, minlength=n_songs)
+
+    _, lengths = _row_ranks(session)
+    ends = np.cumsum(lengths)
+    pair_totals = np.cumsum(lengths * lengths)
+    keys, counts = [], []
+    start_session = 0
+    while start_session < len(lengths):
+        # Generate pairs a bounded number of sessions at a time
+        done = pair_totals[start_session - 1] if start_session else 0
+        end_session = max(int(np.searchsorted(pair_totals, done + PAIR_CHUNK_SIZE, side="right")), start_session + 1)
+        first_song = ends[start_session - 1] if start_session else 0
+        left, right = _session_pairs(songs[first_song:ends[end_session - 1]], lengths[start_session:end_session])
+        chunk_keys, chunk_counts = np.unique(left * n + right, return_counts=True)
+        keys.append(chunk_keys)
+        counts.append(chunk_counts)
+        start_session = end_session
+    if len(keys) > 1:
+        keys, inverse = np.unique(np.concatenate(keys), return_inverse=True)
+        counts = np.bincount(inverse, weights=np.concatenate(counts)).astype(np.int64)
+    elif keys:
+        keys, counts = keys[0], counts[0].astype(np.int64)
+    else:
+        keys, counts = np.empty(0, np.int64), np.empty(0, np.int64)
+
+    rows, cols = keys // n, keys % n
+    indptr = np.r_[0, np.cumsum(np.bincount(rows, minlength=n_songs))]
+    scores = counts / np.sqrt(sessions[rows] * sessions[cols])
+    order = np.lexsort((-scores, rows))
+    rank, _ = _row_ranks(rows[order])
+    best = order[rank < top_k]
+    return {
+        "sessions": sessions,
+        "indptr": indptr,
+        "indices": cols,
+        "counts": counts,
+        "top_indptr": np.r_[0, np.cumsum(np.bincount(rows[best], minlength=n_songs))],
+        "top_indices": cols[best],
+        "top_scores": scores[best],
+    }
+
+
+def dump_model(song_ids, model):
+    """``build_model`` output and the song ids its codes stand for, as bytes."""
+    buffer = io.BytesIO()
+    np.savez(buffer, song_ids=np.frombuffer("\n".join(song_ids).encode(), np.uint8), **model)
+    return buffer.getvalue()
+
+
+def load_model(data):
+    """``(song_ids, model)`` from ``dump_model`` bytes."""
+    arrays = np.load(io.BytesIO(data))
+    encoded = arrays["song_ids"].tobytes().decode()
+    return encoded.split("\n") if encoded else [], {name: arrays[name] for name in arrays.files if name != "song_ids"}
+
+
+def _encode_plays(plays, song_codes, user_codes, songs, users, timestamps):
+    """Append the codes and timestamps of ``plays``, assigning codes to new songs and users."""
+    songs.extend(song_codes.setdefault(play["song_id"], len(song_codes)) for play in plays)
+    users.extend(user_codes.setdefault(play["user_id"], len(user_codes)) for play in plays)
+    timestamps.extend(play["played_at"].timestamp() for play in plays)
+
+
+class ItemRecommender:
+    def __init__(self, top_k=TOP_K, session_gap=SESSION_GAP, max_session_songs=MAX_SESSION_SONGS):
+        self.top_k = top_k
+        self.session_gap = session_gap
+        self.max_session_songs = max_session_songs
+        self.ready = False
+        self.built_until = None  # plays before this are in the model as last built or installed
+        self._lock = threading.Lock()
+        self._pending = None  # plays observed while a rebuild or install is running
+        empty = build_model(np.empty(0, np.int32), np.empty(0, np.int32), np.empty(0), 0)
+        self._load([], empty)
+
+    def _load(self, song_ids, model):
+        self.song_ids = list(song_ids)
+        self._codes = {song_id: code for code, song_id in enumerate(self.song_ids)}
+        self._n_built = len(self.song_ids)
+        self._model = model
+        self._sessions = model["sessions"].astype(np.float64)
+        self._delta = defaultdict(lambda: defaultdict(int))  # code -> {code: extra co-occurrences}
+        self._reranked = {}  # code -> (indices, scores) replacing the built neighbours
+        self._open_sessions = {}  # user_id -> (last played timestamp, [song codes])
+
+    def __len__(self):
+        return len(self.song_ids)
+
+    def _code(self, song_id):
+        code = self._codes.get(song_id)
+        if code is None:
+            code = self._codes[song_id] = len(self.song_ids)
+            self.song_ids.append(song_id)
+            if code >= len(self._sessions):
+                self._sessions = np.concatenate([self._sessions, np.zeros(len(self._sessions) + 1)])
+        return code
+
+    def observe(self, plays):
+        """Fold recorded plays (dicts with ``user_id``, ``song_id``, ``played_at``) into the model."""
+        with self._lock:
+            if self._pending is not None:
+                self._pending.extend(plays)
+            self._observe(plays)
+
+    def _observe(self, plays):
+        touched = set()
+        for play in sorted(plays, key=itemgetter("played_at")):
+            code = self._code(play["song_id"])
+            played = play["played_at"].timestamp()
+            last_played, session = self._open_sessions.get(play["user_id"], (None, None))
+            if last_played is None or played - last_played > self.session_gap:
+                session = []
+            self._open_sessions[play["user_id"]] = (played, session)
+            if code in session or len(session) >= self.max_session_songs:
+                continue
+            for other in session:
+                self._delta[code][other] += 1
+                self._delta[other][code] += 1
+            self._sessions[code] += 1
+            session.append(code)
+            touched.update(session)
+        for code in touched:
+            self._reranked[code] = self._rank(code)
+        if len(self._open_sessions) > MAX_OPEN_SESSIONS:
+            newest = max(last_played for last_played, _ in self._open_sessions.values())
+            self._open_sessions = {
+                user_id: open_session for user_id, open_session in self._open_sessions.items()
+                if newest - open_session[0] <= self.session_gap
+            }
+
+    def _rank(self, code):
+        indices, counts = np.empty(0, np.int64), np.empty(0, np.int64)
+        if code < self._n_built:
+            start, end = self._model["indptr"][code], self._model["indptr"][code + 1]
+            indices, counts = self._model["indices"][start:end], self._model["counts"][start:end]
+        delta = self._delta.get(code)
+        if delta:
+            indices = np.concatenate([indices, np.fromiter(delta.keys(), np.int64, len(delta))])
+            counts = np.concatenate([counts, np.fromiter(delta.values(), np.int64, len(delta))])
+            indices, inverse = np.unique(indices, return_inverse=True)
+            counts = np.bincount(inverse, weights=counts)
+        scores = counts / np.sqrt(np.maximum(self._sessions[code] * self._sessions[indices], 1))
+        best = np.argsort(-scores, kind="stable")[:self.top_k]
+        return indices[best], scores[best]
+
+    def _neighbours(self, code):
+        if code in self._reranked:
+            return self._reranked[code]
+        if code >= self._n_built:
+            return np.empty(0, np.int64), np.empty(0)
+        start, end = self._model["top_indptr"][code], self._model["top_indptr"][code + 1]
+        return self._model["top_indices"][start:end], self._model["top_scores"][start:end]
+
+    def similar(self, song_id):
+        """``[(song_id, score), ...]`` for the song's nearest neighbours, best first."""
+        with self._lock:
+            code = self._codes.get(song_id)
+            if code is None:
+                return []
+            indices, scores = self._neighbours(code)
+            return [(self.song_ids[index], score) for index, score in zip(indices.tolist(), scores.tolist())]
+
+    def recommend(self, seed_song_ids, limit=20, exclude=()):
+        """Songs most similar to the seeds overall, as ``[(song_id, score), ...]``."""
+        with self._lock:
+            totals = defaultdict(float)
+            for song_id in seed_song_ids:
+                code = self._codes.get(song_id)
+                if code is None:
+                    continue
+                indices, scores = self._neighbours(code)
+                for index, score in zip(indices.tolist(), scores.tolist()):
+                    totals[index] += score
+            skip = {self._codes[song_id] for song_id in exclude if song_id in self._codes}
+            best = heapq.nlargest(
+                limit, ((index, score) for index, score in totals.items() if index not in skip), key=itemgetter(1)
+            )
+            return [(self.song_ids[index], score) for index, score in best]
+
+    def export(self):
+        """The model as last built or installed, as ``dump_model`` bytes."""
+        with self._lock:
+            song_ids, model = self.song_ids[:self._n_built], self._model
+        return dump_model(song_ids, model)
+
+    async def install(self, song_ids, model, plays_since):
+        """Swap in a model built elsewhere, then fold in the plays it lacks.
+
+        ``plays_since(until)`` iterates the plays recorded after the model was
+        built and before ``until``; plays observed from ``until`` on are
+        replayed as well.
+        """
+        until = self._start_pending()
+        try:
+            recent = [play async for play in plays_since(until)]
+        except BaseException:
+            self._drop_pending()
+            raise
+        await self._swap(song_ids, model, until, recent)
+
+    async def rebuild(self, plays_before, executor):
+        """Rebuild from the plays ``plays_before(until)`` iterates in ``executor``, then swap the model in.
+
+        ``until`` is taken before the scan starts and the scan stops there, so
+        plays observed since (played at ``until`` or later) are replayed on
+        the new model without being counted twice. Plays are encoded a chunk
+        at a time, letting requests run in between.
+        """
+        until = self._start_pending()
+        try:
+            song_codes, user_codes = {}, {}
+            songs, users, timestamps = array("l"), array("l"), array("d")
+            chunk = []
+            async for play in plays_before(until):
+                chunk.append(play)
+                if len(chunk) >= REBUILD_CHUNK_SIZE:
+                    _encode_plays(chunk, song_codes, user_codes, songs, users, timestamps)
+                    chunk = []
+                    await asyncio.sleep(0)
+            _encode_plays(chunk, song_codes, user_codes, songs, users, timestamps)
+            loop = asyncio.get_running_loop()
+            model = await loop.run_in_executor(
+                executor, build_model,
+                np.frombuffer(users, dtype=np.int_) if users else np.empty(0, np.int_),
+                np.frombuffer(songs, dtype=np.int_) if songs else np.empty(0, np.int_),
+                np.frombuffer(timestamps) if timestamps else np.empty(0),
+                len(song_codes), self.session_gap, self.max_session_songs, self.top_k,
+            )
+        except BaseException:
+            self._drop_pending()
+            raise
+        await self._swap(list(song_codes), model, until)
+        return len(songs)
+
+    def _start_pending(self):
+        """Start holding on to observed plays; returns the moment from which they count."""
+        with self._lock:
+            self._pending = []
+            return datetime.utcnow()
+
+    def _drop_pending(self):
+        with self._lock:
+            self._pending = None
+
+    async def _swap(self, song_ids, model, until, recent=()):
+        # Indexing the new song ids and replaying plays is too slow for the event loop
+        await asyncio.get_running_loop().run_in_executor(None, self._load_and_replay, song_ids, model, until, recent)
+        self.built_until = until
+        self.ready = True
+
+    def _load_and_replay(self, song_ids, model, until, recent):
+        with self._lock:
+            pending, self._pending = self._pending, None
+            self._load(song_ids, model)
+            self._observe([*recent, *(play for play in pending if play["played_at"] >= until)])
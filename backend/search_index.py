@@ -0,0 +1,324 @@
+"""In-process full-text search over the song catalog.
+
+``SearchIndex`` keeps a tokenized inverted index over the searchable song
+fields and ranks matches with BM25. Query terms are expanded by prefix (so
+search-as-you-type works on partial words) and, when a term is not in the
+vocabulary, by character trigram similarity or, for short words where one
+typo changes most trigrams, by edit distance, so small typos still match.
+Terms within one edit of a short word are found through a map from every
+one-character deletion of the vocabulary's short terms, which also catches
+transpositions ("lvoe", "jzaz") that share no trigram with the term.
+
+Terms with long postings lists ("the", "love") are not scored in full: only
+their ``max_postings_per_term`` highest-impact postings (by BM25 contribution
+when last ordered), plus any added since, are scanned to pick candidates.
+Candidates are then scored exactly against every query term, so only
+documents whose best terms all sit past the cut are missed. Call
+``order_by_impact`` for each of ``unordered_terms()`` after a bulk build so
+the first searches do not pay for the ordering.
+"""
+import bisect
+import heapq
+import itertools
+import math
+import re
+from collections import Counter, OrderedDict, defaultdict
+
+FIELD_WEIGHTS = {"title": 3.0, "artist": 2.0, "album": 1.5, "genre": 1.0}
+
+_TOKEN_RE = re.compile(r"\w+")
+
+
+def tokenize(text):
+    return _TOKEN_RE.findall(text.casefold())
+
+
+def trigrams(term):
+    padded = f"^{term}$"
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def deletions(term):
+    """``term`` and each string it becomes with one character deleted."""
+    return {term, *(term[:i] + term[i + 1:] for i in range(len(term)))}
+
+
+def edit_distance(a, b, limit):
+    """Levenshtein distance counting adjacent transpositions as one edit; ``limit + 1`` once it exceeds ``limit``."""
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    previous2 = None
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, 1):
+        current = [i] + [0] * len(b)
+        for j, char_b in enumerate(b, 1):
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (char_a != char_b))
+            if i > 1 and j > 1 and char_a == b[j - 2] and a[i - 2] == char_b:
+                current[j] = min(current[j], previous2[j - 2] + 1)
+        if min(current) > limit:
+            return limit + 1
+        previous2, previous = previous, current
+    return min(previous[-1], limit + 1)
+
+
+class SearchIndex:
+    def __init__(self, k1=1.2, b=0.75, max_prefix_expansions=50,
+                 max_fuzzy_expansions=5, min_similarity=0.45, max_edit_distance_length=6,
+                 max_postings_per_term=2000, result_cache_size=1024, cached_results=200):
+        self.k1 = k1
+        self.b = b
+        self.max_postings_per_term = max_postings_per_term
+        self.max_edit_distance_length = max_edit_distance_length
+        self.result_cache_size = result_cache_size
+        self.cached_results = cached_results
+        self.max_prefix_expansions = max_prefix_expansions
+        self.max_fuzzy_expansions = max_fuzzy_expansions
+        self.min_similarity = min_similarity
+        self.ready = False
+        self._defer_sort = False
+        self._postings = defaultdict(dict)  # term -> {doc_id: weighted tf}
+        self._doc_terms = {}                # doc_id -> Counter of weighted tf
+        self._doc_len = {}
+        self._total_len = 0.0
+        self._vocabulary = []               # sorted, for prefix lookups
+        self._grams = defaultdict(set)      # trigram -> terms
+        self._deletes = defaultdict(set)    # one-deletion variant -> short terms
+        # Top postings of long lists by descending impact; documents added
+        # since sit in the tail until it is merged in.
+        self._impact_top = {}               # term -> [doc_id, ...]
+        self._impact_tail = defaultdict(set)
+        # Ranked results per normalized query, valid while the generation
+        # (bumped on every add/remove) is unchanged.
+        self._results = OrderedDict()
+        self._generation = 0
+
+    def __len__(self):
+        return len(self._doc_terms)
+
+    def __contains__(self, doc_id):
+        return doc_id in self._doc_terms
+
+    def add(self, song):
+        """Index (or re-index) a song document."""
+        doc_id = song["id"]
+        if doc_id in self._doc_terms:
+            self.remove(doc_id)
+        self._generation += 1
+        terms = Counter()
+        for field, weight in FIELD_WEIGHTS.items():
+            for token in tokenize(song.get(field) or ""):
+                terms[token] += weight
+        for term, tf in terms.items():
+            postings = self._postings[term]
+            if not postings:
+                self._add_term(term)
+            postings[doc_id] = tf
+            if term in self._impact_top:
+                self._impact_tail[term].add(doc_id)
+        length = sum(terms.values())
+        self._doc_terms[doc_id] = terms
+        self._doc_len[doc_id] = length
+        self._total_len += length
+
+    def add_many(self, songs):
+        """Index a batch of songs, sorting the vocabulary once at the end."""
+        self._defer_sort = True
+        try:
+            for song in songs:
+                self.add(song)
+        finally:
+            self._defer_sort = False
+            self._vocabulary.sort()
+
+    def remove(self, doc_id):
+        terms = self._doc_terms.pop(doc_id, None)
+        if terms is None:
+            return
+        self._generation += 1
+        self._total_len -= self._doc_len.pop(doc_id)
+        for term in terms:
+            postings = self._postings[term]
+            postings.pop(doc_id, None)
+            if term in self._impact_top:
+                self._impact_tail[term].discard(doc_id)
+                if doc_id in self._impact_top[term]:
+                    self._impact_top[term].remove(doc_id)
+            if not postings:
+                del self._postings[term]
+                self._impact_top.pop(term, None)
+                self._impact_tail.pop(term, None)
+                self._remove_term(term)
+
+    def search(self, query, offset=0, limit=20):
+        """Return ``(total_matches, [doc_id, ...])`` ranked by relevance.
+
+        ``total_matches`` is an estimate when a query term has more than
+        ``max_postings_per_term`` postings.
+        """
+        n_docs = len(self._doc_terms)
+        if not n_docs:
+            return 0, []
+        key = " ".join(tokenize(query))
+        cached = self._results.get(key)
+        if cached is not None:
+            generation, total, ranked = cached
+            truncated = len(ranked) < min(offset + limit, total)
+            if generation == self._generation and not truncated:
+                self._results.move_to_end(key)
+                return total, ranked[offset:offset + limit]
+        total, ranked = self._rank(key.split(), n_docs, max(offset + limit, self.cached_results))
+        self._results[key] = (self._generation, total, ranked)
+        self._results.move_to_end(key)
+        if len(self._results) > self.result_cache_size:
+            self._results.popitem(last=False)
+        return total, ranked[offset:offset + limit]
+
+    def _impact(self, term):
+        """Sort key of a term's postings by BM25 contribution."""
+        k1, b = self.k1, self.b
+        length_norm = k1 * b * len(self._doc_terms) / (self._total_len or 1.0)
+        base_norm = k1 * (1 - b)
+        postings, doc_len = self._postings[term], self._doc_len
+        return lambda doc_id: postings[doc_id] / (postings[doc_id] + base_norm + length_norm * doc_len[doc_id])
+
+    def unordered_terms(self):
+        """Terms with long postings lists whose top postings have not been picked yet."""
+        return [
+            term for term, postings in self._postings.items()
+            if len(postings) > self.max_postings_per_term and term not in self._impact_top
+        ]
+
+    def order_by_impact(self, term):
+        self._impact_top[term] = heapq.nlargest(self.max_postings_per_term, self._postings[term], key=self._impact(term))
+        self._impact_tail.pop(term, None)
+
+    def _top_postings(self, term):
+        """The term's top postings by impact, and those added since."""
+        if term not in self._impact_top:
+            self.order_by_impact(term)
+        tail = self._impact_tail.get(term, ())
+        if len(tail) > self.max_postings_per_term:
+            # Postings outside the top were already below it, so merging the tail is enough
+            self._impact_top[term] = heapq.nlargest(
+                self.max_postings_per_term, itertools.chain(self._impact_top[term], tail), key=self._impact(term)
+            )
+            del self._impact_tail[term]
+            tail = ()
+        return self._impact_top[term], tail
+
+    def _rank(self, tokens, n_docs, top_n):
+        k1, b = self.k1, self.b
+        length_norm = k1 * b * n_docs / (self._total_len or 1.0)
+        base_norm = k1 * (1 - b)
+        doc_len = self._doc_len
+        # Pages past the top postings need every posting scanned
+        scan_all = top_n > self.max_postings_per_term
+        scores = defaultdict(float)
+        capped = []  # (term, postings, scale) of terms scored only for candidates
+        for position, token in enumerate(tokens):
+            # Only the last token can still be mid-word while the user types.
+            is_last = position == len(tokens) - 1
+            for term, weight in self._expand(token, allow_prefix=is_last):
+                postings = self._postings[term]
+                df = len(postings)
+                scale = weight * math.log(1 + (n_docs - df + 0.5) / (df + 0.5)) * (k1 + 1)
+                if df > self.max_postings_per_term and not scan_all:
+                    capped.append((term, postings, scale))
+                    continue
+                for doc_id, tf in postings.items():
+                    scores[doc_id] += scale * tf / (tf + base_norm + length_norm * doc_len[doc_id])
+        # Matches of the fully scanned terms are exact; the capped terms' are
+        # estimated as if terms occurred independently
+        unmatched = 1.0
+        uncapped_matches = len(scores)
+        for term, postings, _ in capped:
+            unmatched *= 1 - len(postings) / n_docs
+            for doc_id in itertools.chain(*self._top_postings(term)):
+                if doc_id not in scores:
+                    scores[doc_id] = 0.0
+        for _, postings, scale in capped:
+            for doc_id in scores:
+                tf = postings.get(doc_id)
+                if tf:
+                    scores[doc_id] += scale * tf / (tf + base_norm + length_norm * doc_len[doc_id])
+        total = len(scores)
+        if capped:
+            estimate = uncapped_matches + (n_docs - uncapped_matches) * (1 - unmatched)
+            total = max(total, round(estimate), *(len(postings) for _, postings, _ in capped))
+        top = heapq.nlargest(top_n, scores.items(), key=lambda item: (item[1], item[0]))
+        return total, [doc_id for doc_id, _ in top]
+
+    def _expand(self, token, allow_prefix):
+        """Map a query token to ``(term, weight)`` pairs present in the index."""
+        expansions = {}
+        if token in self._postings:
+            expansions[token] = 1.0
+        if allow_prefix:
+            vocabulary = self._vocabulary
+            candidates = []
+            for index in range(bisect.bisect_left(vocabulary, token), len(vocabulary)):
+                term = vocabulary[index]
+                if not term.startswith(token):
+                    break
+                if term != token:
+                    candidates.append(term)
+            candidates = heapq.nlargest(
+                self.max_prefix_expansions, candidates, key=lambda t: len(self._postings[t])
+            )
+            for term in candidates:
+                expansions[term] = 0.8 * len(token) / len(term)
+        if not expansions:
+            for term, similarity in self._similar_terms(token):
+                expansions[term] = 0.7 * similarity
+        return expansions.items()
+
+    def _similar_terms(self, token):
+        grams = trigrams(token)
+        shared = Counter()
+        for gram in grams:
+            shared.update(self._grams.get(gram, ()))
+        matches = {}
+        for term, count in shared.items():
+            similarity = count / (len(grams) + len(trigrams(term)) - count)
+            if similarity >= self.min_similarity:
+                matches[term] = similarity
+        # One typo in a short word changes most of its trigrams, so look for
+        # terms within one edit among those sharing a one-deletion variant
+        if len(token) <= self.max_edit_distance_length:
+            for variant in deletions(token):
+                for term in self._deletes.get(variant, ()):
+                    if term not in matches and edit_distance(token, term, 1) <= 1:
+                        matches[term] = 1 - 1 / max(len(token), len(term))
+        return heapq.nlargest(self.max_fuzzy_expansions, matches.items(), key=lambda m: m[1])
+
+    def _add_term(self, term):
+        if self._defer_sort:
+            self._vocabulary.append(term)
+        else:
+            bisect.insort(self._vocabulary, term)
+        for gram in trigrams(term):
+            self._grams[gram].add(term)
+        if len(term) <= self.max_edit_distance_length + 1:
+            for variant in deletions(term):
+                self._deletes[variant].add(term)
+
+    def _remove_term(self, term):
+        if self._defer_sort:
+            self._vocabulary.remove(term)
+        else:
+            index = bisect.bisect_left(self._vocabulary, term)
+            if index < len(self._vocabulary) and self._vocabulary[index] == term:
+                del self._vocabulary[index]
+        for gram in trigrams(term):
+            terms = self._grams.get(gram)
+            if terms is not None:
+                terms.discard(term)
+                if not terms:
+                    del self._grams[gram]
+        if len(term) <= self.max_edit_distance_length + 1:
+            for variant in deletions(term):
+                terms = self._deletes.get(variant)
+                if terms is not None:
+                    terms.discard(term)
+                    if not terms:
+                        del self._deletes[variant]
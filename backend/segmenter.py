@@ -0,0 +1,166 @@
+"""Segmented (HLS-style) packaging of stored audio.
+
+Packaging splits a stored MP3 into segments of roughly ``segment_seconds``
+and records each segment's byte offset, length and duration in a sidecar
+``<file>.segments.json`` next to the audio. Segments are byte ranges of the
+original file, so nothing is re-encoded or copied. Cuts fall on frame
+boundaries, which makes every segment independently decodable (HLS packed
+audio). Other formats cannot be cut that way (a slice of a WAV or FLAC file
+lacks the header a decoder needs), so they are only streamed whole.
+
+The index records the ``segment_seconds`` it was cut with; ``index_tag``
+names that packaging, so URLs and ETags change when the setting does.
+
+Packaging is CPU and IO bound, so it runs in a process pool. Run it offline
+for every stored song that is not packaged yet with:
+
+    python segmenter.py
+"""
+import argparse
+import asyncio
+import json
+import math
+import mmap
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from pathlib import Path
+
+from audio_formats import iter_mp3_frames
+
+INDEX_VERSION = 1
+DEFAULT_SEGMENT_SECONDS = 6.0
+# Formats that can be served as HLS packed audio
+HLS_EXTENSIONS = {".mp3"}
+
+
+def can_package(audio_path):
+    return Path(audio_path).suffix.lower() in HLS_EXTENSIONS
+
+
+def index_path(audio_path):
+    return audio_path.with_name(audio_path.name + ".segments.json")
+
+
+def _mp3_segments(path, segment_seconds):
+    segments = []
+    with open(path, "rb") as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        start = end = None
+        seconds = 0.0
+        for offset, length, samples, rate in iter_mp3_frames(data):
+            if start is None:
+                start = offset
+            elif offset != end or seconds >= segment_seconds:
+                # Cut at the target duration, or where junk between frames was skipped
+                segments.append({"offset": start, "length": end - start, "duration": seconds})
+                start, seconds = offset, 0.0
+            end = offset + length
+            seconds += samples / rate
+        if start is not None:
+            segments.append({"offset": start, "length": end - start, "duration": seconds})
+    return segments
+
+
+def build_segment_index(path, segment_seconds=DEFAULT_SEGMENT_SECONDS):
+    """Compute and write the segment index for ``path``. Runs in a worker process."""
+    path = Path(path)
+    if not can_package(path):
+        raise ValueError(f"{path.name}: only {', '.join(sorted(HLS_EXTENSIONS))} files can be segmented")
+    segments = _mp3_segments(path, segment_seconds)
+    index = {
+        "version": INDEX_VERSION,
+        "segment_seconds": segment_seconds,
+        "duration": sum(segment["duration"] for segment in segments),
+        "segments": segments,
+    }
+    target = index_path(path)
+    temp = target.with_name(target.name + f".{os.getpid()}.tmp")
+    temp.write_text(json.dumps(index))
+    os.replace(temp, target)
+    return index
+
+
+@lru_cache(maxsize=1024)
+def _load_index(path_str, mtime_ns):
+    with open(path_str) as file:
+        return json.load(file)
+
+
+def load_segment_index(audio_path, segment_seconds=DEFAULT_SEGMENT_SECONDS):
+    """The stored segment index for ``audio_path``, or None if it is not packaged with ``segment_seconds``."""
+    path = index_path(audio_path)
+    try:
+        stat_result = path.stat()
+    except FileNotFoundError:
+        return None
+    index = _load_index(str(path), stat_result.st_mtime_ns)
+    if index.get("version") != INDEX_VERSION or index.get("segment_seconds") != segment_seconds:
+        return None
+    return index
+
+
+def index_tag(index):
+    """Names the packaging behind ``index``, for segment URLs and ETags."""
+    return f"{index['version']}-{index['segment_seconds']:g}"
+
+
+def create_executor(workers):
+    # Spawned rather than forked: the API process runs threads (Motor) and an event loop
+    return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+
+
+async def package(executor, audio_path, segment_seconds=DEFAULT_SEGMENT_SECONDS):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, build_segment_index, str(audio_path), segment_seconds)
+
+
+def render_manifest(index, segment_extension):
+    """The HLS playlist; segment URLs carry ``index_tag`` so cached segments never outlive their packaging."""
+    lines = [
+        "#EXTM3U",
+        "#EXT-X-VERSION:3",
+        f"#EXT-X-TARGETDURATION:{math.ceil(max((s['duration'] for s in index['segments']), default=0))}",
+        "#EXT-X-MEDIA-SEQUENCE:0",
+        "#EXT-X-PLAYLIST-TYPE:VOD",
+    ]
+    for number, segment in enumerate(index["segments"]):
+        lines.append(f"#EXTINF:{segment['duration']:.3f},")
+        lines.append(f"{number}{segment_extension}?v={index_tag(index)}")
+    lines.append("#EXT-X-ENDLIST")
+    return "\n".join(lines) + "\n"
+
+
+def read_segment(audio_path, segment):
+    """Bytes of one segment. Blocking; call it from a worker thread."""
+    with open(audio_path, "rb") as file:
+        return os.pread(file.fileno(), segment["length"], segment["offset"])
+
+
+async def _package_all(segment_seconds, workers):
+    from dotenv import load_dotenv
+    from motor.motor_asyncio import AsyncIOMotorClient
+
+    root_dir = Path(__file__).parent
+    load_dotenv(root_dir / '.env')
+    media_dir = Path(os.environ.get('MEDIA_DIR', root_dir / 'media')).resolve()
+    client = AsyncIOMotorClient(os.environ['MONGO_URL'])
+    db = client[os.environ['DB_NAME']]
+    pending = []
+    async for song in db.songs.find({"media_path": {"$type": "string"}}, {"_id": 0, "media_path": 1}):
+        audio_path = media_dir / song["media_path"]
+        if can_package(audio_path) and audio_path.is_file() and load_segment_index(audio_path, segment_seconds) is None:
+            pending.append(audio_path)
+    client.close()
+    with create_executor(workers) as executor:
+        results = await asyncio.gather(*(package(executor, path, segment_seconds) for path in pending))
+    for path, index in zip(pending, results):
+        print(f"{path.name}: {len(index['segments'])} segments, {index['duration']:.1f}s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Package stored songs into segments")
+    parser.add_argument("--segment-seconds", type=float, default=DEFAULT_SEGMENT_SECONDS)
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    args = parser.parse_args()
+    asyncio.run(_package_all(args.segment_seconds, args.workers))
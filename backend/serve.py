@@ -0,0 +1,42 @@
+"""Serve the API with several worker processes.
+
+Each worker is a separate process with its own caches, search index and
+MongoDB connection pool, so the database sees up to ``--workers`` times
+``MONGO_MAX_POOL_SIZE`` connections. Index creation and sample seeding run
+under a lock in the database, so workers can start together. Point load
+balancer health checks at ``/api/health/ready``. Run from the ``backend``
+directory:
+
+    python serve.py --workers 4 --port 8001
+"""
+import argparse
+import os
+from pathlib import Path
+
+import uvicorn
+from dotenv import load_dotenv
+
+ROOT_DIR = Path(__file__).parent
+
+if __name__ == "__main__":
+    load_dotenv(ROOT_DIR / '.env')
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument(
+        "--workers", type=int, default=int(os.environ.get('WEB_CONCURRENCY', os.cpu_count())),
+        help="Worker processes (default: WEB_CONCURRENCY or the CPU count)",
+    )
+    parser.add_argument("--keep-alive", type=int, default=5, help="Seconds to hold idle connections open")
+    args = parser.parse_args()
+    if args.workers > 1 and os.environ.get('STORAGE_BACKEND', 'mongo') == "memory":
+        # Every worker would have its own catalog, users and playlists
+        parser.error("STORAGE_BACKEND=memory keeps data per process; use --workers 1")
+    uvicorn.run(
+        "server:app",
+        app_dir=str(ROOT_DIR),
+        host=args.host,
+        port=args.port,
+        workers=args.workers,
+        timeout_keep_alive=args.keep_alive,
+    )
@@ -1,28 +1,248 @@
-from fastapi import FastAPI, APIRouter, HTTPException, UploadFile, File, Form
+from fastapi import FastAPI, APIRouter, BackgroundTasks, Depends, HTTPException, UploadFile, File, Form, Query, Request, Response
+from fastapi.responses import JSONResponse, PlainTextResponse, RedirectResponse, StreamingResponse
+from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
 from fastapi.staticfiles import StaticFiles
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo.errors import DuplicateKeyError, WaitQueueTimeoutError
+import anyio
+
+try:
+    import orjson
+except ImportError:  # optional; only needed for FAST_SERIALIZATION
+    orjson = None
 import os
+import mimetypes
+import bisect
+import asyncio
 import logging
 from pathlib import Path
 from pydantic import BaseModel, Field
-from typing import List, Optional
+from typing import Dict, List, Literal, Optional
 import uuid
-from datetime import datetime
+from datetime import datetime, timedelta
 import base64
+import json
+import secrets
+import socket
+
+from aggregates import summarize
+from auth import HasherBusy, InvalidToken, PasswordHasher, RevocationList, TokenIssuer
+from catalog_cache import CatalogCache
+from catalog_snapshot import CatalogSnapshot, SnapshotError, export_snapshot
+from charts import TrendingCharts
+from audio_formats import AUDIO_EXTENSIONS, probe_duration
+from memory_storage import MemoryStorage
+from metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE, REGISTRY, MetricsMiddleware, MongoCommandMetrics, MongoPoolMetrics
+from ingest import import_songs, iter_records, new_report
+from leader import LeaderLock
+from media import RangeFileResponse, save_upload
+from play_buffer import BufferFull, PlayWriteBuffer
+from playlist_ops import PlaylistOperationError, PlaylistRevisionConflict, plan_updates
+from play_history import BUCKET_SPANS
+from recent_plays import RecentPlays
+from recommendations import ItemRecommender, load_model
+from search_index import FIELD_WEIGHTS, SearchIndex
+from song_loader import SongLoader
+from storage import READ_KINDS, MongoStorage, read_policy
+from versioning import ContentVersions, etag_matches
+from segmenter import can_package, create_executor, index_tag, load_segment_index, package, read_segment, render_manifest
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
-# MongoDB connection
-mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
-db = client[os.environ['DB_NAME']]
+# Locally stored audio files, referenced by Song.media_path
+MEDIA_DIR = Path(os.environ.get('MEDIA_DIR', ROOT_DIR / 'media')).resolve()
+
+# Segment packaging runs in a process pool, created on first use
+SEGMENT_SECONDS = float(os.environ.get('SEGMENT_SECONDS', 6))
+PACKAGING_WORKERS = int(os.environ.get('PACKAGING_WORKERS', 2))
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+packaging_executor = None
+
+# Plays are acknowledged immediately and written in batches, either one
+# document per play ("events") or packed into per-user time buckets ("buckets")
+PLAY_HISTORY_STORAGE = os.environ.get('PLAY_HISTORY_STORAGE', 'events')
+PLAY_HISTORY_BUCKET_SPAN = BUCKET_SPANS[os.environ.get('PLAY_HISTORY_BUCKET', 'hour')]
+PLAY_HISTORY_LIMIT = 50
+
+# Handlers read and write through the storage repositories: MongoDB by
+# default, or an in-process engine ("memory") that persists nothing
+STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND', 'mongo')
+if STORAGE_BACKEND == "memory":
+    storage = MemoryStorage()
+else:
+    # One pool per worker process; requests that wait longer than
+    # MONGO_WAIT_QUEUE_TIMEOUT_MS for a connection get a 503 (0 waits forever).
+    # Command timings and pool checkout waits are exported on /api/metrics
+    client = AsyncIOMotorClient(
+        os.environ['MONGO_URL'],
+        maxPoolSize=int(os.environ.get('MONGO_MAX_POOL_SIZE', 100)),
+        minPoolSize=int(os.environ.get('MONGO_MIN_POOL_SIZE', 0)),
+        waitQueueTimeoutMS=int(os.environ.get('MONGO_WAIT_QUEUE_TIMEOUT_MS', 10000)) or None,
+        event_listeners=[MongoCommandMetrics(), MongoPoolMetrics()],
+    )
+    # In a replica set, catalog, analytics and playlist reads go where
+    # <KIND>_READ_PREFERENCE says, skipping secondaries more than
+    # MONGO_MAX_STALENESS_SECONDS behind; writes and everything else use the
+    # primary. After a write, reads of what changed stay on the primary until
+    # every eligible secondary must have it (staleness plus a heartbeat).
+    MONGO_MAX_STALENESS_SECONDS = int(os.environ.get('MONGO_MAX_STALENESS_SECONDS', 90))
+    read_policies = {
+        kind: read_policy(
+            os.environ.get(f'{kind.upper()}_READ_PREFERENCE', 'secondaryPreferred'),
+            os.environ.get(f'{kind.upper()}_READ_CONCERN', 'local'),
+            MONGO_MAX_STALENESS_SECONDS,
+        )
+        for kind in READ_KINDS
+    }
+    storage = MongoStorage(
+        client, client[os.environ['DB_NAME']], PLAY_HISTORY_STORAGE, PLAY_HISTORY_BUCKET_SPAN,
+        read_policies=read_policies, pin_seconds=MONGO_MAX_STALENESS_SECONDS + 10,
+    )
+
+# Startup writes are serialized across workers by this lock, renewed while held
+STARTUP_LOCK_TTL = 60
+
+# What must have loaded at least once before /api/health/ready reports ready
+READINESS_CHECKS = ("storage", "catalog_cache", "search_index", "recommendations")
+warmed = set()
 
 # Create the main app without a prefix
 app = FastAPI()
 
+# In-memory full-text index over the song catalog, built at startup
+search_index = SearchIndex()
+SEARCH_INDEX_BATCH_SIZE = 5000
+# Once built, the index picks up songs inserted since its last scan began,
+# less this margin for inserts in flight and clock skew between hosts
+SEARCH_INDEX_RESCAN_MARGIN = timedelta(minutes=5)
+search_index_scanned_at = None
+
+SONG_PAGE_SIZE = 1000
+SUMMARY_PAGE_SIZE = 1000
+PLAYLIST_PAGE_SIZE = 1000
+SONG_STREAM_BATCH_SIZE = 500
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+
+# Write-through cache of song documents (stored without `_id`)
+catalog_cache = CatalogCache(
+    max_songs=int(os.environ.get('CATALOG_CACHE_SIZE', 10000)),
+    ttl=float(os.environ.get('CATALOG_CACHE_TTL', 60)),
+)
+
+# Memory-mapped catalog snapshot serving song, listing and summary reads
+# without touching MongoDB. Each worker maps CATALOG_SNAPSHOT_PATH at startup;
+# one worker per host re-exports it when the catalog has changed, checking
+# every CATALOG_SNAPSHOT_REFRESH_INTERVAL seconds, and every worker swaps the
+# new file in. Unset to disable.
+CATALOG_SNAPSHOT_PATH = os.environ.get('CATALOG_SNAPSHOT_PATH', '')
+CATALOG_SNAPSHOT_REFRESH_INTERVAL = float(os.environ.get('CATALOG_SNAPSHOT_REFRESH_INTERVAL', 300))
+catalog_snapshot = None
+
+def current_snapshot() -> Optional[CatalogSnapshot]:
+    """The snapshot if it is at the current catalog version; listings need that, lookups by id do not."""
+    if catalog_snapshot is not None and catalog_snapshot.version == content_versions["catalog"]:
+        return catalog_snapshot
+    return None
+
+# Catalog and playlist version counters behind the ETags of the read endpoints.
+# Clients revalidate on every use and get a 304 while nothing has changed.
+VERSIONED_CACHE_CONTROL = "no-cache"
+
+def on_external_change(name: str, playlist_ids=None):
+    # Until secondaries catch up, they may not have what the new version counts
+    storage.pin_reads(name, playlist_ids)
+    if name == "catalog":
+        # Songs were added by another process; drop what we cached and index them
+        catalog_cache.invalidate()
+        refresh_search_index()
+
+content_versions = ContentVersions(
+    on_change=on_external_change,
+    poll_interval=float(os.environ.get('CONTENT_VERSION_POLL_INTERVAL', 1)),
+)
+
+# Each active user's latest plays, updated as plays are recorded
+recently_played = RecentPlays(
+    size=PLAY_HISTORY_LIMIT,
+    max_users=int(os.environ.get('RECENT_PLAYS_CACHE_USERS', 10000)),
+    ttl=float(os.environ.get('RECENT_PLAYS_CACHE_TTL', 300)),
+)
+
+async def write_plays(plays, batch=None, retry=False):
+    # Plays reach the model and charts only once the write has succeeded, so a retry cannot count them twice
+    await storage.plays.write(plays, batch, retry)
+    try:
+        await anyio.to_thread.run_sync(recommender.observe, plays)
+    except Exception:
+        logger.exception("Failed to add %d plays to the recommendation model", len(plays))
+    try:
+        await count_chart_plays(plays)
+    except Exception:
+        logger.exception("Failed to add %d plays to the charts", len(plays))
+
+play_buffer = PlayWriteBuffer(
+    write_plays,
+    batch_size=int(os.environ.get('PLAY_BUFFER_BATCH_SIZE', 500)),
+    flush_interval=float(os.environ.get('PLAY_BUFFER_FLUSH_INTERVAL', 0.25)),
+    max_pending=int(os.environ.get('PLAY_BUFFER_MAX_PENDING', 50000)),
+)
+
+# Item-item recommendations, rebuilt from recent play history in a worker
+# process by one server process at a time, which publishes the model for the
+# others, and updated in between as plays are flushed
+recommender = ItemRecommender(top_k=int(os.environ.get('RECOMMENDATION_NEIGHBOURS', 20)))
+RECOMMENDATION_REBUILD_INTERVAL = float(os.environ.get('RECOMMENDATION_REBUILD_INTERVAL', 3600))
+RECOMMENDATION_WINDOW = timedelta(days=int(os.environ.get('RECOMMENDATION_WINDOW_DAYS', 90)))
+RECOMMENDATION_POLL_INTERVAL = float(os.environ.get('RECOMMENDATION_POLL_INTERVAL', 60))
+RECOMMENDATION_SEEDS = 20
+RECOMMENDATION_RETRY_DELAY = 5
+recommendation_executor = None
+recommendation_lock = None
+recommendation_model_id = None  # the published model this worker built or installed
+
+# Trending charts per song, artist and genre, counted as plays are flushed
+charts = TrendingCharts()
+CHARTS_CHECKPOINT_INTERVAL = float(os.environ.get('CHARTS_CHECKPOINT_INTERVAL', 60))
+CHART_DIMENSIONS = {"songs": "song", "artists": "artist", "genres": "genre"}
+
+async def count_chart_plays(plays):
+    song_ids = list(dict.fromkeys(play["song_id"] for play in plays))
+    loader = SongLoader(fetch_songs, catalog_cache, fields=("artist", "genre"))
+    songs = {song["id"]: song for song in await loader.load_many(song_ids)}
+    charts.add([
+        (play["played_at"], {"song": play["song_id"], "artist": song["artist"], "genre": song["genre"]})
+        for play in plays
+        if (song := songs.get(play["song_id"])) is not None
+    ])
+
+# Opt-in fast path for catalog reads: stored documents (queried without `_id`)
+# are encoded straight to JSON bytes with orjson instead of being turned into
+# models and validated again against the response_model
+FAST_SERIALIZATION = os.environ.get('FAST_SERIALIZATION', '').lower() in ('1', 'true', 'yes')
+if FAST_SERIALIZATION and orjson is None:
+    logging.getLogger(__name__).warning("FAST_SERIALIZATION is set but orjson is not installed; ignoring")
+    FAST_SERIALIZATION = False
+
+# Passwords are hashed on a bounded thread pool; logins get stateless JWTs
+password_hasher = PasswordHasher(
+    workers=int(os.environ.get('PASSWORD_HASH_WORKERS', 2)),
+    max_pending=int(os.environ.get('PASSWORD_HASH_MAX_PENDING', 64)),
+    rounds=int(os.environ.get('BCRYPT_ROUNDS', 12)),
+)
+JWT_SECRET = os.environ.get('JWT_SECRET')
+if not JWT_SECRET:
+    logging.getLogger(__name__).warning(
+        "JWT_SECRET is not set; using a random secret, so tokens will not survive a restart"
+    )
+    JWT_SECRET = secrets.token_urlsafe(32)
+tokens = TokenIssuer(JWT_SECRET, ttl=int(os.environ.get('ACCESS_TOKEN_TTL', 86400)))
+revoked_tokens = RevocationList()
+TOKEN_REVOCATION_POLL_INTERVAL = float(os.environ.get('TOKEN_REVOCATION_POLL_INTERVAL', 5))
+bearer_scheme = HTTPBearer(auto_error=False)
+
 # Create a router with the /api prefix
 api_router = APIRouter(prefix="/api")
 
@@ -42,6 +262,11 @@ class UserLogin(BaseModel):
     email: str
     password: str
 
+class UserSession(User):
+    access_token: str
+    token_type: str = "bearer"
+    expires_at: datetime
+
 class Song(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     title: str
@@ -52,6 +277,16 @@ class Song(BaseModel):
     audio_url: str
     cover_art: str
     release_date: datetime = Field(default_factory=datetime.utcnow)
+    media_path: Optional[str] = None  # relative to MEDIA_DIR
+    content_hash: Optional[str] = None  # SHA-256 of uploaded audio
+
+SONG_FIELDS = tuple(Song.model_fields)
+
+# Field order and defaults used to emit the same wire format without the model
+SONG_FIELD_DEFAULTS = {
+    name: None if field.is_required() else field.get_default(call_default_factory=False)
+    for name, field in Song.model_fields.items()
+}
 
 class SongCreate(BaseModel):
     title: str
@@ -71,6 +306,7 @@ class Playlist(BaseModel):
     cover_art: str
     is_public: bool = True
     created_at: datetime = Field(default_factory=datetime.utcnow)
+    revision: int = 0  # bumped by every change to song_ids
 
 class PlaylistCreate(BaseModel):
     name: str
@@ -79,17 +315,45 @@ class PlaylistCreate(BaseModel):
     cover_art: str = ""
     is_public: bool = True
 
+class PlaylistOperation(BaseModel):
+    playlist_id: str
+    op: Literal["add", "remove", "move"]
+    song_id: str
+    position: Optional[int] = Field(None, ge=0)  # insert/move target; end of playlist if omitted
+
+class PlaylistBulkUpdate(BaseModel):
+    operations: List[PlaylistOperation] = Field(..., max_length=10000)
+    # Reject the whole batch if any of these playlists has moved on
+    expected_revisions: Dict[str, int] = {}
+
 class PlayHistory(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     user_id: str
     song_id: str
     played_at: datetime = Field(default_factory=datetime.utcnow)
 
-# Initialize sample data
 @api_router.on_event("startup")
+async def load_content_versions():
+    await content_versions.load(storage.versions)
+    content_versions.start(storage.versions)
+    # The versions just loaded may count writes secondaries have not seen yet
+    for name in content_versions.values:
+        storage.pin_reads(name)
+
+# Create indexes before anything queries the collections. Workers starting
+# together take turns, so only the first seeds or builds anything.
+@api_router.on_event("startup")
+async def prepare_storage():
+    async with LeaderLock(storage.locks, "startup", ttl=STARTUP_LOCK_TTL):
+        await storage.ensure_indexes()
+        await init_sample_data()
+        await build_summaries()
+    warmed.add("storage")
+
+# Initialize sample data
 async def init_sample_data():
     # Check if songs already exist
-    existing_songs = await db.songs.count_documents({})
+    existing_songs = await storage.songs.count()
     if existing_songs == 0:
         sample_songs = [
             {
@@ -181,121 +445,694 @@ async def init_sample_data():
                 "release_date": datetime.utcnow()
             }
         ]
-        await db.songs.insert_many(sample_songs)
+        await storage.songs.insert_many(sample_songs)
+        await storage.songs.add_to_summaries(summarize(sample_songs))
+        await content_versions.bump(storage.versions, "catalog")
+
+async def build_summaries():
+    if await storage.songs.ensure_summaries():
+        await content_versions.bump(storage.versions, "catalog")
+
+async def build_search_index():
+    global search_index_scanned_at
+    started = datetime.utcnow()
+    batch = []
+    if search_index_scanned_at is None:
+        songs = (current_snapshot() or storage.songs).iter_fields(FIELD_WEIGHTS, SEARCH_INDEX_BATCH_SIZE)
+    else:
+        songs = storage.songs.iter_inserted_since(
+            search_index_scanned_at - SEARCH_INDEX_RESCAN_MARGIN, FIELD_WEIGHTS, SEARCH_INDEX_BATCH_SIZE
+        )
+    async for song in songs:
+        if song["id"] in search_index:
+            continue
+        batch.append(song)
+        if len(batch) >= SEARCH_INDEX_BATCH_SIZE:
+            search_index.add_many(batch)
+            batch = []
+            await asyncio.sleep(0)
+    search_index.add_many(batch)
+    # Pick the top postings of common terms now rather than on their first search
+    for term in search_index.unordered_terms():
+        search_index.order_by_impact(term)
+        await asyncio.sleep(0)
+    search_index_scanned_at = started
+    if not search_index.ready:
+        search_index.ready = True
+        warmed.add("search_index")
+        logger.info("Search index built over %d songs", len(search_index))
+
+def refresh_search_index():
+    """(Re)start indexing the songs missing from the index.
+
+    The first run scans the whole catalog and searches fall back to a regex
+    scan until it is done; later runs only read songs inserted since the last
+    one began, and the index keeps serving meanwhile.
+    """
+    task = getattr(app.state, "search_index_task", None)
+    if task is not None:
+        task.cancel()
+    app.state.search_index_task = asyncio.create_task(build_search_index())
+
+@api_router.on_event("startup")
+async def start_play_buffer():
+    play_buffer.start()
+
+async def rebuild_recommendations():
+    """Rebuild the model from the play history and publish it for the other workers."""
+    global recommendation_executor, recommendation_model_id
+    if recommendation_executor is None:
+        recommendation_executor = create_executor(1)
+    plays = await recommender.rebuild(
+        lambda until: storage.plays.iter_since(until - RECOMMENDATION_WINDOW, until), recommendation_executor
+    )
+    logger.info("Recommendation model rebuilt from %d plays over %d songs", plays, len(recommender))
+    data = await anyio.to_thread.run_sync(recommender.export)
+    recommendation_model_id = await storage.recommendation_models.save(data, recommender.built_until)
+
+async def install_recommendations(latest):
+    """Load the model another worker published, with the plays recorded since it was built."""
+    global recommendation_model_id
+    data = await storage.recommendation_models.load(latest["id"])
+    song_ids, model = await anyio.to_thread.run_sync(load_model, data)
+    await recommender.install(
+        song_ids, model, lambda until: storage.plays.iter_since(latest["built_until"], until)
+    )
+    recommendation_model_id = latest["id"]
+    logger.info("Installed the recommendation model built until %s over %d songs", latest["built_until"], len(song_ids))
+
+async def update_recommendations():
+    # One worker at a time rebuilds once the published model is due; the rest install it
+    latest = await storage.recommendation_models.latest()
+    due = latest is None or datetime.utcnow() - latest["built_until"] >= timedelta(seconds=RECOMMENDATION_REBUILD_INTERVAL)
+    if due and await recommendation_lock.acquire(wait=False):
+        try:
+            await rebuild_recommendations()
+        finally:
+            await recommendation_lock.release()
+    elif latest is not None and latest["id"] != recommendation_model_id:
+        await install_recommendations(latest)
+    if recommender.ready:
+        warmed.add("recommendations")
+
+async def refresh_recommendations():
+    retry_delay = RECOMMENDATION_RETRY_DELAY
+    while True:
+        try:
+            await update_recommendations()
+            retry_delay = RECOMMENDATION_RETRY_DELAY
+            # Until the first model arrives, check back as if retrying
+            delay = RECOMMENDATION_POLL_INTERVAL if recommender.ready else RECOMMENDATION_RETRY_DELAY
+        except Exception:
+            logger.exception("Updating the recommendation model failed")
+            # Retry soon, backing off, rather than staying unready (or stale) for a whole interval
+            delay = min(retry_delay, RECOMMENDATION_REBUILD_INTERVAL)
+            retry_delay *= 2
+        await asyncio.sleep(delay)
+
+@api_router.on_event("startup")
+async def start_recommendations():
+    global recommendation_lock
+    recommendation_lock = LeaderLock(storage.locks, "recommendations", ttl=STARTUP_LOCK_TTL)
+    app.state.recommendation_task = asyncio.create_task(refresh_recommendations())
+
+async def save_charts():
+    # Each checkpoint reads, merges and writes back every sketch; only one worker at a time
+    async with LeaderLock(storage.locks, "charts", ttl=STARTUP_LOCK_TTL):
+        await charts.checkpoint(storage.chart_sketches)
+
+async def checkpoint_charts():
+    while True:
+        await asyncio.sleep(CHARTS_CHECKPOINT_INTERVAL)
+        try:
+            await save_charts()
+        except Exception:
+            logger.exception("Checkpointing the charts failed")
+
+@api_router.on_event("startup")
+async def start_charts():
+    restored = await charts.restore(storage.chart_sketches)
+    logger.info("Restored %d chart sketches", restored)
+    app.state.charts_task = asyncio.create_task(checkpoint_charts())
+
+def open_catalog_snapshot():
+    """Map the snapshot file if it changed since this worker last did."""
+    global catalog_snapshot
+    if catalog_snapshot is not None and catalog_snapshot.same_file(CATALOG_SNAPSHOT_PATH):
+        return
+    try:
+        snapshot = CatalogSnapshot(CATALOG_SNAPSHOT_PATH)
+    except FileNotFoundError:
+        return
+    except (SnapshotError, ValueError, KeyError) as exc:
+        logger.warning("Ignoring catalog snapshot %s: %s", CATALOG_SNAPSHOT_PATH, exc)
+        return
+    if catalog_snapshot is None or snapshot.version >= catalog_snapshot.version:
+        # The old mapping stays alive until requests still reading it finish
+        catalog_snapshot = snapshot
+        logger.info("Mapped catalog snapshot at version %d with %d songs", snapshot.version, len(snapshot))
+
+async def refresh_catalog_snapshot():
+    # The file is per host, so is the export
+    lock = LeaderLock(storage.locks, f"catalog_snapshot:{socket.gethostname()}", ttl=STARTUP_LOCK_TTL)
+    while True:
+        try:
+            open_catalog_snapshot()
+            stale = catalog_snapshot is None or catalog_snapshot.version < content_versions["catalog"]
+            if stale and await lock.acquire(wait=False):
+                try:
+                    version = await export_snapshot(storage, CATALOG_SNAPSHOT_PATH)
+                    logger.info("Exported catalog snapshot at version %d", version)
+                finally:
+                    await lock.release()
+                open_catalog_snapshot()
+        except Exception:
+            logger.exception("Refreshing the catalog snapshot failed")
+        await asyncio.sleep(CATALOG_SNAPSHOT_REFRESH_INTERVAL)
+
+@api_router.on_event("startup")
+async def start_catalog_snapshot():
+    # Mapped before the search index and listing warm up so they can read from it
+    if CATALOG_SNAPSHOT_PATH:
+        open_catalog_snapshot()
+        app.state.catalog_snapshot_task = asyncio.create_task(refresh_catalog_snapshot())
+
+@api_router.on_event("startup")
+async def start_search_index():
+    # Runs after init_sample_data; searches fall back to a regex scan until ready
+    refresh_search_index()
+
+@api_router.on_event("startup")
+async def warm_catalog_cache():
+    # A current snapshot already serves the listing
+    if current_snapshot() is None:
+        await load_song_listing()
+    warmed.add("catalog_cache")
 
 # Auth endpoints
-@api_router.post("/auth/register", response_model=User)
+async def poll_revocations():
+    while True:
+        try:
+            await revoked_tokens.refresh(storage.revoked_tokens)
+        except Exception:
+            logger.exception("Refreshing revoked tokens failed")
+        await asyncio.sleep(TOKEN_REVOCATION_POLL_INTERVAL)
+
+@api_router.on_event("startup")
+async def start_revocation_polling():
+    app.state.revocation_task = asyncio.create_task(poll_revocations())
+
+async def hash_password(password: str) -> str:
+    try:
+        return await password_hasher.hash(password)
+    except HasherBusy:
+        raise HTTPException(status_code=503, detail="Too many sign-ins, retry later", headers={"Retry-After": "1"})
+
+async def verify_password(password: str, password_hash: Optional[str]):
+    try:
+        return await password_hasher.verify(password, password_hash)
+    except HasherBusy:
+        raise HTTPException(status_code=503, detail="Too many sign-ins, retry later", headers={"Retry-After": "1"})
+
+def start_session(user_obj: User) -> UserSession:
+    token, expires_at = tokens.issue(user_obj.id, username=user_obj.username, email=user_obj.email)
+    return UserSession(**user_obj.dict(), access_token=token, expires_at=expires_at)
+
+async def get_token_claims(credentials: Optional[HTTPAuthorizationCredentials] = Depends(bearer_scheme)) -> dict:
+    """Claims of a valid, unrevoked bearer token; checked without touching the database."""
+    unauthorized = HTTPException(
+        status_code=401, detail="Invalid or expired token", headers={"WWW-Authenticate": "Bearer"}
+    )
+    if credentials is None:
+        raise unauthorized
+    try:
+        claims = tokens.decode(credentials.credentials)
+    except InvalidToken:
+        raise unauthorized
+    if claims["jti"] in revoked_tokens:
+        raise unauthorized
+    return claims
+
+@api_router.post("/auth/register", response_model=UserSession)
 async def register(user: UserCreate):
     # Check if user exists
-    existing_user = await db.users.find_one({"email": user.email})
+    existing_user = await storage.users.find_by_email(user.email)
     if existing_user:
         raise HTTPException(status_code=400, detail="Email already registered")
     
     user_obj = User(username=user.username, email=user.email)
-    await db.users.insert_one(user_obj.dict())
-    return user_obj
+    password_hash = await hash_password(user.password)
+    try:
+        await storage.users.insert({**user_obj.dict(), "password_hash": password_hash})
+    except DuplicateKeyError:
+        raise HTTPException(status_code=400, detail="Email already registered")
+    return start_session(user_obj)
 
-@api_router.post("/auth/login", response_model=User)
+@api_router.post("/auth/login", response_model=UserSession)
 async def login(credentials: UserLogin):
-    user = await db.users.find_one({"email": credentials.email})
-    if not user:
+    user = await storage.users.find_by_email(credentials.email)
+    # Unknown emails are checked against a dummy hash so they take as long as wrong passwords
+    matches, new_hash = await verify_password(credentials.password, user.get("password_hash") if user else None)
+    if not matches:
         raise HTTPException(status_code=401, detail="Invalid credentials")
-    return User(**user)
+    if new_hash:
+        await storage.users.set_password_hash(user["id"], new_hash)
+    return start_session(User(**user))
+
+@api_router.post("/auth/logout")
+async def logout(claims: dict = Depends(get_token_claims)):
+    await revoked_tokens.revoke(storage.revoked_tokens, claims)
+    return {"message": "Logged out"}
+
+@api_router.get("/auth/me")
+async def get_me(claims: dict = Depends(get_token_claims)):
+    return {"id": claims["sub"], "username": claims.get("username"), "email": claims.get("email")}
 
 # Music endpoints
-@api_router.get("/songs", response_model=List[Song])
-async def get_songs():
-    songs = await db.songs.find().to_list(1000)
-    return [Song(**song) for song in songs]
+def json_response(payload, response: Optional[Response] = None) -> Response:
+    fast = Response(orjson.dumps(payload), media_type="application/json")
+    if response is not None:
+        fast.headers.raw.extend(response.headers.raw)
+    return fast
 
-@api_router.get("/songs/search")
-async def search_songs(q: str):
-    songs = await db.songs.find({
-        "$or": [
-            {"title": {"$regex": q, "$options": "i"}},
-            {"artist": {"$regex": q, "$options": "i"}},
-            {"album": {"$regex": q, "$options": "i"}},
-            {"genre": {"$regex": q, "$options": "i"}}
-        ]
-    }).to_list(100)
+def not_modified(request: Request, response: Response, etag: str) -> Optional[Response]:
+    """Tag the response with ``etag``; returns a bare 304 if the client already has it."""
+    response.headers["ETag"] = etag
+    response.headers["Cache-Control"] = VERSIONED_CACHE_CONTROL
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=dict(response.headers))
+    return None
+
+def catalog_etag(variant: str = "") -> str:
+    return f'"c{content_versions["catalog"]}{variant}"'
+
+def songs_response(songs: List[dict], response: Optional[Response] = None):
+    if FAST_SERIALIZATION:
+        return json_response(
+            [{field: song.get(field, default) for field, default in SONG_FIELD_DEFAULTS.items()} for song in songs],
+            response,
+        )
     return [Song(**song) for song in songs]
 
+def encode_cursor(song_id: str) -> str:
+    return base64.urlsafe_b64encode(song_id.encode()).decode().rstrip("=")
+
+def decode_cursor(token: str) -> str:
+    try:
+        return base64.b64decode(token + "=" * (-len(token) % 4), altchars=b"-_", validate=True).decode()
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+async def stream_songs(after_id: Optional[str]):
+    lines = []
+    source = current_snapshot() or storage.songs
+    async for song in source.iter_sorted(after_id, SONG_STREAM_BATCH_SIZE):
+        lines.append(Song(**song).json())
+        if len(lines) >= SONG_STREAM_BATCH_SIZE:
+            yield "\n".join(lines) + "\n"
+            lines = []
+    if lines:
+        yield "\n".join(lines) + "\n"
+
+async def load_song_listing():
+    """The full catalog sorted by id from the cache, loading it if it fits."""
+    listing = catalog_cache.listing()
+    if listing is None and not catalog_cache.listing_oversized():
+        songs = await storage.songs.find_page(None, catalog_cache.max_songs + 1)
+        listing = catalog_cache.set_listing(songs)
+    return listing
+
+@api_router.get("/songs", response_model=List[Song])
+async def get_songs(
+    request: Request,
+    response: Response,
+    after: Optional[str] = None,
+    limit: int = Query(SONG_PAGE_SIZE, ge=1, le=SONG_PAGE_SIZE),
+):
+    # Keyset pagination on the unique `id` index; `after` is the opaque
+    # X-Next-Cursor value from the previous page.
+    after_id = decode_cursor(after) if after else None
+    ndjson = NDJSON_MEDIA_TYPE in request.headers.get("accept", "")
+    response.headers["Vary"] = "Accept"
+    if cached := not_modified(request, response, catalog_etag("-ndjson" if ndjson else "")):
+        return cached
+    if ndjson:
+        # Stream the whole catalog (from `after` onwards) one song per line
+        return StreamingResponse(stream_songs(after_id), media_type=NDJSON_MEDIA_TYPE, headers=dict(response.headers))
+
+    snapshot = current_snapshot()
+    if snapshot is not None:
+        songs = await snapshot.find_page(after_id, limit)
+    elif (listing := await load_song_listing()) is not None:
+        ids, cached_songs = listing
+        start = bisect.bisect_right(ids, after_id) if after else 0
+        songs = cached_songs[start:start + limit]
+    else:
+        songs = await storage.songs.find_page(after_id, limit)
+    if len(songs) == limit:
+        response.headers["X-Next-Cursor"] = encode_cursor(songs[-1]["id"])
+    return songs_response(songs, response)
+
+async def fetch_songs(song_ids: List[str], fields: Optional[tuple]) -> List[dict]:
+    if catalog_snapshot is None:
+        return await storage.songs.find_many(song_ids, fields)
+    # Any snapshot has every song that existed when it was taken
+    songs = await catalog_snapshot.find_many(song_ids, fields)
+    if len(songs) < len(song_ids):
+        found = {song["id"] for song in songs}
+        songs += await storage.songs.find_many([song_id for song_id in song_ids if song_id not in found], fields)
+    return songs
+
+def get_song_loader() -> SongLoader:
+    """Per-request batched song lookups through the catalog cache."""
+    # Only the fields the Song model serves (stream and HLS use media_path from them too)
+    return SongLoader(fetch_songs, catalog_cache, fields=SONG_FIELDS, complete=True)
+
+@api_router.get("/songs/search", response_model=List[Song])
+async def search_songs(
+    request: Request,
+    response: Response,
+    q: str,
+    offset: int = Query(0, ge=0),
+    limit: int = Query(100, ge=1, le=100),
+    loader: SongLoader = Depends(get_song_loader),
+):
+    # The regex fallback matches and orders differently from the index, so the two get different ETags
+    ready = search_index.ready
+    if cached := not_modified(request, response, catalog_etag("-ranked" if ready else "-scan")):
+        return cached
+    if not ready:
+        songs = await storage.songs.scan(q, FIELD_WEIGHTS, offset, limit)
+        return songs_response(songs, response)
+
+    total, song_ids = search_index.search(q, offset=offset, limit=limit)
+    response.headers["X-Total-Count"] = str(total)
+    return songs_response(await loader.load_many(song_ids), response)
+
 @api_router.get("/songs/{song_id}", response_model=Song)
-async def get_song(song_id: str):
-    song = await db.songs.find_one({"id": song_id})
-    if not song:
+async def get_song(
+    song_id: str, request: Request, response: Response, loader: SongLoader = Depends(get_song_loader)
+):
+    # Songs never change once stored, but may not exist yet at an older version
+    if cached := not_modified(request, response, catalog_etag()):
+        return cached
+    song = await loader.load(song_id)
+    if song is None:
         raise HTTPException(status_code=404, detail="Song not found")
+    if FAST_SERIALIZATION:
+        return json_response(
+            {field: song.get(field, default) for field, default in SONG_FIELD_DEFAULTS.items()}, response
+        )
     return Song(**song)
 
+def local_media_path(song: dict) -> Path:
+    path = (MEDIA_DIR / song["media_path"]).resolve()
+    if MEDIA_DIR not in path.parents or not path.is_file():
+        raise HTTPException(status_code=404, detail="Audio file not found")
+    return path
+
+@api_router.api_route("/songs/{song_id}/stream", methods=["GET", "HEAD"])
+async def stream_song(song_id: str, request: Request, loader: SongLoader = Depends(get_song_loader)):
+    song = await loader.load(song_id)
+    if song is None:
+        raise HTTPException(status_code=404, detail="Song not found")
+    if not song.get("media_path"):
+        # Not stored locally; let the client fetch it from the original host
+        return RedirectResponse(song["audio_url"])
+    return RangeFileResponse(local_media_path(song), request.headers)
+
+async def package_media(path: Path):
+    global packaging_executor
+    if packaging_executor is None:
+        packaging_executor = create_executor(PACKAGING_WORKERS)
+    return await package(packaging_executor, path, SEGMENT_SECONDS)
+
+async def load_packaged_song(song_id: str, loader: SongLoader):
+    song = await loader.load(song_id)
+    if song is None:
+        raise HTTPException(status_code=404, detail="Song not found")
+    if not song.get("media_path"):
+        raise HTTPException(status_code=404, detail="Song is not stored locally")
+    path = local_media_path(song)
+    if not can_package(path):
+        # Byte slices of other formats are not decodable on their own
+        raise HTTPException(status_code=415, detail=f"HLS is only available for MP3 audio; use /api/songs/{song_id}/stream")
+    # Normally packaged right after upload; package on demand otherwise
+    index = load_segment_index(path, SEGMENT_SECONDS) or await package_media(path)
+    return path, index
+
+@api_router.get("/songs/{song_id}/hls/index.m3u8")
+async def get_song_manifest(
+    song_id: str, request: Request, response: Response, loader: SongLoader = Depends(get_song_loader)
+):
+    path, index = await load_packaged_song(song_id, loader)
+    # Revalidated rather than immutable: repackaging with other SEGMENT_SECONDS changes it
+    if cached := not_modified(request, response, f'"{path.name}-{index_tag(index)}"'):
+        return cached
+    return Response(
+        render_manifest(index, path.suffix),
+        media_type="application/vnd.apple.mpegurl",
+        headers=dict(response.headers),
+    )
+
+@api_router.get("/songs/{song_id}/hls/{segment_name}")
+async def get_song_segment(
+    song_id: str, segment_name: str, v: Optional[str] = None, loader: SongLoader = Depends(get_song_loader)
+):
+    path, index = await load_packaged_song(song_id, loader)
+    number, _, extension = segment_name.partition(".")
+    if not number.isdigit() or f".{extension}" != path.suffix or int(number) >= len(index["segments"]):
+        raise HTTPException(status_code=404, detail="Segment not found")
+    tag = index_tag(index)
+    if v is not None and v != tag:
+        # Listed by a manifest from an earlier packaging; its byte ranges no longer apply
+        raise HTTPException(status_code=404, detail="Segment not found")
+    data = await anyio.to_thread.run_sync(read_segment, path, index["segments"][int(number)])
+    return Response(
+        data,
+        media_type=mimetypes.guess_type(path.name)[0] or "application/octet-stream",
+        headers={"Cache-Control": IMMUTABLE_CACHE_CONTROL, "ETag": f'"{path.name}-{tag}-{number}"'},
+    )
+
+async def insert_song(song_obj: Song):
+    await storage.songs.insert(song_obj.dict())
+    catalog_cache.write_through(song_obj.dict())
+    search_index.add(song_obj.dict())
+    await storage.songs.add_to_summaries(summarize([song_obj.dict()]))
+    await content_versions.bump(storage.versions, "catalog")
+
+def build_song(row: dict) -> dict:
+    """Validate a feed row as SongCreate and return the document to insert."""
+    return Song(**SongCreate(**row).dict()).dict()
+
+@api_router.post("/songs/import")
+async def import_song_feed(request: Request, format: Optional[Literal["ndjson", "csv"]] = None):
+    # Streamed from the request body; the format defaults to the Content-Type
+    feed_format = format or ("csv" if "csv" in request.headers.get("content-type", "") else "ndjson")
+    report = new_report()
+    try:
+        return await import_songs(
+            storage.songs, iter_records(request.stream(), feed_format), build_song,
+            on_batch=search_index.add_many, report=report,
+        )
+    finally:
+        # Also when the import fails part way (or the client goes away): earlier batches are in
+        if report["inserted"]:
+            catalog_cache.invalidate_listing()
+            await content_versions.bump(storage.versions, "catalog")
+
 @api_router.post("/songs", response_model=Song)
 async def create_song(song: SongCreate):
     song_obj = Song(**song.dict())
-    await db.songs.insert_one(song_obj.dict())
+    await insert_song(song_obj)
+    return song_obj
+
+@api_router.post("/songs/upload", response_model=Song)
+async def upload_song(
+    background_tasks: BackgroundTasks,
+    file: UploadFile = File(...),
+    title: str = Form(...),
+    artist: str = Form(...),
+    album: str = Form(...),
+    genre: str = Form(...),
+    cover_art: str = Form(""),
+    duration: Optional[int] = Form(None),
+):
+    suffix = Path(file.filename or "").suffix.lower()
+    if suffix not in AUDIO_EXTENSIONS:
+        raise HTTPException(status_code=415, detail="Unsupported audio format")
+
+    content_hash, media_path = await save_upload(file, MEDIA_DIR, suffix)
+    existing = await storage.songs.find_by_content_hash(content_hash)
+    if existing:
+        return Song(**existing)
+
+    probed = await anyio.to_thread.run_sync(probe_duration, MEDIA_DIR / media_path)
+    if probed is None and duration is None:
+        (MEDIA_DIR / media_path).unlink(missing_ok=True)
+        raise HTTPException(status_code=422, detail="Could not determine the duration; pass `duration`")
+
+    song_obj = Song(
+        title=title,
+        artist=artist,
+        album=album,
+        genre=genre,
+        cover_art=cover_art,
+        duration=round(probed) if probed is not None else duration,
+        audio_url="",
+        media_path=media_path,
+        content_hash=content_hash,
+    )
+    song_obj.audio_url = f"/api/songs/{song_obj.id}/stream"
+    try:
+        await insert_song(song_obj)
+    except DuplicateKeyError:
+        # An identical upload finished first
+        existing = await storage.songs.find_by_content_hash(content_hash)
+        return Song(**existing)
+    if can_package(media_path):
+        background_tasks.add_task(package_media, MEDIA_DIR / media_path)
     return song_obj
 
+@api_router.get("/cache/stats")
+async def get_cache_stats():
+    stats = catalog_cache.stats()
+    if catalog_snapshot is not None:
+        stats["snapshot"] = {**catalog_snapshot.stats(), "current": current_snapshot() is not None}
+    return stats
+
 # Playlist endpoints
 @api_router.get("/playlists", response_model=List[Playlist])
-async def get_playlists(user_id: Optional[str] = None):
-    query = {"user_id": user_id} if user_id else {"is_public": True}
-    playlists = await db.playlists.find(query).to_list(100)
+async def get_playlists(request: Request, response: Response, user_id: Optional[str] = None):
+    if cached := not_modified(request, response, f'"l{content_versions["playlists"]}"'):
+        return cached
+    playlists = await storage.playlists.list(user_id, 100)
     return [Playlist(**playlist) for playlist in playlists]
 
 @api_router.post("/playlists", response_model=Playlist)
 async def create_playlist(playlist: PlaylistCreate):
     playlist_obj = Playlist(**playlist.dict())
-    await db.playlists.insert_one(playlist_obj.dict())
+    await storage.playlists.insert(playlist_obj.dict())
+    await content_versions.bump(storage.versions, "playlists", [playlist_obj.id])
     return playlist_obj
 
 @api_router.get("/playlists/{playlist_id}", response_model=Playlist)
-async def get_playlist(playlist_id: str):
-    playlist = await db.playlists.find_one({"id": playlist_id})
+async def get_playlist(playlist_id: str, request: Request, response: Response):
+    revision = content_versions.playlist_revision(playlist_id)
+    if revision is not None and (cached := not_modified(request, response, f'"p{revision}"')):
+        return cached
+    as_of = content_versions["playlists"]
+    playlist = await storage.playlists.get(playlist_id)
     if not playlist:
         raise HTTPException(status_code=404, detail="Playlist not found")
+    revision = playlist.get("revision", 0)
+    content_versions.remember_revision(playlist_id, revision, as_of)
+    if cached := not_modified(request, response, f'"p{revision}"'):
+        return cached
     return Playlist(**playlist)
 
+async def playlist_changed(playlist_id: str):
+    await content_versions.bump(storage.versions, "playlists", [playlist_id])
+
 @api_router.put("/playlists/{playlist_id}/songs/{song_id}")
 async def add_song_to_playlist(playlist_id: str, song_id: str):
-    playlist = await db.playlists.find_one({"id": playlist_id})
-    if not playlist:
+    if await storage.playlists.add_song(playlist_id, song_id):
+        await playlist_changed(playlist_id)
+    elif not await storage.playlists.exists(playlist_id):
         raise HTTPException(status_code=404, detail="Playlist not found")
-    
-    if song_id not in playlist.get("song_ids", []):
-        await db.playlists.update_one(
-            {"id": playlist_id},
-            {"$push": {"song_ids": song_id}}
-        )
     return {"message": "Song added to playlist"}
 
 @api_router.delete("/playlists/{playlist_id}/songs/{song_id}")
 async def remove_song_from_playlist(playlist_id: str, song_id: str):
-    await db.playlists.update_one(
-        {"id": playlist_id},
-        {"$pull": {"song_ids": song_id}}
-    )
+    if await storage.playlists.remove_song(playlist_id, song_id):
+        await playlist_changed(playlist_id)
     return {"message": "Song removed from playlist"}
 
+@api_router.post("/playlists/bulk")
+async def bulk_update_playlists(batch: PlaylistBulkUpdate):
+    playlist_ids = list(dict.fromkeys(operation.playlist_id for operation in batch.operations))
+    playlists = await storage.playlists.find_states(playlist_ids)
+    missing = [playlist_id for playlist_id in playlist_ids if playlist_id not in playlists]
+    if missing:
+        raise HTTPException(status_code=404, detail={"message": "Playlist not found", "playlist_ids": missing})
+    conflicts = [
+        playlist_id for playlist_id, revision in batch.expected_revisions.items()
+        if playlist_id in playlists and playlists[playlist_id].get("revision", 0) != revision
+    ]
+    if conflicts:
+        raise HTTPException(status_code=409, detail={"message": "Playlist revision changed", "playlist_ids": conflicts})
+
+    try:
+        revisions, updates = plan_updates(playlists, batch.operations)
+    except PlaylistOperationError as error:
+        raise HTTPException(status_code=422, detail=str(error))
+    if updates:
+        try:
+            await storage.playlists.apply_updates(updates)
+        except PlaylistRevisionConflict as conflict:
+            # A concurrent writer changed some playlists between our read and write; nothing applied
+            if conflict.changed:
+                await content_versions.bump(storage.versions, "playlists", conflict.changed)
+            raise HTTPException(
+                status_code=409, detail={"message": "Playlist revision changed", "playlist_ids": conflict.playlist_ids}
+            )
+        await content_versions.bump(storage.versions, "playlists", list(revisions))
+    return {"revisions": revisions}
+
 @api_router.get("/playlists/{playlist_id}/songs", response_model=List[Song])
-async def get_playlist_songs(playlist_id: str):
-    playlist = await db.playlists.find_one({"id": playlist_id})
-    if not playlist:
+async def get_playlist_songs(
+    playlist_id: str,
+    request: Request,
+    response: Response,
+    offset: int = Query(0, ge=0),
+    limit: int = Query(PLAYLIST_PAGE_SIZE, ge=1, le=PLAYLIST_PAGE_SIZE),
+    loader: SongLoader = Depends(get_song_loader),
+):
+    # Songs listed by a playlist may be added to the catalog later, hence both versions
+    catalog_version, as_of = content_versions["catalog"], content_versions["playlists"]
+    revision = content_versions.playlist_revision(playlist_id)
+    if revision is not None and (cached := not_modified(request, response, f'"c{catalog_version}-p{revision}"')):
+        return cached
+    window = await storage.playlists.song_window(playlist_id, offset, limit)
+    if window is None:
         raise HTTPException(status_code=404, detail="Playlist not found")
+    revision = window["revision"]
+    content_versions.remember_revision(playlist_id, revision, as_of)
+    if cached := not_modified(request, response, f'"c{catalog_version}-p{revision}"'):
+        return cached
     
-    song_ids = playlist.get("song_ids", [])
-    songs = await db.songs.find({"id": {"$in": song_ids}}).to_list(1000)
-    return [Song(**song) for song in songs]
+    response.headers["X-Total-Count"] = str(window["total"])
+    # Playlist order, duplicates included
+    songs = await loader.load_many(window["song_ids"])
+    return songs_response(songs, response)
 
 # Play history
 @api_router.post("/play-history")
 async def record_play(user_id: str, song_id: str):
     play_record = PlayHistory(user_id=user_id, song_id=song_id)
-    await db.play_history.insert_one(play_record.dict())
+    try:
+        await play_buffer.add(play_record.dict())
+    except BufferFull:
+        raise HTTPException(status_code=503, detail="Play history is overloaded, retry later")
+    recently_played.record(play_record.dict())
     return {"message": "Play recorded"}
 
+async def recent_plays(user_id: str) -> List[dict]:
+    history = recently_played.get(user_id)
+    if history is not None:
+        return history
+    history = await storage.plays.recent(user_id, PLAY_HISTORY_LIMIT)
+    return recently_played.warm(user_id, history)
+
 @api_router.get("/play-history/{user_id}")
-async def get_play_history(user_id: str):
-    history = await db.play_history.find({"user_id": user_id}).sort("played_at", -1).limit(50).to_list(50)
+async def get_play_history(
+    user_id: str,
+    include_songs: bool = False,
+    loader: SongLoader = Depends(get_song_loader),
+):
+    history = await recent_plays(user_id)
     # Convert MongoDB documents to dictionaries to ensure JSON serialization
-    return [
+    items = [
         {
             "id": item.get("id"),
             "user_id": item.get("user_id"),
@@ -304,30 +1141,125 @@ async def get_play_history(user_id: str):
         } 
         for item in history
     ]
+    if include_songs:
+        # One batched lookup through the catalog cache; `song` is null for deleted songs
+        songs = await asyncio.gather(*(loader.load(item["song_id"]) for item in items))
+        for item, song in zip(items, songs):
+            item["song"] = Song(**song) if song is not None else None
+    return items
+
+@api_router.get("/play-history/{user_id}/daily")
+async def get_user_daily_plays(user_id: str, days: int = Query(30, ge=1, le=366)):
+    return await storage.plays.daily_for_user(user_id, days)
+
+@api_router.get("/songs/{song_id}/daily-plays")
+async def get_song_daily_plays(song_id: str, days: int = Query(30, ge=1, le=366)):
+    return await storage.plays.daily_for_song(song_id, days)
+
+# Recommendations
+@api_router.get("/recommendations/{user_id}", response_model=List[Song])
+async def get_recommendations(
+    user_id: str,
+    response: Response,
+    limit: int = Query(20, ge=1, le=100),
+    loader: SongLoader = Depends(get_song_loader),
+):
+    if not recommender.ready:
+        raise HTTPException(status_code=503, detail="Recommendations are still being built", headers={"Retry-After": "5"})
+    # Neighbours of the user's most recent distinct songs, excluding those songs
+    seeds = list(dict.fromkeys(play["song_id"] for play in await recent_plays(user_id)))[:RECOMMENDATION_SEEDS]
+    ranked = recommender.recommend(seeds, limit=limit, exclude=seeds)
+    songs = await loader.load_many([song_id for song_id, _ in ranked])
+    return songs_response(songs, response)
+
+# Charts
+@api_router.get("/charts/{dimension}")
+async def get_chart(
+    dimension: Literal["songs", "artists", "genres"],
+    response: Response,
+    window: Literal["1h", "24h", "7d"] = "24h",
+    limit: int = Query(20, ge=1, le=100),
+    loader: SongLoader = Depends(get_song_loader),
+):
+    # Estimated play counts over the window, straight from the in-memory sketches
+    ranked = charts.top(CHART_DIMENSIONS[dimension], window, limit)
+    if dimension != "songs":
+        return [{"name": name, "plays": plays} for name, plays in ranked]
+    songs = await loader.load_many([song_id for song_id, _ in ranked])
+    plays = dict(ranked)
+    return [{"song": Song(**song), "plays": plays[song["id"]]} for song in songs]
 
 # Artists and Albums
+async def list_summaries(
+    collection: str, request: Request, response: Response, after: Optional[str], limit: int, key_fields: List[str]
+):
+    if cached := not_modified(request, response, catalog_etag()):
+        return cached
+    # Keyset pagination over the summary's unique key; the cursor encodes the
+    # key values of the last item on the previous page.
+    last_key = None
+    if after:
+        try:
+            last_key = json.loads(decode_cursor(after))
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+        # Key values are strings; anything else could not have come from X-Next-Cursor
+        if (
+            not isinstance(last_key, list) or len(last_key) != len(key_fields)
+            or not all(isinstance(value, str) for value in last_key)
+        ):
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+    items = await (current_snapshot() or storage.songs).summaries_page(collection, last_key, limit)
+    if len(items) == limit:
+        response.headers["X-Next-Cursor"] = encode_cursor(json.dumps([items[-1][field] for field in key_fields]))
+    if FAST_SERIALIZATION:
+        return json_response(items, response)
+    return items
+
 @api_router.get("/artists")
-async def get_artists():
-    artists = await db.songs.distinct("artist")
-    return [{"name": artist} for artist in artists]
+async def get_artists(
+    request: Request,
+    response: Response,
+    after: Optional[str] = None,
+    limit: int = Query(SUMMARY_PAGE_SIZE, ge=1, le=SUMMARY_PAGE_SIZE),
+):
+    return await list_summaries("artists", request, response, after, limit, ["name"])
 
 @api_router.get("/albums")
-async def get_albums():
-    pipeline = [
-        {"$group": {
-            "_id": "$album",
-            "artist": {"$first": "$artist"},
-            "cover_art": {"$first": "$cover_art"},
-            "song_count": {"$sum": 1}
-        }}
-    ]
-    albums = await db.songs.aggregate(pipeline).to_list(100)
-    return [{"name": album["_id"], "artist": album["artist"], "cover_art": album["cover_art"], "song_count": album["song_count"]} for album in albums]
+async def get_albums(
+    request: Request,
+    response: Response,
+    after: Optional[str] = None,
+    limit: int = Query(SUMMARY_PAGE_SIZE, ge=1, le=SUMMARY_PAGE_SIZE),
+):
+    return await list_summaries("albums", request, response, after, limit, ["name", "artist"])
 
 @api_router.get("/genres")
-async def get_genres():
-    genres = await db.songs.distinct("genre")
-    return [{"name": genre} for genre in genres]
+async def get_genres(
+    request: Request,
+    response: Response,
+    after: Optional[str] = None,
+    limit: int = Query(SUMMARY_PAGE_SIZE, ge=1, le=SUMMARY_PAGE_SIZE),
+):
+    return await list_summaries("genres", request, response, after, limit, ["name"])
+
+# Health probes. Liveness only shows the event loop is answering; readiness
+# also waits for startup and the caches, so traffic goes to warm workers.
+@api_router.get("/health/live")
+async def get_liveness():
+    return {"status": "ok"}
+
+@api_router.get("/health/ready")
+async def get_readiness(response: Response):
+    checks = {name: name in warmed for name in READINESS_CHECKS}
+    ready = all(checks.values())
+    if not ready:
+        response.status_code = 503
+    return {"status": "ready" if ready else "starting", "checks": checks}
+
+@api_router.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    return PlainTextResponse(REGISTRY.render(), media_type=METRICS_CONTENT_TYPE)
 
 # Include the router in the main app
 app.include_router(api_router)
@@ -338,7 +1270,16 @@ app.add_middleware(
     allow_origins=["*"],
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "X-Total-Count"],
 )
+# Added last so it wraps everything else, CORS preflights included
+app.add_middleware(MetricsMiddleware)
+
+@app.exception_handler(WaitQueueTimeoutError)
+async def connection_pool_exhausted(request: Request, exc: WaitQueueTimeoutError):
+    return JSONResponse(
+        status_code=503, content={"detail": "Database is overloaded, retry later"}, headers={"Retry-After": "1"}
+    )
 
 # Configure logging
 logging.basicConfig(
@@ -349,4 +1290,22 @@ logger = logging.getLogger(__name__)
 
 @app.on_event("shutdown")
 async def shutdown_db_client():
-    client.close()
\ No newline at end of file
+    global packaging_executor, recommendation_executor
+    app.state.search_index_task.cancel()
+    app.state.recommendation_task.cancel()
+    app.state.charts_task.cancel()
+    app.state.revocation_task.cancel()
+    if CATALOG_SNAPSHOT_PATH:
+        app.state.catalog_snapshot_task.cancel()
+    await content_versions.stop()
+    # Write out any buffered plays before the connection goes away
+    await play_buffer.stop()
+    await save_charts()
+    if packaging_executor is not None:
+        packaging_executor.shutdown(wait=False, cancel_futures=True)
+        packaging_executor = None
+    if recommendation_executor is not None:
+        recommendation_executor.shutdown(wait=False, cancel_futures=True)
+        recommendation_executor = None
+    password_hasher.shutdown()
+    storage.close()
\ No newline at end of file
@@ -0,0 +1,71 @@
+"""Per-request batched song resolver.
+
+``SongLoader`` works like a DataLoader: every ``load`` issued during the same
+event-loop turn is coalesced into one dispatch that serves what it can from
+the shared ``CatalogCache`` and fetches the rest with ``$in`` queries of at
+most ``max_batch_size`` ids. Results are memoized for the life of the loader,
+so create one per request.
+"""
+import asyncio
+
+
+class SongLoader:
+    def __init__(self, fetch_many, cache=None, fields=None, max_batch_size=1000, complete=False):
+        """``fetch_many(ids, fields)`` returns the song documents for ``ids``.
+
+        With ``fields`` only those song fields are fetched from storage; such
+        partial documents are not written back to the cache, unless
+        ``complete`` says ``fields`` covers every field a cached song needs.
+        """
+        self._fetch_many = fetch_many
+        self._cache = cache
+        self._fields = tuple(fields) if fields is not None else None
+        self._partial = fields is not None and not complete
+        self.max_batch_size = max_batch_size
+        self._futures = {}
+        self._pending = []
+        self._dispatch_scheduled = False
+        self._dispatch_task = None
+
+    def load(self, song_id):
+        """A future resolving to the song document, or None if it does not exist."""
+        future = self._futures.get(song_id)
+        if future is None:
+            loop = asyncio.get_running_loop()
+            future = self._futures[song_id] = loop.create_future()
+            self._pending.append(song_id)
+            if not self._dispatch_scheduled:
+                self._dispatch_scheduled = True
+                loop.call_soon(self._schedule_dispatch)
+        return future
+
+    async def load_many(self, song_ids):
+        """Songs for ``song_ids`` in the same order, duplicates included; missing ids are dropped."""
+        songs = await asyncio.gather(*(self.load(song_id) for song_id in song_ids))
+        return [song for song in songs if song is not None]
+
+    def _schedule_dispatch(self):
+        # Runs one loop turn after the first load, once callers have queued theirs
+        self._dispatch_task = asyncio.ensure_future(self._dispatch())
+
+    async def _dispatch(self):
+        song_ids, self._pending = self._pending, []
+        self._dispatch_scheduled = False
+        try:
+            if self._cache is not None:
+                found, missing = self._cache.get_many(song_ids)
+            else:
+                found, missing = {}, song_ids
+            for start in range(0, len(missing), self.max_batch_size):
+                fetched = await self._fetch_many(missing[start:start + self.max_batch_size], self._fields)
+                if self._cache is not None and not self._partial:
+                    self._cache.put_many(fetched)
+                found.update((song["id"], song) for song in fetched)
+        except Exception as exc:
+            for song_id in song_ids:
+                if not self._futures[song_id].done():
+                    self._futures[song_id].set_exception(exc)
+            return
+        for song_id in song_ids:
+            if not self._futures[song_id].done():
+                self._futures[song_id].set_result(found.get(song_id))
@@ -0,0 +1,665 @@
+"""Storage repositories backed by MongoDB (Motor).
+
+Handlers reach the database only through a storage object exposing one
+repository per kind of data: ``songs`` (with the artist/album/genre
+summaries), ``users``, ``playlists``, ``plays`` (with the daily rollups),
+``versions``, ``revoked_tokens``, ``chart_sketches``, ``recommendation_models`` and ``locks``. ``MongoStorage``
+implements them with the queries the handlers used to issue themselves;
+``memory_storage.MemoryStorage`` implements the same methods in process.
+
+Documents go in and come out as plain dicts without ``_id``. Writes that
+would break a unique key raise ``pymongo.errors.DuplicateKeyError``.
+
+Writes always go to the primary. Catalog, analytics and playlist reads can
+be routed elsewhere in a replica set through ``ReadRouter``; everything else
+(users, versions, locks, and the reads write paths depend on) reads from the
+primary. To see where reads go against a replica set (a single host started
+with ``--replSet`` will do), run with the server's settings:
+
+    python storage.py check-reads
+"""
+import argparse
+import asyncio
+import re
+import sys
+import time
+import uuid
+from contextlib import asynccontextmanager
+from datetime import datetime
+
+from bson import ObjectId
+from motor.motor_asyncio import AsyncIOMotorGridFSBucket
+from pymongo import ReturnDocument
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+from pymongo.read_concern import ReadConcern
+from pymongo.read_preferences import Nearest, Primary, PrimaryPreferred, Secondary, SecondaryPreferred
+
+from aggregates import SUMMARIES, ensure_summaries, write_summaries
+from indexes import ensure_indexes
+from metrics import mongo_reads, mongo_server_commands
+from play_history import (
+    daily_plays, iter_bucket_plays, raise_unless_duplicates, recent_plays_from_buckets, record_daily_plays,
+    write_play_buckets,
+)
+from playlist_ops import PlaylistRevisionConflict, mongo_update, revert_update
+from versioning import VERSION_LOG_SIZE
+
+
+READ_PREFERENCES = {
+    "primary": Primary,
+    "primaryPreferred": PrimaryPreferred,
+    "secondary": Secondary,
+    "secondaryPreferred": SecondaryPreferred,
+    "nearest": Nearest,
+}
+READ_KINDS = ("catalog", "analytics", "playlists")
+
+
+def read_policy(mode, read_concern="", max_staleness=-1):
+    """``(mode, read preference, read concern)`` from a mode name such as ``secondaryPreferred``.
+
+    An empty ``read_concern`` keeps the server default; ``max_staleness`` (in
+    seconds, -1 for none) applies to the modes that may read a secondary.
+    """
+    if mode not in READ_PREFERENCES:
+        raise ValueError(f"Unknown read preference {mode!r}; expected one of {', '.join(READ_PREFERENCES)}")
+    preference = Primary() if mode == "primary" else READ_PREFERENCES[mode](max_staleness=max_staleness)
+    return mode, preference, ReadConcern(read_concern or None)
+
+
+class ReadRouter:
+    """Picks where each kind of read (``READ_KINDS``) goes.
+
+    ``policies`` maps a kind to a ``read_policy``; kinds without one read
+    from the primary with the server's read concern. The handlers' ETags count
+    a write as soon as it lands, so a secondary that has not replicated it
+    yet must not answer for it: after a write, or once another process's
+    write is noticed, reads of what changed are pinned to the primary for
+    ``pin_seconds``, by which time any secondary within the max staleness
+    has it. Pins taken by a write in a session also carry its cluster and
+    operation times, and the pinned read runs in a causally consistent
+    session advanced past them.
+
+    Pins live in the process that takes them. Another worker pins only once
+    its ``versioning.ContentVersions`` poll notices the write, so until then
+    (up to the poll interval) it may still send reads of what changed,
+    including the writing user's next request, to a secondary that has not
+    replicated the write; and its pins carry no session times.
+    """
+
+    def __init__(self, client, db, policies=None, pin_seconds=100.0):
+        self.client = client
+        self.db = db
+        self.pin_seconds = pin_seconds
+        self._routes = {}  # kind -> (mode, database handle)
+        for kind, (mode, preference, read_concern) in (policies or {}).items():
+            if mode != "primary" or read_concern.level is not None:
+                self._routes[kind] = (mode, db.with_options(read_preference=preference, read_concern=read_concern))
+        self._pins = {}  # key -> (until, cluster_time, operation_time), oldest first
+
+    def mode(self, kind):
+        """The read preference mode reads of ``kind`` are sent with when not pinned."""
+        return self._routes[kind][0] if kind in self._routes else "primary"
+
+    def routed(self, kind):
+        """Whether reads of ``kind`` may leave the primary."""
+        return self.mode(kind) != "primary"
+
+    def pin(self, keys, session=None):
+        """Send reads of ``keys`` to the primary for ``pin_seconds``, after ``session``'s writes if given."""
+        now = time.monotonic()
+        times = (session.cluster_time, session.operation_time) if session is not None else (None, None)
+        entry = (now + self.pin_seconds, *times)
+        for key in keys:
+            self._pins.pop(key, None)
+            self._pins[key] = entry
+        # Every pin lasts as long, so expired ones are at the front
+        while self._pins:
+            key = next(iter(self._pins))
+            if self._pins[key][0] > now:
+                break
+            del self._pins[key]
+
+    def _pinned(self, keys):
+        now = time.monotonic()
+        for key in keys:
+            pin = self._pins.get(key)
+            if pin is not None and pin[0] > now:
+                return pin
+        return None
+
+    @asynccontextmanager
+    async def reading(self, kind, *keys):
+        """Yield ``(db, session)`` for a read of ``kind``; ``keys`` name what is read, most specific first."""
+        mode, db = self._routes.get(kind, ("primary", self.db))
+        if not self.routed(kind):
+            mongo_reads.inc(kind, mode)
+            yield db, None
+            return
+        pin = self._pinned((*keys, kind))
+        if pin is None:
+            mongo_reads.inc(kind, mode)
+            yield db, None
+            return
+        mongo_reads.inc(kind, "pinned")
+        _, cluster_time, operation_time = pin
+        if operation_time is None:
+            yield self.db, None
+            return
+        async with await self.client.start_session(causal_consistency=True) as session:
+            session.advance_cluster_time(cluster_time)
+            session.advance_operation_time(operation_time)
+            yield self.db, session
+
+    def transactions_supported(self):
+        """Whether the deployment is a replica set or sharded cluster, as far as the client has seen."""
+        return self.client.topology_description.topology_type_name in ("ReplicaSetWithPrimary", "Sharded")
+
+    async def transaction(self, kind, keys, write):
+        """Run ``write(session)`` in a transaction, retried on transient errors, then pin ``keys``.
+
+        Outside a replica set or sharded cluster there are no transactions, so
+        it runs as a plain ``writing`` block.
+        """
+        if not self.transactions_supported():
+            async with self.writing(kind, keys) as session:
+                return await write(session)
+        async with await self.client.start_session(causal_consistency=True) as session:
+            try:
+                return await session.with_transaction(write)
+            finally:
+                self.pin(keys, session)
+
+    @asynccontextmanager
+    async def writing(self, kind, keys):
+        """Yield a session for a write, then pin ``keys``; the session is None if reads of ``kind`` stay on the primary."""
+        if not self.routed(kind):
+            yield None
+            return
+        async with await self.client.start_session(causal_consistency=True) as session:
+            try:
+                yield session
+            finally:
+                # A standalone server reports no operation time; the pin alone has to do
+                self.pin(keys, session if session.operation_time is not None else None)
+
+
+# ``applied_writes`` is bookkeeping for ``MongoPlaylists.apply_updates``
+PLAYLIST_PROJECTION = {"_id": 0, "applied_writes": 0}
+
+
+def _projection(fields):
+    return {"_id": 0} if fields is None else {"_id": 0, "id": 1, **{field: 1 for field in fields}}
+
+
+class MongoSongs:
+    """Songs and summaries; listings, lookups and searches are catalog reads for the router."""
+
+    def __init__(self, db, router):
+        self.db = db
+        self.router = router
+
+    async def count(self):
+        return await self.db.songs.count_documents({})
+
+    async def insert(self, song):
+        await self.db.songs.insert_one(dict(song))
+        self.router.pin(["catalog"])
+
+    async def insert_many(self, songs):
+        """Insert what can be inserted; returns ``{index: error message}`` for the rest."""
+        try:
+            await self.db.songs.insert_many([dict(song) for song in songs], ordered=False)
+        except BulkWriteError as exc:
+            return {error["index"]: error.get("errmsg", "Write failed") for error in exc.details["writeErrors"]}
+        finally:
+            self.router.pin(["catalog"])
+        return {}
+
+    async def find_page(self, after_id, limit):
+        """Up to ``limit`` songs with ids after ``after_id`` (all if None), sorted by id."""
+        query = {"id": {"$gt": after_id}} if after_id is not None else {}
+        async with self.router.reading("catalog") as (db, session):
+            return await db.songs.find(query, {"_id": 0}, session=session).sort("id", 1).limit(limit).to_list(limit)
+
+    async def iter_sorted(self, after_id=None, batch_size=500):
+        query = {"id": {"$gt": after_id}} if after_id is not None else {}
+        async with self.router.reading("catalog") as (db, session):
+            async for song in db.songs.find(query, {"_id": 0}, session=session).sort("id", 1).batch_size(batch_size):
+                yield song
+
+    async def iter_fields(self, fields, batch_size=5000):
+        """Every song, with only ``id`` and ``fields``, in no particular order."""
+        async with self.router.reading("catalog") as (db, session):
+            async for song in db.songs.find({}, _projection(fields), session=session).batch_size(batch_size):
+                yield song
+
+    async def iter_inserted_since(self, since, fields, batch_size=5000):
+        """Songs inserted at or after ``since`` by their ``_id`` timestamp, with only ``id`` and ``fields``.
+
+        The timestamp is the inserting client's clock, so callers allow for skew.
+        """
+        query = {"_id": {"$gte": ObjectId.from_datetime(since)}}
+        async with self.router.reading("catalog") as (db, session):
+            async for song in db.songs.find(query, _projection(fields), session=session).batch_size(batch_size):
+                yield song
+
+    async def find_many(self, song_ids, fields=None):
+        """The songs with these ids, in no particular order; with ``fields`` only those (and ``id``)."""
+        async with self.router.reading("catalog") as (db, session):
+            cursor = db.songs.find({"id": {"$in": song_ids}}, _projection(fields), session=session)
+            return await cursor.to_list(len(song_ids))
+
+    async def find_by_content_hash(self, content_hash):
+        return await self.db.songs.find_one({"content_hash": content_hash}, {"_id": 0})
+
+    async def scan(self, text, fields, offset, limit):
+        """Songs with ``text`` in any of ``fields`` (case-insensitive), by a full scan."""
+        pattern = re.escape(text)
+        async with self.router.reading("catalog") as (db, session):
+            return await db.songs.find(
+                {"$or": [{field: {"$regex": pattern, "$options": "i"}} for field in fields]}, {"_id": 0},
+                session=session,
+            ).skip(offset).to_list(limit)
+
+    async def add_to_summaries(self, summaries):
+        """Fold ``aggregates.summarize`` output into the artist/album/genre summaries."""
+        await write_summaries(self.db, summaries)
+        self.router.pin(["catalog"])
+
+    async def ensure_summaries(self):
+        return await ensure_summaries(self.db)
+
+    async def summaries_page(self, collection, after_key, limit):
+        """Summaries sorted by their key fields, starting after the key values ``after_key``."""
+        key_fields = [summary_field for summary_field, _ in SUMMARIES[collection]]
+        query = {}
+        if after_key is not None:
+            query = {"$or": [
+                {**dict(zip(key_fields[:i], after_key[:i])), key_fields[i]: {"$gt": after_key[i]}}
+                for i in range(len(key_fields))
+            ]}
+        sort = [(field, 1) for field in key_fields]
+        async with self.router.reading("catalog") as (db, session):
+            return await db[collection].find(query, {"_id": 0}, session=session).sort(sort).limit(limit).to_list(limit)
+
+
+class MongoUsers:
+    def __init__(self, db):
+        self.db = db
+
+    async def find_by_email(self, email):
+        return await self.db.users.find_one({"email": email}, {"_id": 0})
+
+    async def insert(self, user):
+        await self.db.users.insert_one(dict(user))
+
+    async def set_password_hash(self, user_id, password_hash):
+        await self.db.users.update_one({"id": user_id}, {"$set": {"password_hash": password_hash}})
+
+
+class MongoPlaylists:
+    """Playlists; reads are playlist reads for the router, pinned per playlist after its writes."""
+
+    def __init__(self, db, router):
+        self.db = db
+        self.router = router
+
+    @staticmethod
+    def pin_keys(playlist_ids):
+        """Router keys to pin after writing ``playlist_ids``.
+
+        Listings cover every playlist, so any write pins them along with the playlists written.
+        """
+        return ["playlist_listings", *(("playlist", playlist_id) for playlist_id in playlist_ids)]
+
+    def _writing(self, playlist_ids):
+        return self.router.writing("playlists", self.pin_keys(playlist_ids))
+
+    async def list(self, user_id=None, limit=100):
+        """A user's playlists, or the public ones without ``user_id``."""
+        query = {"user_id": user_id} if user_id else {"is_public": True}
+        async with self.router.reading("playlists", "playlist_listings") as (db, session):
+            return await db.playlists.find(query, PLAYLIST_PROJECTION, session=session).to_list(limit)
+
+    async def insert(self, playlist):
+        async with self._writing([playlist["id"]]) as session:
+            await self.db.playlists.insert_one(dict(playlist), session=session)
+
+    async def get(self, playlist_id):
+        async with self.router.reading("playlists", ("playlist", playlist_id)) as (db, session):
+            return await db.playlists.find_one({"id": playlist_id}, PLAYLIST_PROJECTION, session=session)
+
+    async def exists(self, playlist_id):
+        return bool(await self.db.playlists.count_documents({"id": playlist_id}, limit=1))
+
+    async def add_song(self, playlist_id, song_id):
+        """Append the song unless present; returns whether the playlist changed."""
+        async with self._writing([playlist_id]) as session:
+            result = await self.db.playlists.update_one(
+                {"id": playlist_id, "song_ids": {"$ne": song_id}},
+                {"$push": {"song_ids": song_id}, "$inc": {"revision": 1}},
+                session=session,
+            )
+        return bool(result.modified_count)
+
+    async def remove_song(self, playlist_id, song_id):
+        """Remove every copy of the song; returns whether the playlist changed."""
+        async with self._writing([playlist_id]) as session:
+            result = await self.db.playlists.update_one(
+                {"id": playlist_id, "song_ids": song_id},
+                {"$pull": {"song_ids": song_id}, "$inc": {"revision": 1}},
+                session=session,
+            )
+        return bool(result.modified_count)
+
+    async def song_window(self, playlist_id, offset, limit):
+        """``{"total", "song_ids", "revision"}`` with only the requested slice of ids, or None."""
+        # Only the requested window of song_ids leaves the database
+        pipeline = [
+            {"$match": {"id": playlist_id}},
+            {"$project": {
+                "_id": 0,
+                "total": {"$size": {"$ifNull": ["$song_ids", []]}},
+                "song_ids": {"$slice": [{"$ifNull": ["$song_ids", []]}, offset, limit]},
+                "revision": {"$ifNull": ["$revision", 0]},
+            }},
+        ]
+        async with self.router.reading("playlists", ("playlist", playlist_id)) as (db, session):
+            playlists = await db.playlists.aggregate(pipeline, session=session).to_list(1)
+        return playlists[0] if playlists else None
+
+    async def find_states(self, playlist_ids):
+        """``{playlist_id: {"id", "song_ids", "revision"}}`` for the playlists that exist."""
+        # Read from the primary: the bulk update it plans is checked against these revisions
+        playlists = await self.db.playlists.find(
+            {"id": {"$in": playlist_ids}}, {"_id": 0, "id": 1, "song_ids": 1, "revision": 1}
+        ).to_list(len(playlist_ids))
+        return {playlist["id"]: playlist for playlist in playlists}
+
+    async def apply_updates(self, updates):
+        """Apply ``playlist_ops.plan_updates`` output, all of it or none.
+
+        Raises ``PlaylistRevisionConflict`` when a playlist is no longer at its
+        planned revision. In a replica set the updates commit together, in a
+        transaction; elsewhere the ones that landed are reverted, unless their
+        playlist has changed again since.
+        """
+        write_id = uuid.uuid4().hex
+        playlist_ids = [update.playlist_id for update in updates]
+
+        async def write(session):
+            result = await self.db.playlists.bulk_write(
+                [mongo_update(update, write_id) for update in updates], ordered=False, session=session
+            )
+            if result.matched_count == len(updates):
+                return
+            # A concurrent writer changed some playlists between the read and
+            # the write; ours applied where our write id was recorded
+            applied = await self.db.playlists.find(
+                {"id": {"$in": playlist_ids}, "applied_writes": write_id}, {"_id": 0, "id": 1}, session=session
+            ).to_list(len(updates))
+            applied = {playlist["id"] for playlist in applied}
+            stale = [playlist_id for playlist_id in playlist_ids if playlist_id not in applied]
+            if not applied or (session is not None and session.in_transaction):
+                # Aborts the transaction
+                raise PlaylistRevisionConflict(stale)
+            await self.db.playlists.bulk_write(
+                [revert_update(update, write_id) for update in updates if update.playlist_id in applied],
+                ordered=False, session=session,
+            )
+            raise PlaylistRevisionConflict(stale, changed=sorted(applied))
+
+        await self.router.transaction("playlists", self.pin_keys(playlist_ids), write)
+
+
+class MongoPlays:
+    """Play events, stored one document per play ("events") or in per-user time buckets ("buckets")."""
+
+    def __init__(self, db, router, mode="events", bucket_span=None):
+        self.db = db
+        self.router = router
+        self.mode = mode
+        self.bucket_span = bucket_span
+
+    async def write(self, plays, batch=None, retry=False):
+        """Write a batch of plays; ``batch`` is its ``(writer, sequence)`` key, and with
+        ``retry`` an earlier attempt may have written part of it."""
+        batch = batch or (uuid.uuid4().hex, 0)
+        if self.mode == "buckets":
+            await write_play_buckets(self.db, plays, self.bucket_span, batch, retry)
+        else:
+            try:
+                await self.db.play_history.insert_many([dict(play) for play in plays], ordered=False)
+            except BulkWriteError as exc:
+                raise_unless_duplicates(exc)
+        await record_daily_plays(self.db, plays, batch)
+
+    async def recent(self, user_id, limit):
+        """The user's latest plays, newest first."""
+        if self.mode == "buckets":
+            return await recent_plays_from_buckets(self.db, user_id, limit)
+        cursor = self.db.play_history.find({"user_id": user_id}, {"_id": 0}).sort("played_at", -1)
+        return await cursor.limit(limit).to_list(limit)
+
+    async def iter_since(self, since, until=None):
+        """``user_id``, ``song_id`` and ``played_at`` of every play at or after ``since`` (and before
+        ``until``); an analytics read."""
+        async with self.router.reading("analytics") as (db, _):
+            if self.mode == "buckets":
+                async for play in iter_bucket_plays(db, since, until):
+                    yield play
+            else:
+                played_at = {"$gte": since} if until is None else {"$gte": since, "$lt": until}
+                projection = {"_id": 0, "user_id": 1, "song_id": 1, "played_at": 1}
+                async for play in db.play_history.find({"played_at": played_at}, projection).batch_size(10000):
+                    yield play
+
+    async def daily_for_user(self, user_id, days):
+        async with self.router.reading("analytics") as (db, _):
+            return await daily_plays(db, "user_daily_plays", "user_id", user_id, days)
+
+    async def daily_for_song(self, song_id, days):
+        async with self.router.reading("analytics") as (db, _):
+            return await daily_plays(db, "song_daily_plays", "song_id", song_id, days)
+
+
+class MongoVersions:
+    def __init__(self, db):
+        self.db = db
+
+    async def load(self, names):
+        """``{name: value}`` for the counters that exist."""
+        counters = self.db.versions.find({"_id": {"$in": list(names)}}, {"value": 1})
+        return {counter["_id"]: counter["value"] async for counter in counters}
+
+    async def increment(self, name):
+        """Increment a counter and return its new value."""
+        counter = await self.db.versions.find_one_and_update(
+            {"_id": name}, {"$inc": {"value": 1}}, {"value": 1}, upsert=True, return_document=ReturnDocument.AFTER
+        )
+        return counter["value"]
+
+    async def increment_logged(self, name, entry):
+        """Increment a counter, appending ``entry`` to its log of the last ``VERSION_LOG_SIZE`` increments."""
+        counter = await self.db.versions.find_one_and_update(
+            {"_id": name},
+            {"$inc": {"value": 1}, "$push": {"log": {"$each": [entry], "$slice": -VERSION_LOG_SIZE}}},
+            {"value": 1},
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+        return counter["value"]
+
+    async def load_log(self, name):
+        """``(value, log)`` for a counter, the log's last entry being for ``value``."""
+        counter = await self.db.versions.find_one({"_id": name}, {"value": 1, "log": 1})
+        return (counter["value"], counter.get("log", [])) if counter else (0, [])
+
+
+class MongoRevokedTokens:
+    def __init__(self, db):
+        self.db = db
+
+    async def add(self, jti, expires_at):
+        await self.db.revoked_tokens.update_one(
+            {"_id": jti},
+            {"$setOnInsert": {"expires_at": expires_at, "revoked_at": datetime.utcnow()}},
+            upsert=True,
+        )
+
+    async def unexpired(self, now):
+        """``[(jti, expires_at), ...]`` for revocations of tokens still valid at ``now``."""
+        return [
+            (revoked["_id"], revoked["expires_at"])
+            async for revoked in self.db.revoked_tokens.find({"expires_at": {"$gt": now}})
+        ]
+
+    async def revoked_since(self, moment):
+        """``[(jti, expires_at), ...]`` for revocations made at or after ``moment``."""
+        return [
+            (revoked["_id"], revoked["expires_at"])
+            async for revoked in self.db.revoked_tokens.find({"revoked_at": {"$gte": moment}})
+        ]
+
+
+class MongoChartSketches:
+    def __init__(self, db):
+        self.db = db
+
+    async def save(self, key, state):
+        await self.db.chart_sketches.replace_one({"_id": key}, state, upsert=True)
+
+    async def load_all(self):
+        """``[(key, state), ...]`` for every saved sketch."""
+        return [(state.pop("_id"), state) async for state in self.db.chart_sketches.find({})]
+
+
+class MongoRecommendationModels:
+    """Recommendation models published by the worker that built them, in GridFS."""
+
+    def __init__(self, db):
+        self.db = db
+        self.bucket = AsyncIOMotorGridFSBucket(db, bucket_name="recommendation_models")
+
+    async def latest(self):
+        """``{"id", "built_until"}`` of the newest model, or None."""
+        model = await self.db["recommendation_models.files"].find_one(
+            {}, {"metadata.built_until": 1}, sort=[("uploadDate", -1)]
+        )
+        return model and {"id": model["_id"], "built_until": model["metadata"]["built_until"]}
+
+    async def load(self, model_id):
+        stream = await self.bucket.open_download_stream(model_id)
+        return await stream.read()
+
+    async def save(self, data, built_until):
+        """Store a model and return its id; all but the two newest are deleted."""
+        model_id = await self.bucket.upload_from_stream("model", data, metadata={"built_until": built_until})
+        # The previous one stays for workers still downloading it
+        async for old in self.db["recommendation_models.files"].find({}, {"_id": 1}).sort("uploadDate", -1).skip(2):
+            await self.bucket.delete(old["_id"])
+        return model_id
+
+
+class MongoLocks:
+    """Named locks held by one owner until released or ``expires_at`` passes."""
+
+    def __init__(self, db):
+        self.db = db
+
+    async def acquire(self, name, owner, expires_at):
+        """Take (or extend) the lock; returns False while another owner holds it."""
+        try:
+            # Matches a free, expired or own lock; otherwise the upsert collides on _id
+            await self.db.locks.update_one(
+                {"_id": name, "$or": [{"expires_at": {"$lte": datetime.utcnow()}}, {"owner": owner}]},
+                {"$set": {"owner": owner, "expires_at": expires_at}},
+                upsert=True,
+            )
+        except DuplicateKeyError:
+            return False
+        return True
+
+    async def release(self, name, owner):
+        await self.db.locks.delete_one({"_id": name, "owner": owner})
+
+
+class MongoStorage:
+    def __init__(self, client, db, play_history_mode="events", bucket_span=None, read_policies=None, pin_seconds=100.0):
+        """``read_policies`` maps read kinds to ``read_policy`` results (see ``ReadRouter``)."""
+        self.client = client
+        self.db = db
+        self.router = ReadRouter(client, db, read_policies, pin_seconds)
+        self.songs = MongoSongs(db, self.router)
+        self.users = MongoUsers(db)
+        self.playlists = MongoPlaylists(db, self.router)
+        self.plays = MongoPlays(db, self.router, play_history_mode, bucket_span)
+        self.versions = MongoVersions(db)
+        self.revoked_tokens = MongoRevokedTokens(db)
+        self.chart_sketches = MongoChartSketches(db)
+        self.recommendation_models = MongoRecommendationModels(db)
+        self.locks = MongoLocks(db)
+
+    async def ensure_indexes(self):
+        await ensure_indexes(self.db)
+
+    def pin_reads(self, kind, playlist_ids=None):
+        """Keep reads of ``kind`` on the primary for a while; call when another process changed it.
+
+        For ``playlists``, pass the ids of the playlists changed, when known, to pin only those and the listings.
+        """
+        if kind == "playlists" and playlist_ids is not None:
+            self.router.pin(MongoPlaylists.pin_keys(playlist_ids))
+        else:
+            self.router.pin([kind])
+
+    def close(self):
+        self.client.close()
+
+
+async def check_reads(storage):
+    """Write and read back a scratch playlist and read the catalog and analytics; returns whether reads saw the writes."""
+    hello = await storage.client.admin.command("hello")
+    if "setName" not in hello:
+        print("Not a replica set: every read goes to the one server (start mongod with --replSet and run rs.initiate())")
+        return False
+    print(f"Replica set {hello['setName']}: primary {hello.get('primary')}, members {', '.join(hello['hosts'])}")
+    for kind in READ_KINDS:
+        print(f"  {kind} reads: {storage.router.mode(kind)}")
+    playlist_id = f"read-check-{uuid.uuid4()}"
+    try:
+        await storage.playlists.insert({"id": playlist_id, "name": "Read check", "user_id": "read-check", "song_ids": []})
+        created = await storage.playlists.get(playlist_id)
+        await storage.playlists.add_song(playlist_id, "read-check-song")
+        window = await storage.playlists.song_window(playlist_id, 0, 1)
+    finally:
+        await storage.db.playlists.delete_one({"id": playlist_id})
+    read_own_writes = created is not None and window is not None and window["song_ids"] == ["read-check-song"]
+    print(f"Playlist reads after writes: {'saw them' if read_own_writes else 'MISSED them'}")
+    await storage.songs.find_page(None, 10)
+    await storage.plays.daily_for_song("read-check-song", 7)
+    for metric in (mongo_reads, mongo_server_commands):
+        for line in metric.render():
+            if not line.startswith("#"):
+                print(line)
+    return read_own_writes
+
+
+async def _main(command):
+    import server
+
+    try:
+        if server.STORAGE_BACKEND == "memory":
+            print("Read routing applies to STORAGE_BACKEND=mongo")
+            return 1
+        return 0 if await check_reads(server.storage) else 1
+    finally:
+        server.storage.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check read routing against the configured MongoDB deployment")
+    parser.add_argument("command", choices=["check-reads"])
+    args = parser.parse_args()
+    sys.exit(asyncio.run(_main(args.command)))
@@ -0,0 +1,168 @@
+"""Catalog and playlist version counters for conditional GETs.
+
+Write handlers bump a counter in the storage's ``versions`` repository once
+their write has landed: ``catalog`` for songs and the artist/album/genre summaries,
+``playlists`` for any playlist change (each playlist also carries its own
+``revision``). Read endpoints build strong ETags from the in-process copy of
+the counters, so a matching ``If-None-Match`` is answered with 304 before any
+database work. ``ContentVersions`` polls the counters to notice writes made by
+other processes (more workers, ``ingest.py``), so those are picked up within
+``poll_interval`` seconds.
+
+Each ``playlists`` increment also records which playlists it was for, in a
+short log kept with the counter, so a process noticing other processes'
+writes forgets (and pins reads of) only those playlists. When the log no
+longer reaches back far enough, or a write changed too many playlists to
+list, every playlist counts as changed.
+"""
+import asyncio
+import logging
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+COUNTERS = ("catalog", "playlists")
+# Increments kept in a counter's log, and playlists listed per entry (a write
+# changing more is logged as changing all of them)
+VERSION_LOG_SIZE = 256
+MAX_LOGGED_PLAYLISTS = 100
+
+
+def etag_matches(if_none_match, etag):
+    """Whether an ``If-None-Match`` header value covers ``etag`` (weak comparison)."""
+    if not if_none_match:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in tags or any(tag.removeprefix("W/") == etag for tag in tags)
+
+
+class ContentVersions:
+    def __init__(self, on_change=None, poll_interval=1.0, max_revisions=10000):
+        """``on_change(name, changed)`` is called when a counter moved because of a write made elsewhere.
+
+        ``changed`` is the set of playlist ids changed for ``playlists`` when
+        known, otherwise None.
+        """
+        self.values = dict.fromkeys(COUNTERS, 0)
+        self.poll_interval = poll_interval
+        self.max_revisions = max_revisions
+        self._on_change = on_change
+        self._revisions = OrderedDict()  # playlist id -> last known revision
+        self._changed_at = OrderedDict()  # playlist id -> playlists counter when it last changed
+        self._all_changed_at = 0  # playlists counter when any playlist may have changed
+        self._loaded = False
+        # A poll landing between a bump's increment and its update would count our own write as external
+        self._lock = asyncio.Lock()
+        self._task = None
+
+    def __getitem__(self, name):
+        return self.values[name]
+
+    def _update(self, name, value, external, changed=None):
+        if value <= self.values[name]:
+            return
+        self.values[name] = value
+        if external:
+            logger.info("%s version moved to %d elsewhere", name, value)
+            if name == "playlists":
+                self._playlists_changed(changed, value)
+            if self._on_change is not None:
+                self._on_change(name, changed)
+
+    def _playlists_changed(self, playlist_ids, value):
+        if playlist_ids is None:
+            self._revisions.clear()
+            self._changed_at.clear()
+            self._all_changed_at = value
+            return
+        for playlist_id in playlist_ids:
+            self._revisions.pop(playlist_id, None)
+            self._changed_at.pop(playlist_id, None)
+            self._changed_at[playlist_id] = value
+        while len(self._changed_at) > self.max_revisions:
+            # Forgetting when it changed means treating a read from before then as stale
+            _, changed_at = self._changed_at.popitem(last=False)
+            self._all_changed_at = max(self._all_changed_at, changed_at)
+
+    async def _playlists_logged(self, versions, first, last):
+        """Ids of the playlists changed by ``playlists`` counter values ``first`` to ``last``, or None if unknown."""
+        value, log = await versions.load_log("playlists")
+        changed = set()
+        for counter in range(first, last + 1):
+            index = len(log) - 1 - (value - counter)
+            if index < 0 or index >= len(log) or log[index] is None:
+                return None
+            changed.update(log[index])
+        return changed
+
+    async def load(self, versions):
+        """Read the current counters; changes after the first load count as external."""
+        async with self._lock:
+            await self._load(versions)
+
+    async def _load(self, versions):
+        for name, value in (await versions.load(COUNTERS)).items():
+            changed = None
+            if self._loaded and name == "playlists" and value > self.values[name]:
+                changed = await self._playlists_logged(versions, self.values[name] + 1, value)
+            self._update(name, value, external=self._loaded, changed=changed)
+        self._loaded = True
+
+    async def bump(self, versions, name, playlist_ids=None):
+        """Count a write that has landed; for ``playlists`` pass the ids of the playlists it changed."""
+        async with self._lock:
+            return await self._bump(versions, name, playlist_ids)
+
+    async def _bump(self, versions, name, playlist_ids):
+        expected = self.values[name] + 1
+        if name != "playlists":
+            value = await versions.increment(name)
+            # Anything beyond our own increment means another process wrote too
+            self._update(name, value, external=value != expected)
+            return value
+        if playlist_ids is not None and len(playlist_ids) > MAX_LOGGED_PLAYLISTS:
+            playlist_ids = None
+        value = await versions.increment_logged(name, None if playlist_ids is None else list(playlist_ids))
+        changed = await self._playlists_logged(versions, expected, value - 1) if value != expected else None
+        self._update(name, value, external=value != expected, changed=changed)
+        self._playlists_changed(playlist_ids, value)
+        return value
+
+    def playlist_revision(self, playlist_id):
+        """The playlist's revision if it is known to be current, else None."""
+        revision = self._revisions.get(playlist_id)
+        if revision is not None:
+            self._revisions.move_to_end(playlist_id)
+        return revision
+
+    def remember_revision(self, playlist_id, revision, as_of):
+        """Record a revision read while the ``playlists`` counter was ``as_of``.
+
+        Skipped if a write to the playlist finished since, as the read may predate it.
+        """
+        if max(self._all_changed_at, self._changed_at.get(playlist_id, 0)) > as_of:
+            return
+        self._revisions[playlist_id] = revision
+        self._revisions.move_to_end(playlist_id)
+        while len(self._revisions) > self.max_revisions:
+            self._revisions.popitem(last=False)
+
+    def start(self, versions):
+        self._task = asyncio.create_task(self._poll(versions))
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _poll(self, versions):
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            try:
+                await self.load(versions)
+            except Exception:
+                logger.exception("Refreshing content versions failed")
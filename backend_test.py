@@ -3,6 +3,8 @@ import requests
 import json
 import uuid
 import time
+import io
+import wave
 from pprint import pprint
 
 # Get the backend URL from the frontend .env file
@@ -69,6 +71,95 @@ def test_get_songs():
     print(f"Found {len(data)} songs with proper structure")
     return True
 
+def test_get_songs_pagination():
+    """Test keyset pagination and NDJSON streaming on GET /api/songs"""
+    # Walk the catalog three songs at a time using the X-Next-Cursor header
+    song_ids = []
+    params = {"limit": 3}
+    while True:
+        response = requests.get(f"{BACKEND_URL}/songs", params=params)
+        if response.status_code != 200:
+            print(f"Error: Expected status code 200, got {response.status_code}")
+            return False
+        song_ids.extend(song["id"] for song in response.json())
+        next_cursor = response.headers.get("X-Next-Cursor")
+        if not next_cursor:
+            break
+        params = {"limit": 3, "after": next_cursor}
+    
+    if len(song_ids) != len(set(song_ids)):
+        print("Error: Pages returned duplicate songs")
+        return False
+    
+    # The NDJSON stream should contain the same songs in the same order
+    response = requests.get(f"{BACKEND_URL}/songs", headers={"Accept": "application/x-ndjson"})
+    if response.status_code != 200:
+        print(f"Error: Expected status code 200, got {response.status_code}")
+        return False
+    
+    streamed_ids = [json.loads(line)["id"] for line in response.text.splitlines() if line]
+    if streamed_ids != song_ids:
+        print(f"Error: Streamed {len(streamed_ids)} songs, paged {len(song_ids)}")
+        return False
+    
+    print(f"Paged and streamed {len(song_ids)} songs consistently")
+    return True
+
+def test_conditional_get():
+    """Test ETag / If-None-Match on catalog read endpoints"""
+    for path in ["/songs", "/artists", "/albums", "/genres"]:
+        response = requests.get(f"{BACKEND_URL}{path}")
+        etag = response.headers.get("ETag")
+        if response.status_code != 200 or not etag:
+            print(f"Error: Expected 200 with an ETag from {path}, got {response.status_code}")
+            return False
+        
+        response = requests.get(f"{BACKEND_URL}{path}", headers={"If-None-Match": etag})
+        if response.status_code != 304:
+            print(f"Error: Expected status code 304 from {path}, got {response.status_code}")
+            return False
+    
+    print("Unchanged catalog pages answered with 304 Not Modified")
+    return True
+
+def test_upload_song():
+    """Test POST /api/songs/upload endpoint"""
+    # One second of silence as a WAV file, unique per run so it is not deduplicated
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as audio:
+        audio.setnchannels(1)
+        audio.setsampwidth(2)
+        audio.setframerate(8000)
+        audio.writeframes(b"\x00\x00" * 8000 + uuid.uuid4().bytes)
+    audio_bytes = buffer.getvalue()
+    form = {"title": "Upload Test", "artist": "Test Artist", "album": "Test Album", "genre": "Test"}
+    
+    response = requests.post(f"{BACKEND_URL}/songs/upload", data=form, files={"file": ("test.wav", audio_bytes, "audio/wav")})
+    if response.status_code != 200:
+        print(f"Error: Expected status code 200, got {response.status_code}")
+        print(f"Response: {response.text}")
+        return False
+    
+    song = response.json()
+    if song["duration"] != 1:
+        print(f"Error: Expected probed duration 1, got {song['duration']}")
+        return False
+    
+    # Uploading the same bytes again should return the same song
+    response = requests.post(f"{BACKEND_URL}/songs/upload", data=form, files={"file": ("copy.wav", audio_bytes, "audio/wav")})
+    if response.json()["id"] != song["id"]:
+        print("Error: Duplicate upload created a second song")
+        return False
+    
+    # The stored file should be served with Range support
+    response = requests.get(f"{BACKEND_URL}/songs/{song['id']}/stream", headers={"Range": "bytes=0-3"})
+    if response.status_code != 206 or response.content != b"RIFF":
+        print(f"Error: Expected 206 with the WAV header, got {response.status_code}")
+        return False
+    
+    print(f"Uploaded song {song['id']} and streamed a byte range from it")
+    return True
+
 def test_search_songs():
     """Test GET /api/songs/search endpoint"""
     # Test search for "electric" which should match "Electric Dreams"
@@ -104,6 +195,23 @@ def test_search_songs():
     print(f"Search found {len(data)} songs matching 'electric'")
     return True
 
+def test_search_typos():
+    """Test GET /api/songs/search matches short words with a transposition"""
+    # "jzaz" shares no trigram with "jazz", nor "lvoe" with "love"
+    for query, field, expected in (("jzaz", "title", "Midnight Jazz"), ("lvoe", "artist", "Love Frequency")):
+        response = requests.get(f"{BACKEND_URL}/songs/search?q={query}")
+        if response.status_code != 200:
+            print(f"Error: Expected status code 200, got {response.status_code}")
+            return False
+        
+        matches = [song[field] for song in response.json()]
+        if expected not in matches:
+            print(f"Error: Expected search for '{query}' to find {field} '{expected}', got {matches}")
+            return False
+        
+        print(f"Search for '{query}' found {field} '{expected}'")
+    return True
+
 def test_get_artists():
     """Test GET /api/artists endpoint"""
     response = requests.get(f"{BACKEND_URL}/artists")
@@ -161,6 +269,12 @@ def test_get_albums():
             print(f"Error: Missing required field '{field}' in album data")
             return False
     
+    # A cursor whose key values are not strings is rejected ("WzEsMl0" is [1,2])
+    response = requests.get(f"{BACKEND_URL}/albums", params={"after": "WzEsMl0"})
+    if response.status_code != 400:
+        print(f"Error: Expected status code 400 for a malformed cursor, got {response.status_code}")
+        return False
+    
     print(f"Found {len(data)} albums with proper structure")
     return True
 
@@ -287,6 +401,51 @@ def test_user_login():
     user_id = data["id"]
     return True
 
+def test_auth_token():
+    """Test bearer tokens from /api/auth/login with /api/auth/me and /api/auth/logout"""
+    global registered_user
+    
+    if not registered_user:
+        print("Error: No registered user available for token test")
+        return False
+    
+    response = requests.post(f"{BACKEND_URL}/auth/login", json={
+        "email": registered_user["email"],
+        "password": registered_user["password"]
+    })
+    token = response.json().get("access_token") if response.status_code == 200 else None
+    if not token:
+        print(f"Error: Expected an access token, got {response.status_code}: {response.text}")
+        return False
+    
+    # Wrong passwords are rejected
+    response = requests.post(f"{BACKEND_URL}/auth/login", json={
+        "email": registered_user["email"],
+        "password": "wrong-password"
+    })
+    if response.status_code != 401:
+        print(f"Error: Expected status code 401 for a wrong password, got {response.status_code}")
+        return False
+    
+    headers = {"Authorization": f"Bearer {token}"}
+    response = requests.get(f"{BACKEND_URL}/auth/me", headers=headers)
+    if response.status_code != 200 or response.json().get("email") != registered_user["email"]:
+        print(f"Error: Expected the token's user from /auth/me, got {response.status_code}: {response.text}")
+        return False
+    
+    response = requests.post(f"{BACKEND_URL}/auth/logout", headers=headers)
+    if response.status_code != 200:
+        print(f"Error: Expected status code 200 from logout, got {response.status_code}")
+        return False
+    
+    response = requests.get(f"{BACKEND_URL}/auth/me", headers=headers)
+    if response.status_code != 401:
+        print(f"Error: Expected status code 401 after logout, got {response.status_code}")
+        return False
+    
+    print("Token issued, verified and revoked")
+    return True
+
 def test_create_playlist():
     """Test POST /api/playlists endpoint"""
     global user_id
@@ -471,6 +630,54 @@ def test_get_playlist_songs():
     print(f"Found {len(data)} songs in playlist {playlist_id}, including our added song")
     return True
 
+def test_bulk_update_stale_revision():
+    """Test POST /api/playlists/bulk rejects a batch with one stale revision and applies none of it"""
+    global user_id, playlist_id, added_song_id
+    
+    if not playlist_id or not added_song_id:
+        print("Error: No playlist with a song available for bulk update test")
+        return False
+    
+    # A fresh playlist at revision 0, next to ours which adding a song moved past it
+    response = requests.post(f"{BACKEND_URL}/playlists", json={
+        "name": f"Bulk Playlist {str(uuid.uuid4())[:8]}",
+        "description": "A playlist for the bulk update test",
+        "user_id": user_id,
+        "cover_art": "https://images.pexels.com/photos/1021876/pexels-photo-1021876.jpeg",
+        "is_public": False
+    })
+    if response.status_code != 200:
+        print(f"Error: Failed to create playlist for bulk update test: {response.status_code}")
+        return False
+    other_playlist_id = response.json()["id"]
+    
+    response = requests.post(f"{BACKEND_URL}/playlists/bulk", json={
+        "operations": [
+            {"playlist_id": other_playlist_id, "op": "add", "song_id": added_song_id},
+            {"playlist_id": playlist_id, "op": "remove", "song_id": added_song_id},
+        ],
+        "expected_revisions": {other_playlist_id: 0, playlist_id: 0},
+    })
+    if response.status_code != 409:
+        print(f"Error: Expected status code 409, got {response.status_code}")
+        print(f"Response: {response.text}")
+        return False
+    
+    detail = response.json().get("detail", {})
+    if detail.get("playlist_ids") != [playlist_id]:
+        print(f"Error: Expected only {playlist_id} reported stale, got {detail}")
+        return False
+    
+    # Neither playlist changed
+    other_songs = requests.get(f"{BACKEND_URL}/playlists/{other_playlist_id}/songs").json()
+    songs = requests.get(f"{BACKEND_URL}/playlists/{playlist_id}/songs").json()
+    if other_songs or added_song_id not in [song["id"] for song in songs]:
+        print(f"Error: Rejected batch was partly applied")
+        return False
+    
+    print(f"Bulk update with a stale revision for {playlist_id} was rejected as a whole")
+    return True
+
 def test_record_play_history():
     """Test POST /api/play-history endpoint"""
     global user_id, added_song_id
@@ -513,6 +720,9 @@ def test_get_play_history():
         print("Error: No user ID available for get play history test")
         return False
     
+    # Plays are written in batches; give the buffer time to flush
+    time.sleep(1)
+    
     # Get play history
     response = requests.get(f"{BACKEND_URL}/play-history/{user_id}")
     
@@ -536,6 +746,106 @@ def test_get_play_history():
     print(f"Found {len(data)} play history entries for user {user_id}")
     return True
 
+def test_get_play_history_with_songs():
+    """Test GET /api/play-history/{user_id}?include_songs=true"""
+    global user_id
+    
+    if not user_id:
+        print("Error: No user ID available for play history test")
+        return False
+    
+    response = requests.get(f"{BACKEND_URL}/play-history/{user_id}", params={"include_songs": "true"})
+    if response.status_code != 200:
+        print(f"Error: Expected status code 200, got {response.status_code}")
+        return False
+    
+    data = response.json()
+    if not data or any(item.get("song", {}).get("id") != item["song_id"] for item in data if item.get("song")):
+        print(f"Error: Expected play history entries with their songs, got {data}")
+        return False
+    
+    print(f"Found {len(data)} play history entries with song details")
+    return True
+
+def test_get_charts():
+    """Test GET /api/charts/{dimension} endpoint"""
+    for dimension in ["songs", "artists", "genres"]:
+        response = requests.get(f"{BACKEND_URL}/charts/{dimension}", params={"window": "24h", "limit": 10})
+        if response.status_code != 200:
+            print(f"Error: Expected status code 200 for {dimension}, got {response.status_code}")
+            return False
+        
+        data = response.json()
+        if not isinstance(data, list) or any("plays" not in item for item in data):
+            print(f"Error: Expected a list of chart entries for {dimension}, got {data}")
+            return False
+    
+    print("Charts returned for songs, artists and genres")
+    return True
+
+def test_get_recommendations():
+    """Test GET /api/recommendations/{user_id} endpoint"""
+    global user_id
+    
+    if not user_id:
+        print("Error: No user ID available for recommendations test")
+        return False
+    
+    response = requests.get(f"{BACKEND_URL}/recommendations/{user_id}")
+    if response.status_code == 503:
+        print("Recommendation model is still being built")
+        return True
+    if response.status_code != 200:
+        print(f"Error: Expected status code 200, got {response.status_code}")
+        return False
+    
+    data = response.json()
+    if not isinstance(data, list):
+        print(f"Error: Expected list response, got {type(data)}")
+        return False
+    
+    print(f"Got {len(data)} recommendations for user {user_id}")
+    return True
+
+def test_get_metrics():
+    """Test GET /api/metrics endpoint"""
+    response = requests.get(f"{BACKEND_URL}/metrics")
+    if response.status_code != 200:
+        print(f"Error: Expected status code 200, got {response.status_code}")
+        return False
+    
+    if not response.headers.get("Content-Type", "").startswith("text/plain"):
+        print(f"Error: Expected Prometheus text format, got {response.headers.get('Content-Type')}")
+        return False
+    
+    for name in ["http_requests_total", "http_request_duration_seconds", "mongodb_command_duration_seconds"]:
+        if f"# TYPE {name}" not in response.text:
+            print(f"Error: Metric {name} missing from /metrics")
+            return False
+    
+    print("Metrics exposed in Prometheus text format")
+    return True
+
+def test_health_probes():
+    """Test GET /api/health/live and /api/health/ready endpoints"""
+    response = requests.get(f"{BACKEND_URL}/health/live")
+    if response.status_code != 200:
+        print(f"Error: Expected status code 200 from liveness, got {response.status_code}")
+        return False
+    
+    response = requests.get(f"{BACKEND_URL}/health/ready")
+    if response.status_code not in (200, 503):
+        print(f"Error: Expected status code 200 or 503 from readiness, got {response.status_code}")
+        return False
+    
+    data = response.json()
+    if data.get("status") != ("ready" if response.status_code == 200 else "starting") or not isinstance(data.get("checks"), dict):
+        print(f"Error: Unexpected readiness response: {data}")
+        return False
+    
+    print(f"Readiness: {data['status']} {data['checks']}")
+    return True
+
 if __name__ == "__main__":
     print(f"\n{'='*80}\nTesting Music Streaming Backend API\n{'='*80}")
     print(f"Backend URL: {BACKEND_URL}")
@@ -549,7 +859,11 @@ if __name__ == "__main__":
     # Run tests
     # 1. Music Library APIs
     run_test("Get Songs", test_get_songs)
+    run_test("Get Songs Pagination", test_get_songs_pagination)
+    run_test("Conditional Get", test_conditional_get)
+    run_test("Upload Song", test_upload_song)
     run_test("Search Songs", test_search_songs)
+    run_test("Search Typos", test_search_typos)
     run_test("Get Artists", test_get_artists)
     run_test("Get Albums", test_get_albums)
     run_test("Get Genres", test_get_genres)
@@ -557,16 +871,25 @@ if __name__ == "__main__":
     # 2. User Authentication
     run_test("User Registration", test_user_registration)
     run_test("User Login", test_user_login)
+    run_test("Auth Token", test_auth_token)
     
     # 3. Playlist Management
     run_test("Create Playlist", test_create_playlist)
     run_test("Get Playlists", test_get_playlists)
     run_test("Add Song to Playlist", test_add_song_to_playlist)
     run_test("Get Playlist Songs", test_get_playlist_songs)
+    run_test("Bulk Update Stale Revision", test_bulk_update_stale_revision)
     
     # 4. Play History
     run_test("Record Play History", test_record_play_history)
     run_test("Get Play History", test_get_play_history)
+    run_test("Get Play History With Songs", test_get_play_history_with_songs)
+    run_test("Get Recommendations", test_get_recommendations)
+    run_test("Get Charts", test_get_charts)
+    
+    # 5. Operations
+    run_test("Get Metrics", test_get_metrics)
+    run_test("Health Probes", test_health_probes)
     
     # Print summary
     print(f"\n{'='*80}\nTest Summary\n{'='*80}")
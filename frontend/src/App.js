@@ -122,7 +122,10 @@ const Player = () => {
 
   useEffect(() => {
     if (currentSong) {
-      audioRef.current.src = currentSong.audio_url;
+      // Locally stored songs are served by the backend (`/api/songs/{id}/stream`)
+      audioRef.current.src = currentSong.audio_url.startsWith('/')
+        ? `${BACKEND_URL}${currentSong.audio_url}`
+        : currentSong.audio_url;
       audioRef.current.load();
     }
   }, [currentSong]);
@@ -573,6 +576,9 @@ const App = () => {
   }, []);
 
   const handleLogin = (userData) => {
+    if (userData.access_token) {
+      axios.defaults.headers.common['Authorization'] = `Bearer ${userData.access_token}`;
+    }
     setUser(userData);
   };
 